@@ -2,33 +2,39 @@
 
 import argparse
 from commandline.Augment import Augment
+from commandline.Benchmark import Benchmark
 from commandline.Detect import Detect
+from commandline.Export import Export
 from commandline.Analyze import Analyze
 from commandline.Label import Label
+from commandline.Pack import Pack
+from commandline.Run import Run
 from commandline.Split import Split
 from commandline.Track import Track
 from commandline.Train import Train
 
 # List of sub-programs.
-programs = [Augment, Detect, Label, Split, Track, Train, Analyze]
+programs = [Augment, Detect, Label, Split, Pack, Track, Train, Export, Analyze, Run, Benchmark]
 
-# Parse sub-program selection
-parser = argparse.ArgumentParser(
-    description="OrganoID: deep learning for organoid image analysis.")
-subparsers = parser.add_subparsers(dest="subparser_name")
+# Sub-programs may start worker processes, which re-import this module. Only the main process runs the CLI.
+if __name__ == "__main__":
+    # Parse sub-program selection
+    parser = argparse.ArgumentParser(
+        description="OrganoID: deep learning for organoid image analysis.")
+    subparsers = parser.add_subparsers(dest="subparser_name")
 
-# Instantiate sub-programs
-programs = [program() for program in programs]
+    # Instantiate sub-programs
+    programs = [program() for program in programs]
 
-# Load sub-program arguments
-for program in programs:
-    program.SetupParser(subparsers.add_parser(program.Name(), help=program.Description()))
+    # Load sub-program arguments
+    for program in programs:
+        program.SetupParser(subparsers.add_parser(program.Name(), help=program.Description()))
 
-# Parse all command-line arguments.
-args = parser.parse_args()
+    # Parse all command-line arguments.
+    args = parser.parse_args()
 
-# Run the selected sub-program with the parsed arguments.
-for program in programs:
-    if program.Name() == args.subparser_name:
-        program.RunProgram(args)
-        break
+    # Run the selected sub-program with the parsed arguments.
+    for program in programs:
+        if program.Name() == args.subparser_name:
+            program.RunProgram(args)
+            break
@@ -1,11 +1,18 @@
 # Augment.py -- augment images with random transformations
 
-import Augmentor
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import math
 import re
+import threading
+import numpy as np
+import scipy.ndimage as ndimage
 
 
+# Writes count augmented copies of the images and segmentations to disk with Augmentor.
 def Augment(imagesPath: Path, segmentationsPath: Path, outputPath: Path, count: int):
+    import Augmentor
+
     outputPath.mkdir(parents=True, exist_ok=True)
 
     augmentor = Augmentor.Pipeline(source_directory=imagesPath,
@@ -44,3 +51,185 @@ def Augment(imagesPath: Path, segmentationsPath: Path, outputPath: Path, count:
     for imageFile in trainingImageFiles:
         newFilename = re.sub(".*_", "", imageFile.name)
         imageFile.rename(outputImagesPath / newFilename)
+
+
+# Augments images and masks in memory, during training. The transformations and their parameters are those of Augment
+# (after Augmentor's implementation of each), but all of them are combined into one map from output to input
+# coordinates, so every example is resampled only once. Images are resampled bilinearly and masks with nearest
+# neighbours, so masks stay binary. Pixels mapped from outside the image are 0. The examples of a batch are augmented on
+# several threads.
+class Augmenter:
+    def __init__(self, workers=None, seed=None, rotation=20, flipProbability=0.5, zoomProbability=0.5, zoomArea=0.7,
+                 shear=20, distortionProbability=0.5, distortionGrid=5, distortionMagnitude=3, skewProbability=0.5,
+                 skewMagnitude=0.3):
+        self.rotation = rotation
+        self.flipProbability = flipProbability
+        self.zoomProbability = zoomProbability
+        self.zoomArea = zoomArea
+        self.shear = shear
+        self.distortionProbability = distortionProbability
+        self.distortionGrid = distortionGrid
+        self.distortionMagnitude = distortionMagnitude
+        self.skewProbability = skewProbability
+        self.skewMagnitude = skewMagnitude
+        self._executor = ThreadPoolExecutor(workers)
+        self._seeds = np.random.SeedSequence(seed)
+        self._seedLock = threading.Lock()
+
+    # Augments a batch of images and masks, each of shape (batch, rows, columns, 1) (or (batch, rows, columns)).
+    # Each image is transformed together with its mask.
+    def AugmentBatch(self, images: np.ndarray, masks: np.ndarray):
+        with self._seedLock:
+            seeds = self._seeds.spawn(len(images))
+        augmentedImages = np.empty_like(images)
+        augmentedMasks = np.empty_like(masks)
+
+        def AugmentExample(i):
+            image, mask = self.Augment(images[i], masks[i], np.random.default_rng(seeds[i]))
+            augmentedImages[i] = image
+            augmentedMasks[i] = mask
+
+        list(self._executor.map(AugmentExample, range(len(images))))
+        return augmentedImages, augmentedMasks
+
+    def Augment(self, image: np.ndarray, mask: np.ndarray, rng: np.random.Generator):
+        rows, columns = self.SourceCoordinates(image.shape[:2], rng)
+        coordinates = np.stack([rows, columns])
+        if image.ndim == 3:
+            coordinates = np.concatenate([coordinates[..., None], np.zeros_like(coordinates[:1, ..., None])])
+        augmented = ndimage.map_coordinates(image.astype(np.float32), coordinates, order=1, mode="constant")
+        if np.issubdtype(image.dtype, np.integer):
+            augmented = np.clip(np.round(augmented), np.iinfo(image.dtype).min, np.iinfo(image.dtype).max)
+        return augmented.astype(image.dtype), ndimage.map_coordinates(mask, coordinates, order=0, mode="constant")
+
+    def SourceCoordinates(self, shape, rng: np.random.Generator):
+        # Draws a random transformation and returns the (row, column) input coordinates of each output pixel.
+        # Transformations are applied to the image in the order rotate, flips, zoom, shear, distort, skew, so the
+        # coordinate maps are applied the other way around. Coordinates are continuous, with pixel centers at +0.5 (as
+        # in PIL, which Augmentor uses).
+        height, width = shape
+        y, x = np.meshgrid(np.arange(height) + 0.5, np.arange(width) + 0.5, indexing="ij")
+        if rng.random() < self.skewProbability:
+            x, y = self._Skew(x, y, width, height, rng)
+        if rng.random() < self.distortionProbability:
+            x, y = self._Distort(x, y, width, height, rng)
+        x, y = self._Shear(x, y, width, height, rng)
+        if rng.random() < self.zoomProbability:
+            x, y = self._Zoom(x, y, width, height, rng)
+        if rng.random() < self.flipProbability:
+            y = height - y
+        if rng.random() < self.flipProbability:
+            x = width - x
+        x, y = self._Rotate(x, y, width, height, rng)
+        return y - 0.5, x - 0.5
+
+    def _Rotate(self, x, y, width, height, rng):
+        # Rotates by a random whole number of degrees, crops the largest rectangle without borders and scales it back
+        # to the original size.
+        angle = int(rng.integers(-self.rotation, 1)) if rng.integers(2) == 0 else int(rng.integers(0, self.rotation + 1))
+        matrix = _RotationMatrix(angle, width, height)
+        rotatedWidth, rotatedHeight = matrix.pop()
+        angleA = math.radians(abs(angle))
+        angleB = math.radians(90 - abs(angle))
+        e = math.sin(angleA) / math.sin(angleB) * (rotatedHeight - rotatedWidth * (math.sin(angleA) / math.sin(angleB)))
+        e = e / 1 - (math.sin(angleA) ** 2 / math.sin(angleB) ** 2)
+        a = (math.sin(angleA) / math.sin(angleB)) * (rotatedWidth - e)
+        left, top = int(round(e)), int(round(a))
+        right, bottom = int(round(rotatedWidth - e)), int(round(rotatedHeight - a))
+        x = left + x * (right - left) / width
+        y = top + y * (bottom - top) / height
+        return matrix[0] * x + matrix[1] * y + matrix[2], matrix[3] * x + matrix[4] * y + matrix[5]
+
+    def _Zoom(self, x, y, width, height, rng):
+        # Crops a random region of zoomArea times the width and height, and scales it back to the original size.
+        zoomedWidth = int(math.floor(width * self.zoomArea))
+        zoomedHeight = int(math.floor(height * self.zoomArea))
+        left = int(rng.integers(0, width - zoomedWidth + 1))
+        top = int(rng.integers(0, height - zoomedHeight + 1))
+        return left + x * zoomedWidth / width, top + y * zoomedHeight / height
+
+    def _Shear(self, x, y, width, height, rng):
+        # Shears along x or y by a random angle, crops the sheared-in border and scales back to the original size.
+        angle = int(rng.uniform(-self.shear - 1, self.shear + 1))
+        if angle != -1:
+            angle += 1
+        phi = math.tan(math.radians(angle))
+        alongX = rng.integers(2) == 0
+        shift = phi * (height if alongX else width)
+        shift = math.ceil(shift) if shift > 0 else math.floor(shift)
+        offset = shift
+        if angle <= 0:
+            shift = abs(shift)
+            offset = 0
+            phi = -abs(phi)
+        if alongX:
+            x = shift + x * (width - shift) / width
+            return x + phi * y - offset, y
+        y = shift + y * (height - shift) / height
+        return x, phi * x + y - offset
+
+    def _Distort(self, x, y, width, height, rng):
+        # Moves each inner point of a grid by a random number of pixels, and stretches the image cells with them.
+        tiles = self.distortionGrid
+        magnitude = self.distortionMagnitude
+        gridX = np.append(np.arange(tiles) * (width // tiles), width).astype(np.float64)
+        gridY = np.append(np.arange(tiles) * (height // tiles), height).astype(np.float64)
+        displacements = np.zeros([tiles + 1, tiles + 1, 2])
+        for row in range(1, tiles):
+            for column in range(1, tiles):
+                displacements[row, column] = rng.integers(-magnitude, magnitude + 1, 2)
+
+        # Each output pixel is moved by the bilinear interpolation of the displacements at its cell's corners.
+        gridCoordinates = [np.interp(y, gridY, np.arange(tiles + 1)), np.interp(x, gridX, np.arange(tiles + 1))]
+        return (x + ndimage.map_coordinates(displacements[..., 0], gridCoordinates, order=1, mode="nearest"),
+                y + ndimage.map_coordinates(displacements[..., 1], gridCoordinates, order=1, mode="nearest"))
+
+    def _Skew(self, x, y, width, height, rng):
+        # Perspective transform that moves one or two corners by a random amount (a tilt or a corner skew).
+        amount = int(rng.integers(1, int(math.ceil(max(width, height) * self.skewMagnitude)) + 1))
+        original = [(0, 0), (width, 0), (width, height), (0, height)]
+        skewed = [list(corner) for corner in original]
+        skew = ["TILT", "TILT_LEFT_RIGHT", "TILT_TOP_BOTTOM", "CORNER"][rng.integers(4)]
+        if skew == "CORNER":
+            # One corner is moved along one of its edges.
+            direction = int(rng.integers(8))
+            corner, axis = direction // 2, direction % 2
+            outwards = [-1, -1] if corner == 0 else [1, -1] if corner == 1 else [1, 1] if corner == 2 else [-1, 1]
+            skewed[corner][axis] += outwards[axis] * amount
+        else:
+            direction = int(rng.integers(4) if skew == "TILT" else rng.integers(2) if skew == "TILT_LEFT_RIGHT" else
+                            rng.integers(2, 4))
+            # Left, right, forward and backward tilts move the corners of one edge apart.
+            corners, axis, signs = [((0, 3), 1, (-1, 1)), ((1, 2), 1, (-1, 1)), ((0, 1), 0, (-1, 1)),
+                                    ((3, 2), 0, (-1, 1))][direction]
+            for corner, sign in zip(corners, signs):
+                skewed[corner][axis] += sign * amount
+
+        # Coefficients of the perspective map from skewed to original corners
+        matrix = []
+        for (skewedX, skewedY), (originalX, originalY) in zip(skewed, original):
+            matrix.append([skewedX, skewedY, 1, 0, 0, 0, -originalX * skewedX, -originalX * skewedY])
+            matrix.append([0, 0, 0, skewedX, skewedY, 1, -originalY * skewedX, -originalY * skewedY])
+        a, b, c, d, e, f, g, h = np.linalg.pinv(np.array(matrix, dtype=float)) @ np.array(original, dtype=float).ravel()
+        denominator = g * x + h * y + 1
+        return (a * x + b * y + c) / denominator, (d * x + e * y + f) / denominator
+
+
+def _RotationMatrix(angle, width, height):
+    # Affine map from output to input coordinates of PIL's Image.rotate(angle, expand=True), followed by the size of the
+    # rotated image.
+    radians = -math.radians(angle)
+    matrix = [round(math.cos(radians), 15), round(math.sin(radians), 15), 0.0,
+              round(-math.sin(radians), 15), round(math.cos(radians), 15), 0.0]
+
+    def Transform(x, y):
+        return matrix[0] * x + matrix[1] * y + matrix[2], matrix[3] * x + matrix[4] * y + matrix[5]
+
+    matrix[2], matrix[5] = Transform(-width / 2.0, -height / 2.0)
+    matrix[2] += width / 2.0
+    matrix[5] += height / 2.0
+    corners = [Transform(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))]
+    rotatedWidth = math.ceil(max(x for x, _ in corners)) - math.floor(min(x for x, _ in corners))
+    rotatedHeight = math.ceil(max(y for _, y in corners)) - math.floor(min(y for _, y in corners))
+    matrix[2], matrix[5] = Transform(-(rotatedWidth - width) / 2.0, -(rotatedHeight - height) / 2.0)
+    return matrix + [(rotatedWidth, rotatedHeight)]
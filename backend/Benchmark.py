@@ -0,0 +1,293 @@
+# Benchmark.py -- measures the throughput of OrganoID's processing stages, for comparison across versions and machines.
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import ast
+import inspect
+import itertools
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+
+# Ways of running a Detector: Detect on one frame at a time, DetectBatch on batches of frames, DetectMultiple on
+# frames already prepared at network size, and DetectBatch in tiled mode.
+DetectorModes = ["detect", "batch", "multiple", "tiled"]
+
+
+# Runs a Detector benchmark for every combination of the given settings, each in a new process (so that its peak
+# memory use is its own). imageSources are "synthetic" or directories of images. Images are resized to each of
+# imageSizes (square), or kept at their own size if imageSizes is [None]. Returns the results, one dict per run.
+def BenchmarkDetectors(modelPaths, imageSources, imageSizes, modes, batchSizes, threadCounts, frames, repeats,
+                       tileOverlap=64, log=print):
+    runs = []
+    for modelPath, source, size, mode, batchSize, threads in itertools.product(modelPaths, imageSources, imageSizes,
+                                                                               modes, batchSizes, threadCounts):
+        if mode == "detect" and batchSize != batchSizes[0]:
+            # Detect always sends one frame at a time.
+            continue
+        run = {"model": str(modelPath), "images": str(source), "size": size, "mode": mode,
+               "batchSize": 1 if mode == "detect" else batchSize, "threads": threads, "frames": frames,
+               "repeats": repeats, "tileOverlap": tileOverlap if mode == "tiled" else None}
+        run.update(_RunInNewProcess(_BenchmarkDetectorRun, run))
+        log(FormatRun(run))
+        runs.append(run)
+    return runs
+
+
+# Times Tracker.Track on synthetic scenes (see SyntheticScenes) with each of the given numbers of organoids, each in a
+# new process, and scores its assignments against the ground truth. sceneParameters are further SyntheticScene
+# arguments. If savePath is given, each scene is also saved there. Returns the results, one dict per run: its settings,
+# the mean, median and 95th percentile time per frame in seconds, frames per second, peak memory use, the number of
+# each kind of scene event, and the scores from SyntheticScenes.ScoreTracking.
+def BenchmarkTracking(organoidCounts, frames, imageSize, sceneParameters: dict, savePath: Path = None, log=print):
+    runs = []
+    for organoids in organoidCounts:
+        run = dict(sceneParameters, organoids=organoids, frames=frames, imageSize=list(imageSize),
+                   savePath=str(savePath / ("scene_%d" % organoids)) if savePath is not None else None)
+        run.update(_RunInNewProcess(_BenchmarkTrackingRun, run))
+        log("%d organoids, %d frames of %dx%d: mean %.1f ms, p50 %.1f ms, p95 %.1f ms per frame, %.2f frames/s, "
+            "peak RSS %s MB; link accuracy %.4f, purity %.4f (%d tracks for %d organoids)" %
+            (organoids, frames, imageSize[0], imageSize[1], run["mean"] * 1000, run["p50"] * 1000, run["p95"] * 1000,
+             run["fps"], "%.0f" % run["peakRSS"] if run["peakRSS"] is not None else "?", run["linkAccuracy"],
+             run["purity"], run["tracks"], run["truthOrganoids"]))
+        runs.append(run)
+    return runs
+
+
+# Measures the startup cost of each sub-program (Program subclasses): importing OrganoID.py and every module that the
+# sub-program imports, in a new interpreter with python -X importtime, repeats times. Returns the results, one dict
+# per sub-program: the modules, the median total import time and process time in seconds, the slowest top-level
+# imports, and whether TensorFlow was imported (or the error, if an import failed).
+def BenchmarkStartup(programs, repeats=3, log=print):
+    root = Path(__file__).parent.parent
+    runs = []
+    for program in programs:
+        modules = ProgramImports(program)
+        command = [sys.executable, "-X", "importtime", "-c",
+                   "; ".join("import " + module for module in ["OrganoID"] + modules)]
+        importTimes = []
+        processTimes = []
+        run = {"program": program().Name(), "modules": modules}
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = subprocess.run(command, cwd=root, capture_output=True, text=True)
+            processTimes.append(time.perf_counter() - start)
+            if result.returncode != 0:
+                run["error"] = result.stderr.strip().splitlines()[-1]
+                break
+            imports = _ParseImportTimes(result.stderr)
+            importTimes.append(sum(selfTime for _, selfTime, _, _ in imports))
+        if "error" not in run:
+            topLevel = sorted(((name, cumulative) for name, _, cumulative, depth in imports if depth == 0),
+                              key=lambda entry: -entry[1])
+            run.update({"importTime": float(np.median(importTimes)), "processTime": float(np.median(processTimes)),
+                        "slowest": dict(topLevel[:5]),
+                        "tensorflow": any(name.split(".")[0] == "tensorflow" for name, _, _, _ in imports)})
+            log("%-10s %7.3f s imports, %7.3f s process%s; slowest: %s" %
+                (run["program"], run["importTime"], run["processTime"], " (TensorFlow)" if run["tensorflow"] else "",
+                 ", ".join("%s %.3f s" % entry for entry in topLevel[:3])))
+        else:
+            log("%-10s failed: %s" % (run["program"], run["error"]))
+        runs.append(run)
+    return runs
+
+
+# Modules that a sub-program imports (at module level or in its methods), other than the standard library modules
+# that every sub-program uses.
+def ProgramImports(program):
+    modules = []
+    for node in ast.walk(ast.parse(inspect.getsource(inspect.getmodule(program)))):
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules.append(node.module)
+    return [module for module in dict.fromkeys(modules) if module not in ["argparse", "pathlib"]]
+
+
+def FormatRun(run):
+    timings = run["timings"]
+    total = sum(timings.values()) or 1
+    return ("%s | %s | %s | %-8s | batch %d | %d threads: p50 %.1f ms, p95 %.1f ms, %.2f frames/s, peak RSS %s MB, "
+            "%s" % (Path(run["model"]).parent.name + "/" + Path(run["model"]).name, Path(run["images"]).name,
+                    run["size"] or "native", run["mode"], run["batchSize"], run["threads"], run["p50"] * 1000,
+                    run["p95"] * 1000, run["fps"], "%.0f" % run["peakRSS"] if run["peakRSS"] is not None else "?",
+                    ", ".join("%s %.0f%%" % (stage, 100 * seconds / total) for stage, seconds in timings.items())))
+
+
+# Information about the code and machine that a benchmark ran on.
+def Environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "platform": platform.platform(),
+            "processor": platform.processor(), "cpuCount": multiprocessing.cpu_count(),
+            "python": platform.python_version()}
+
+
+def SaveResults(path: Path, target, runs):
+    with open(path, "w+") as file:
+        json.dump({"target": target, "environment": Environment(), "runs": runs}, file, indent=2)
+
+
+# Settings that identify a run of each benchmark target, for matching runs across result files.
+_detectorSettings = ["model", "images", "size", "mode", "batchSize", "threads", "frames", "tileOverlap"]
+_trackingSettings = ["organoids", "frames", "imageSize", "radius", "growth", "drift", "jitter", "mergeRate",
+                     "splitRate", "disappearRate", "seed"]
+_startupSettings = ["program"]
+
+
+def _RunSettings(run):
+    if "program" in run:
+        return _startupSettings
+    return _detectorSettings if "model" in run else _trackingSettings
+
+
+def _RunKey(run):
+    # Settings are serialized, as some of them (such as imageSize) are lists.
+    settings = _RunSettings(run)
+    return json.dumps([settings] + [run.get(name) for name in settings])
+
+
+def _RunLabel(run):
+    if _RunSettings(run) is _trackingSettings:
+        return "%s organoids, %s frames of %s" % (run.get("organoids"), run.get("frames"),
+                                                  "x".join(str(size) for size in run.get("imageSize") or []))
+    return " ".join(str(run.get(name)) for name in _detectorSettings[:6])
+
+
+# Compares the frame rates of runs (or, for startup runs, the import times) with a previous result file, matching runs
+# by their settings. Returns report lines.
+def CompareResults(previousPath: Path, runs):
+    with open(previousPath) as file:
+        previous = json.load(file)["runs"]
+    previousByKey = {_RunKey(run): run for run in previous}
+    lines = []
+    for run in runs:
+        old = previousByKey.get(_RunKey(run))
+        if old is None:
+            continue
+        if "program" in run:
+            if "importTime" in old and "importTime" in run:
+                lines.append("%s: %.3f -> %.3f s imports (%+.1f%%)" % (run["program"], old["importTime"],
+                                                                     run["importTime"],
+                                                                     100 * (run["importTime"] / old["importTime"] - 1)))
+            elif "importTime" in run:
+                lines.append("%s: failed -> %.3f s imports" % (run["program"], run["importTime"]))
+        elif old["fps"] > 0:
+            lines.append("%s: %.2f -> %.2f frames/s (%+.1f%%)" % (_RunLabel(run), old["fps"], run["fps"],
+                                                                 100 * (run["fps"] / old["fps"] - 1)))
+    return lines
+
+
+# Peak resident memory of this process in megabytes, or None where it cannot be measured.
+def PeakRSS():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if platform.system() == "Darwin" else peak / 2 ** 10
+
+
+# Synthetic microscopy-like frames: smoothed noise, so that the auto-contrast and resizing work as on real images.
+def SyntheticImages(count, size, seed=0):
+    import scipy.ndimage as ndimage
+
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        image = ndimage.gaussian_filter(rng.random([size, size], dtype=np.float32), size / 64)
+        image = 255 * (image - image.min()) / (image.max() - image.min())
+        images.append(image.astype(np.uint8))
+    return images
+
+
+def _RunInNewProcess(function, run):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, run).result()
+
+
+def _ParseImportTimes(output):
+    # (module, self time, cumulative time, nesting depth) of each import, from python -X importtime output (times in
+    # microseconds, converted to seconds).
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        selfTime, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(selfTime) / 1e6, int(cumulative) / 1e6, depth))
+    return imports
+
+
+def _LoadBenchmarkImages(source, size, count):
+    # count frames from the source, repeated if it has fewer
+    if source == "synthetic":
+        return SyntheticImages(count, size or 1024)
+    from backend.ImageManager import LoadImages
+
+    frames = [frame for image in LoadImages(Path(source), size=[size, size] if size else None, mode="L")
+              for frame in image.frames]
+    return [frames[i % len(frames)] for i in range(count)]
+
+
+def _BenchmarkDetectorRun(run):
+    # Runs in a fresh process. Times repeats passes over the frames (after one pass that is not timed) and returns
+    # the statistics.
+    from backend.Detector import Detector
+
+    images = _LoadBenchmarkImages(run["images"], run["size"], run["frames"])
+    detector = Detector(Path(run["model"]), run["batchSize"], run["threads"], run["tileOverlap"])
+    if run["mode"] == "detect":
+        calls = [lambda image=image: detector.Detect(image) for image in images]
+    elif run["mode"] == "multiple":
+        prepared = [detector.Prepare(image) for image in images]
+        calls = [lambda start=start: detector.DetectMultiple(prepared[start:start + run["batchSize"]])
+                 for start in range(0, len(prepared), run["batchSize"])]
+    else:
+        calls = [lambda start=start: detector.DetectBatch(images[start:start + run["batchSize"]])
+                 for start in range(0, len(images), run["batchSize"])]
+
+    for call in calls:
+        call()
+    detector.timings = {}
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(run["repeats"]):
+        for call in calls:
+            callStart = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - callStart)
+    total = time.perf_counter() - start
+    return {"p50": float(np.percentile(latencies, 50)), "p95": float(np.percentile(latencies, 95)),
+            "fps": run["frames"] * run["repeats"] / total, "peakRSS": PeakRSS(), "timings": detector.timings}
+
+
+def _BenchmarkTrackingRun(run):
+    # Runs in a fresh process. The scene is generated before timing, so only tracking is timed.
+    from backend.SyntheticScenes import SyntheticScene, ScoreTracking, SaveScene
+    from backend.Tracker import Tracker
+
+    scene = SyntheticScene(run["organoids"], run["frames"], run["imageSize"], **{
+        name: run[name] for name in ["radius", "growth", "drift", "jitter", "mergeRate", "splitRate", "disappearRate",
+                                     "seed"] if name in run})
+    if run["savePath"] is not None:
+        SaveScene(scene, Path(run["savePath"]))
+    images, truths = zip(*scene.Frames())
+
+    tracker = Tracker()
+    labelMaps = []
+    times = []
+    for image in images:
+        start = time.perf_counter()
+        labelMaps.append(tracker.Track(image))
+        times.append(time.perf_counter() - start)
+    return dict({"mean": float(np.mean(times)), "p50": float(np.percentile(times, 50)),
+                 "p95": float(np.percentile(times, 95)), "fps": len(times) / sum(times), "peakRSS": PeakRSS(),
+                 "events": {name: int(count) for name, count in scene.events.items()}}, **ScoreTracking(truths, labelMaps))
@@ -1,48 +1,182 @@
-import keras.saving.saved_model.model_serialization
 from tflite_runtime.interpreter import Interpreter
+from backend.Parallel import WorkerPool, CPUCount
+from backend.ResultCache import ResultCache
+from collections import deque
+import itertools
 
 from pathlib import Path
 from PIL import Image
 import numpy as np
-import skimage.color as colors
+import time
 import typing
 
 
 class Detector:
-    def __init__(self, modelPath: Path):
-        self._interpreter = Interpreter(model_path=str(modelPath.absolute()))
+    # tileOverlap: if set, images are not shrunk to the network size. Instead, the network is run over overlapping
+    # network-sized tiles at native resolution (overlapping by tileOverlap pixels) that are blended back together.
+    # cache: an optional ResultCache. Frames whose detection image is in the cache are not run through the network.
+    # Time spent preparing network inputs, running the network and restoring its outputs to image size is accumulated
+    # in timings ("prepare", "invoke" and "restore").
+    def __init__(self, modelPath: Path, batchSize=1, numThreads=None, tileOverlap=None, cache: ResultCache = None):
+        self._interpreter = Interpreter(model_path=str(modelPath.absolute()), num_threads=numThreads)
         self._inputIndex = self._interpreter.get_input_details()[0]['index']
         self._inputShape = self._interpreter.get_input_details()[0]['shape']
         self._output_index = self._interpreter.get_output_details()[0]['index']
+
+        # The input tensor is sized for a fixed number of frames once, up front. Every invocation reuses the same
+        # batch buffer, and partial batches are padded with blank frames.
+        self._batchSize = batchSize
+        batchShape = np.array(self._inputShape)
+        batchShape[0] = batchSize
+        if batchSize != self._inputShape[0]:
+            self._interpreter.resize_tensor_input(self._inputIndex, batchShape, strict=True)
         self._interpreter.allocate_tensors()
+        self._batch = np.zeros(batchShape, dtype=np.float32)
+
+        self._tileOverlap = tileOverlap
+        self._tileWeights = None
+        if tileOverlap is not None:
+            self._tileWeights = self.BuildTileWeights(self._inputShape[1:3], tileOverlap)
+
+        self._cache = cache
+        if cache is not None:
+            self._cacheParameters = CacheParameters(modelPath, tileOverlap)
+
+        self.timings = {}
+        self._stageStart = 0
 
     def Detect(self, image: np.ndarray) -> np.ndarray:
-        inSize = reversed(image.shape[:2])
-        image = np.asarray(Image.fromarray(image).resize([512, 512]))
+        return self.DetectBatch([image])[0]
+
+    def DetectBatch(self, images: typing.List[np.ndarray]) -> typing.List[np.ndarray]:
+        # Detect organoids in a list of frames, packing as many frames as possible into each invocation.
+        if self._cache is not None:
+            keys, results = LookUpDetections(self._cache, self._cacheParameters, images)
+            misses = [image for image, result in zip(images, results) if result is None]
+            return StoreDetections(self._cache, keys, results, self._DetectUncached(misses))
+        return self._DetectUncached(images)
+
+    def _DetectUncached(self, images: typing.List[np.ndarray]) -> typing.List[np.ndarray]:
+        if self._tileOverlap is not None:
+            return [self.DetectTiled(image) for image in images]
+        outputs = []
+        for start in range(0, len(images), self._batchSize):
+            batchImages = images[start:start + self._batchSize]
+            self._StartStage()
+            for i, image in enumerate(batchImages):
+                self._batch[i, :, :, 0] = self.Prepare(image)
+            self._EndStage("prepare")
+            output = self._Invoke(len(batchImages))
+            outputs += [self.Restore(output[i], image.shape[:2]) for i, image in enumerate(batchImages)]
+            self._EndStage("restore")
+        return outputs
+
+    def DetectStream(self, batches: typing.Iterable[typing.List[np.ndarray]]):
+        # Lazily detect organoids in a sequence of frame lists, yielding the results for each list in order.
+        for batch in batches:
+            yield self.DetectBatch(batch)
+
+    def DetectTiled(self, image: np.ndarray) -> np.ndarray:
+        # Auto-contrast is applied over the whole image so that every tile sees the same intensity scale.
+        self._StartStage()
+        tileSize = self._inputShape[1:3]
+        image = image.astype(np.float32)
         image = 255 * ((image - image.min()) / (image.max() - image.min()))
-        image = np.reshape(image, self._inputShape).astype(np.float32)
-        self._interpreter.set_tensor(self._inputIndex, image)
-        self._interpreter.invoke()
-        output = self._interpreter.get_tensor(self._output_index)[0, :, :, 0]
-        output = np.asarray(Image.fromarray(output).resize(inSize))
-        return output
+
+        # Images smaller than a tile are mirrored out to the tile size.
+        size = image.shape[:2]
+        padding = [(0, max(0, tileSize[i] - size[i])) for i in range(2)]
+        image = np.pad(image, padding, mode="symmetric")
+
+        # Only the blended output is kept at full size. Tiles are copied into the batch buffer as they are needed, so
+        # memory use beyond the image itself does not grow with the image size.
+        detected = np.zeros(image.shape, dtype=np.float32)
+        weights = np.zeros(image.shape, dtype=np.float32)
+        origins = self.TileOrigins(image.shape, tileSize, self._tileOverlap)
+        for start in range(0, len(origins), self._batchSize):
+            batchOrigins = origins[start:start + self._batchSize]
+            for i, (y, x) in enumerate(batchOrigins):
+                self._batch[i, :, :, 0] = image[y:y + tileSize[0], x:x + tileSize[1]]
+            self._EndStage("prepare")
+            output = self._Invoke(len(batchOrigins))
+            for i, (y, x) in enumerate(batchOrigins):
+                detected[y:y + tileSize[0], x:x + tileSize[1]] += output[i] * self._tileWeights
+                weights[y:y + tileSize[0], x:x + tileSize[1]] += self._tileWeights
+            self._EndStage("restore")
+        detected /= weights
+        self._EndStage("restore")
+        return detected[:size[0], :size[1]]
+
+    @staticmethod
+    def TileOrigins(imageShape, tileSize, overlap):
+        # Top-left corners of tiles that cover the image, with neighbours overlapping by at least the given amount.
+        # The last tile in each direction is aligned to the image edge.
+        axes = []
+        for length, tile in zip(imageShape[:2], tileSize):
+            stride = max(1, tile - overlap)
+            positions = list(range(0, max(1, length - tile + 1), stride))
+            if positions[-1] != length - tile:
+                positions.append(length - tile)
+            axes.append(positions)
+        return [(y, x) for y in axes[0] for x in axes[1]]
+
+    @staticmethod
+    def BuildTileWeights(tileSize, overlap):
+        # Blending weights fall off linearly over the overlap region towards each tile edge, so that predictions
+        # near a tile border (where the network lacks context) count for less than those from a neighbouring tile.
+        ramps = []
+        for tile in tileSize:
+            distance = np.minimum(np.arange(tile), np.arange(tile)[::-1]) + 1
+            ramps.append(np.minimum(1, distance / (overlap + 1)).astype(np.float32))
+        return np.outer(ramps[0], ramps[1])
+
+    def Prepare(self, image: np.ndarray) -> np.ndarray:
+        # Resize to the network input size and auto-contrast.
+        image = np.asarray(Image.fromarray(image).resize([self._inputShape[2], self._inputShape[1]]))
+        return 255 * ((image - image.min()) / (image.max() - image.min()))
+
+    @staticmethod
+    def Restore(output: np.ndarray, size) -> np.ndarray:
+        # Scale a network output back up to the size (rows, columns) of the original image.
+        return np.asarray(Image.fromarray(output).resize([size[1], size[0]]))
 
     def Contrast(self, i):
         return 255 * (i - i.min()) / (i.max()-i.min())
 
     def DetectMultiple(self, images: typing.List[np.ndarray]) -> np.ndarray:
-        stackedImages = np.expand_dims(np.stack(images), axis=-1).astype(np.float32)
-        batchShape = self._inputShape
-        batchShape[0] = len(images)
-        self._interpreter.resize_tensor_input(self._inputIndex, batchShape, True)
-        self._interpreter.allocate_tensors()
-        self._interpreter.set_tensor(self._inputIndex, stackedImages)
+        # Run already-prepared network-sized images through the network, one full batch at a time.
+        outputs = []
+        for start in range(0, len(images), self._batchSize):
+            batchImages = images[start:start + self._batchSize]
+            self._StartStage()
+            self._batch[:len(batchImages), :, :, 0] = np.stack(batchImages)
+            self._EndStage("prepare")
+            outputs.append(self._Invoke(len(batchImages)))
+        return np.concatenate(outputs)
+
+    def _Invoke(self, count) -> np.ndarray:
+        # Pad out the unused part of the batch and run the network on it. Starts the next stage's timing.
+        self._StartStage()
+        self._batch[count:] = 0
+        self._interpreter.set_tensor(self._inputIndex, self._batch)
         self._interpreter.invoke()
-        output = self._interpreter.get_tensor(self._output_index)
-        return output[:, :, :, 0]
+        output = self._interpreter.get_tensor(self._output_index)[:count, :, :, 0]
+        self._EndStage("invoke")
+        return output
+
+    def _StartStage(self):
+        self._stageStart = time.perf_counter()
+
+    def _EndStage(self, stage):
+        # Adds the time since the last stage ended (or started) to the given stage.
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0) + now - self._stageStart
+        self._stageStart = now
 
     @staticmethod
     def ConvertToHeatmap(detected: np.ndarray) -> np.ndarray:
+        import skimage.color as colors
+
         minimum = detected.min()
         maximum = detected.max()
         hue = 44.8 / 360
@@ -52,3 +186,99 @@ class Detector:
         concat = np.stack([h, s, v], -1)
         converted = colors.hsv2rgb(concat)
         return (converted * 255).astype(np.uint8)
+
+
+# Everything other than the frame that a detection image depends on, for ResultCache keys.
+def CacheParameters(modelPath: Path, tileOverlap):
+    return [ResultCache.FileDigest(modelPath), tileOverlap]
+
+
+def LookUpDetections(cache: ResultCache, parameters, images: typing.List[np.ndarray]):
+    # Returns the cache key of each frame and its cached detection image (None for misses).
+    keys = [cache.Key("detect", image, parameters) for image in images]
+    results = []
+    for key in keys:
+        cached = cache.Get(key)
+        results.append(cached["detected"] if cached is not None else None)
+    return keys, results
+
+
+def StoreDetections(cache: ResultCache, keys, results, detected: typing.List[np.ndarray]):
+    # Fills in the misses of LookUpDetections with the newly detected images (in order), and caches them.
+    detected = iter(detected)
+    for i, key in enumerate(keys):
+        if results[i] is None:
+            results[i] = next(detected)
+            cache.Put(key, detected=results[i])
+    return results
+
+
+# Each DetectorPool worker process loads its own copy of the model exactly once.
+_workerDetector: Detector = None
+
+
+def _InitializeWorker(modelPath: Path, batchSize, numThreads, tileOverlap):
+    global _workerDetector
+    _workerDetector = Detector(modelPath, batchSize, numThreads, tileOverlap)
+
+
+def _DetectInWorker(images: typing.List[np.ndarray]):
+    # Returns the detection images and the time spent in each stage for this batch.
+    before = dict(_workerDetector.timings)
+    detected = _workerDetector.DetectBatch(images)
+    timings = {stage: seconds - before.get(stage, 0) for stage, seconds in _workerDetector.timings.items()}
+    return detected, timings
+
+
+# Spreads detection over several processes, each with its own interpreter. The cores of the machine are divided
+# between the workers so that the interpreters do not oversubscribe the CPU.
+# With a cache, frames are looked up before they are handed to the workers, and only misses are sent.
+# Time spent in each stage by all workers together is accumulated in timings, as for Detector.
+class DetectorPool:
+    def __init__(self, modelPath: Path, workers, batchSize=1, tileOverlap=None, cache: ResultCache = None):
+        numThreads = max(1, CPUCount() // max(1, workers))
+        self._batchSize = batchSize
+        self._cache = cache
+        if cache is not None:
+            self._cacheParameters = CacheParameters(modelPath, tileOverlap)
+
+        self.timings = {}
+        self._pool = WorkerPool(workers, _InitializeWorker, (modelPath, batchSize, numThreads, tileOverlap))
+
+    def DetectBatch(self, images: typing.List[np.ndarray]) -> typing.List[np.ndarray]:
+        batches = (images[start:start + self._batchSize] for start in range(0, len(images), self._batchSize))
+        return list(itertools.chain.from_iterable(self.DetectStream(batches)))
+
+    def DetectStream(self, batches: typing.Iterable[typing.List[np.ndarray]]):
+        # Batches are handed out to whichever worker is free; results come back in input order.
+        if self._cache is None:
+            return self._DetectStreamUncached(batches)
+        return self._DetectStreamCached(batches)
+
+    def _DetectStreamUncached(self, batches: typing.Iterable[typing.List[np.ndarray]]):
+        for detected, timings in self._pool.Map(_DetectInWorker, batches):
+            self._AddTimings(timings)
+            yield detected
+
+    def _DetectStreamCached(self, batches: typing.Iterable[typing.List[np.ndarray]]):
+        lookups = deque()
+
+        def Misses():
+            for batch in batches:
+                keys, results = LookUpDetections(self._cache, self._cacheParameters, batch)
+                lookups.append((keys, results))
+                yield [image for image, result in zip(batch, results) if result is None]
+
+        for detected, timings in self._pool.Map(_DetectInWorker, Misses()):
+            self._AddTimings(timings)
+            keys, results = lookups.popleft()
+            yield StoreDetections(self._cache, keys, results, detected)
+
+    def _AddTimings(self, timings):
+        for stage, seconds in timings.items():
+            self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+    def Close(self):
+        self._pool.Close()
+
+    ConvertToHeatmap = staticmethod(Detector.ConvertToHeatmap)
@@ -3,18 +3,23 @@
 # manipulation and display
 
 import pathlib
-from typing import Union, List, Callable
-from PIL import Image, ImageFont, ImageDraw
+from typing import Union, List, Callable, TYPE_CHECKING
+from PIL import Image
 from pathlib import Path
+from collections import OrderedDict
+import threading
 import numpy as np
 import sys
 import re
-from skimage.color import label2rgb
-from skimage.filters import sobel
-from skimage.measure import regionprops
-from backend.Tracker import Tracker
+import struct
+import zlib
 from util import Printer
 
+# skimage, the Tracker and PIL's drawing and font support are only imported by the functions that use them, so that
+# loading and saving images starts quickly.
+if TYPE_CHECKING:
+    from backend.Tracker import Tracker
+
 
 # A SmartImage maintains knowledge about the path that an image was loaded from (and groups stacks together)
 class SmartImage:
@@ -23,27 +28,186 @@ class SmartImage:
         self.frames = frames
         self.originalSize = originalSize
 
-    def DoOperation(self, operation: Callable[[np.ndarray], np.ndarray], verboseLabel):
+    # With a pool (backend.Parallel.WorkerPool), frames are processed by its workers, and the operation must be
+    # picklable (a module-level function or a functools.partial of one).
+    def DoOperation(self, operation: Callable[[np.ndarray], np.ndarray], verboseLabel, pool=None):
         images = []
-        for i, frame in enumerate(self.frames):
+        results = pool.Map(operation, self.frames) if pool is not None else map(operation, self.frames)
+        for i, result in enumerate(results):
             Printer.printRep("%s: %d/%d" % (verboseLabel, i + 1, len(self.frames)))
-            images.append(operation(frame))
+            images.append(result)
+        Printer.printRep()
+        return SmartImage(self.path, images, self.originalSize)
+
+    # Resizes every frame to size (width, height), as LoadImages does.
+    def Resize(self, size):
+        return SmartImage(self.path, [np.asarray(Image.fromarray(frame).resize(size)) for frame in self.frames],
+                          self.originalSize)
+
+    # Same as DoOperation, but the operation maps a list of up to batchSize frames to a list of results.
+    def DoBatchOperation(self, operation: Callable[[List[np.ndarray]], List[np.ndarray]], batchSize, verboseLabel):
+        images = []
+        for start in range(0, len(self.frames), batchSize):
+            end = min(start + batchSize, len(self.frames))
+            Printer.printRep("%s: %d-%d/%d" % (verboseLabel, start + 1, end, len(self.frames)))
+            images += operation([self.frames[i] for i in range(start, end)])
         Printer.printRep()
         return SmartImage(self.path, images, self.originalSize)
 
 
+# An indexable sequence of the frames in an image file (e.g. a TIFF stack). Frames are only decoded when they are
+# accessed, so stacks do not have to fit in memory. Frames of uncompressed TIFFs that need no conversion are read
+# straight from a read-only memory map of the file. Other frames are decoded on access, and the most recently used
+# cacheSize decoded frames are kept. The file is only opened when a frame is accessed, and is closed again once too
+# many other FrameSources have opened theirs (see _OpenFile), so that loading a large directory does not hold a file
+# handle per image.
+class FrameSource:
+    # Raw TIFF pixel layouts that can be viewed directly as numpy arrays.
+    _memoryMappableModes = {"L": np.uint8, "I;16": np.dtype("<u2"), "I;32S": np.dtype("<i4"),
+                            "F;32F": np.dtype("<f4")}
+
+    def __init__(self, path: Path, size=None, mode=None, cacheSize=0):
+        self.path = path
+        self._size = size
+        self._mode = mode
+        self._cacheSize = cacheSize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        with Image.open(path) as rawImage:
+            self._count = getattr(rawImage, "n_frames", 1)
+            self.originalSize = rawImage.size
+        self._file = None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("frame index out of range")
+
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+
+            self._file = _OpenFile.Acquire(self._file, self.path, self._lock)
+            self._file.image.seek(index)
+            frame = self._MapFrame()
+            if frame is not None:
+                return frame
+
+            frame = PrepareFrame(self._file.image, self._size, self._mode)
+            if self._cacheSize > 0:
+                self._cache[index] = frame
+                if len(self._cache) > self._cacheSize:
+                    self._cache.popitem(last=False)
+            return frame
+
+    def _MapFrame(self):
+        # Returns a memory-mapped view of the current frame, or None if it has to be decoded.
+        rawImage = self._file.image
+        if rawImage.format != "TIFF" or self._size is not None or \
+                (self._mode is not None and self._mode != rawImage.mode) or len(rawImage.tile) != 1:
+            return None
+        tile = rawImage.tile[0]
+        rawMode, stride, orientation = tile[3][:3] if len(tile[3]) >= 3 else (None, None, None)
+        width, height = rawImage.size
+        if tile[0] != "raw" or rawMode not in self._memoryMappableModes or orientation != 1 or \
+                tuple(tile[1]) != (0, 0, width, height):
+            return None
+        dtype = np.dtype(self._memoryMappableModes[rawMode])
+        if stride not in (0, width * dtype.itemsize):
+            return None
+
+        # Frames returned earlier keep the memory map (and its file handle) alive only as long as they are in use.
+        if self._file.fileMap is None:
+            self._file.fileMap = np.memmap(self.path, dtype=np.uint8, mode="r")
+        offset = tile[2]
+        frameBytes = self._file.fileMap[offset:offset + width * height * dtype.itemsize]
+        return np.asarray(frameBytes).view(dtype).reshape([height, width])
+
+
+# An image file opened by a FrameSource, with its memory map once one is needed. At most maxOpen files are open at
+# once: opening another closes the least recently used one that is not being read at the time.
+class _OpenFile:
+    maxOpen = 16
+    _open = OrderedDict()
+    _openLock = threading.Lock()
+
+    def __init__(self, path: Path, lock: threading.Lock):
+        self.image = Image.open(path)
+        self.fileMap = None
+        self._lock = lock
+
+    # Returns file if it is still open (marking it as recently used), or else opens the file anew. lock is the
+    # caller's lock, which it holds while it reads from the file.
+    @classmethod
+    def Acquire(cls, file, path: Path, lock: threading.Lock):
+        with cls._openLock:
+            if file is not None and file.image is not None:
+                cls._open.move_to_end(file)
+                return file
+            file = cls(path, lock)
+            cls._open[file] = None
+            for other in list(cls._open):
+                if len(cls._open) <= cls.maxOpen:
+                    break
+                # Files that are being read are skipped rather than waited for, so that two readers cannot deadlock.
+                if other is not file and other._lock.acquire(blocking=False):
+                    try:
+                        other._Close()
+                    finally:
+                        other._lock.release()
+                    del cls._open[other]
+            return file
+
+    def _Close(self):
+        self.image.close()
+        self.image = None
+        self.fileMap = None
+
+
+# Converts a single loaded PIL frame to a numpy array, with optional mode conversion and resizing.
+def PrepareFrame(rawImage: Image.Image, size=None, mode=None) -> np.ndarray:
+    preparedImage = rawImage
+    if mode is not None:
+        if preparedImage.mode[0] == 'I' and mode == "L":
+            # Intensity images (i.e. 16-bit or 32-bit floating-point) should be divided by 255 to convert to
+            # 8-bit.
+            preparedImage = preparedImage.convert(mode="I")
+            preparedImage = preparedImage.point(lambda x: x * (1 / 255))
+
+        if preparedImage.mode != mode:
+            # Convert to expected mode
+            preparedImage = preparedImage.convert(mode=mode)
+
+    if size is not None:
+        # Resize image
+        preparedImage = preparedImage.resize(size)
+    return np.asarray(preparedImage)
+
+
 # Lazy load of images from a string or Path-like object of a directory, file, or stack.
 # size: A tuple (width, height) -- resize loaded images to this size
 # mode: the image mode to convert all loaded images into (from PIL library, e.g. "L", "1", "RGB")
-def LoadImages(source: Union[Path, str, List], size=None, mode=None) -> List[SmartImage]:
+# cacheSize: number of decoded frames to keep per image (see FrameSource)
+def LoadImages(source: Union[Path, str, List], size=None, mode=None, cacheSize=0) -> List[SmartImage]:
     if isinstance(source, list):
         # Iterate through path lists
         for i in source:
-            for image in LoadImages(i, size, mode):
+            for image in LoadImages(i, size, mode, cacheSize):
                 yield image
     elif isinstance(source, str):
         # Convert strings to Path-like
-        for image in LoadImages(Path(source), size, mode):
+        for image in LoadImages(Path(source), size, mode, cacheSize):
             yield image
     elif isinstance(source, Path):
         if source.is_dir():
@@ -51,7 +215,7 @@ def LoadImages(source: Union[Path, str, List], size=None, mode=None) -> List[Sma
             source = [path for path in source.iterdir() if path.is_file()]
             # Sort alphabetically and respect numbering (important for image tracking)
             sort_paths_nicely(source)
-            for image in LoadImages(source, size, mode):
+            for image in LoadImages(source, size, mode, cacheSize):
                 yield image
         else:
             if not source.is_file():
@@ -60,42 +224,17 @@ def LoadImages(source: Union[Path, str, List], size=None, mode=None) -> List[Sma
                 directory = source.parent
                 source = [path for path in directory.glob(regex) if path.is_file()]
                 sort_paths_nicely(source)
-                for image in LoadImages(source, size, mode):
+                for image in LoadImages(source, size, mode, cacheSize):
                     yield image
                 return
 
             try:
-                rawImage = Image.open(source)
+                frames = FrameSource(source, size, mode, cacheSize)
             except Exception as e:
                 print("Could not load. Error " + str(e), file=sys.stderr)
                 return
-            numFrames = getattr(rawImage, "n_frames", 1)
-            preparedImages = []
-            # Load image, which possibly has multiple frames (e.g. TIFF stack)
-            originalSize = None
-            for frame_number in range(numFrames):
-                rawImage.seek(frame_number)
-
-                preparedImage = rawImage
-                originalSize = preparedImage.size
-
-                if mode is not None:
-                    if preparedImage.mode[0] == 'I' and mode == "L":
-                        # Intensity images (i.e. 16-bit or 32-bit floating-point) should be divided by 255 to convert to
-                        # 8-bit.
-                        preparedImage = preparedImage.convert(mode="I")
-                        preparedImage = preparedImage.point(lambda x: x * (1 / 255))
-
-                    if preparedImage.mode != mode:
-                        # Convert to expected mode
-                        preparedImage = preparedImage.convert(mode=mode)
-
-                if size is not None:
-                    # Resize image
-                    preparedImage = preparedImage.resize(size)
-                preparedImages.append(np.asarray(preparedImage))
-
-            yield SmartImage(source, preparedImages, originalSize)
+
+            yield SmartImage(source, frames, frames.originalSize)
     else:
         raise TypeError("source must be a list, string, or Path-like. Not " + str(type(source)))
 
@@ -110,16 +249,18 @@ def ShowImage(frame: np.ndarray, size=None):
 
 # Saves a list of images as a GIF.
 def SaveGIF(images: List[np.ndarray], path: Path):
-    path.parent.mkdir(parents=True, exist_ok=True)
-    Image.fromarray(images[0]).save(path, save_all=True, append_images=[Image.fromarray(im) for im in images[1:]],
-                                    loop=0)
+    writer = GIFWriter(path)
+    for image in images:
+        writer.Append(image)
+    writer.Close()
 
 
 # Saves a list of images as a TIFF stack)
-def SaveTIFFStack(images: List[np.ndarray], path: Path):
-    path.parent.mkdir(parents=True, exist_ok=True)
-    Image.fromarray(images[0]).save(path, save_all=True, append_images=[Image.fromarray(im) for im in images[1:]],
-                                    compression=None)
+def SaveTIFFStack(images: List[np.ndarray], path: Path, bigTIFF=False, compression=None):
+    writer = TIFFWriter(path, bigTIFF, compression)
+    for image in images:
+        writer.Append(image)
+    writer.Close()
 
 
 # Save a single image
@@ -128,9 +269,195 @@ def SaveImage(image: np.ndarray, path: Path):
     Image.fromarray(image).save(path)
 
 
+# Writes frames to a multi-page TIFF file one at a time, so only the frame being written is held in memory. Frames may
+# be boolean, 8/16/32-bit integer (signed 8-bit saved as 16-bit), floating-point (saved as 32-bit), or 8-bit RGB(A).
+# Uncompressed frames are stored as a single strip, which LoadImages can memory-map.
+# bigTIFF: use 64-bit offsets, for files larger than 4 GB.
+# compression: None or "deflate". Compressed frames are stored in strips of rowsPerStrip rows.
+class TIFFWriter:
+    _compressions = {None: 1, "deflate": 8}
+    _sampleFormats = {"b": 1, "u": 1, "i": 2, "f": 3}
+
+    def __init__(self, path: Path, bigTIFF=False, compression=None, rowsPerStrip=64):
+        if compression not in self._compressions:
+            raise ValueError("Unsupported TIFF compression: " + str(compression))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.frameCount = 0
+        self._bigTIFF = bigTIFF
+        self._compression = compression
+        self._rowsPerStrip = rowsPerStrip
+        self._file = open(path, "wb")
+        if bigTIFF:
+            self._offsetFormat, self._offsetType = "Q", 16
+            self._file.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+            self._nextIFDPointer = 8
+        else:
+            self._offsetFormat, self._offsetType = "I", 4
+            self._file.write(b"II" + struct.pack("<HI", 42, 0))
+            self._nextIFDPointer = 4
+
+    def Append(self, frame: np.ndarray):
+        frame = self._PrepareFrame(np.asarray(frame))
+        height, width = frame.shape[:2]
+        samples = frame.shape[2] if frame.ndim == 3 else 1
+
+        # Image data
+        if frame.dtype == bool:
+            rows = np.packbits(frame, axis=1)
+            bitsPerSample = 1
+        else:
+            rows = frame.reshape([height, -1]).view(np.uint8)
+            bitsPerSample = frame.dtype.itemsize * 8
+        rowsPerStrip = height if self._compression is None else min(self._rowsPerStrip, height)
+        stripOffsets = []
+        stripByteCounts = []
+        self._file.seek(0, 2)
+        for start in range(0, height, rowsPerStrip):
+            data = rows[start:start + rowsPerStrip].tobytes()
+            if self._compression == "deflate":
+                data = zlib.compress(data)
+            stripOffsets.append(self._CheckOffset(self._file.tell()))
+            stripByteCounts.append(len(data))
+            self._file.write(data)
+
+        # Image file directory. Values that do not fit into their entry are written just before it.
+        entries = [(256, 4, [width]), (257, 4, [height]), (258, 3, [bitsPerSample] * samples),
+                   (259, 3, [self._compressions[self._compression]]), (262, 3, [2 if samples >= 3 else 1]),
+                   (273, self._offsetType, stripOffsets), (277, 3, [samples]), (278, 4, [rowsPerStrip]),
+                   (279, self._offsetType, stripByteCounts), (284, 3, [1])]
+        if samples == 4:
+            entries.append((338, 3, [2]))
+        entries.append((339, 3, [self._sampleFormats[frame.dtype.kind]] * samples))
+
+        inlineSize = 8 if self._bigTIFF else 4
+        packedEntries = []
+        for tag, valueType, values in entries:
+            valueFormat = {3: "H", 4: "I", 16: "Q"}[valueType]
+            data = struct.pack("<%d%s" % (len(values), valueFormat), *values)
+            if len(data) > inlineSize:
+                self._Align()
+                offset = self._CheckOffset(self._file.tell())
+                self._file.write(data)
+                data = struct.pack("<" + self._offsetFormat, offset)
+            packedEntries.append(struct.pack("<HH" + self._offsetFormat, tag, valueType, len(values)) +
+                                 data.ljust(inlineSize, b"\0"))
+
+        self._Align()
+        ifdOffset = self._CheckOffset(self._file.tell())
+        self._file.write(struct.pack("<" + ("Q" if self._bigTIFF else "H"), len(packedEntries)))
+        self._file.write(b"".join(packedEntries))
+        nextIFDPointer = self._file.tell()
+        self._file.write(struct.pack("<" + self._offsetFormat, 0))
+
+        # Link the directory to the previous one
+        self._file.seek(self._nextIFDPointer)
+        self._file.write(struct.pack("<" + self._offsetFormat, ifdOffset))
+        self._nextIFDPointer = nextIFDPointer
+        self.frameCount += 1
+
+    def Close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    @staticmethod
+    def _PrepareFrame(frame: np.ndarray):
+        # Converts to a little-endian type that TIFF readers support (as PIL would save it).
+        if frame.dtype == np.float64:
+            frame = frame.astype(np.float32)
+        elif frame.dtype.kind in "iu" and frame.dtype.itemsize == 8:
+            if frame.size and (frame.min() < np.iinfo(np.int32).min or frame.max() > np.iinfo(np.int32).max):
+                raise ValueError("64-bit integer frames must fit in 32 bits to be saved as TIFF")
+            frame = frame.astype(np.int32)
+        elif frame.dtype == np.int8:
+            # Readers (PIL among them) take 8-bit samples as unsigned, whatever their sample format.
+            frame = frame.astype(np.int16)
+        elif frame.dtype.kind not in "biuf":
+            raise ValueError("Cannot save frames of type %s as TIFF" % frame.dtype)
+        if frame.ndim == 3 and (frame.dtype != np.uint8 or frame.shape[2] not in (3, 4)):
+            raise ValueError("Multi-channel frames must be 8-bit RGB or RGBA")
+        return np.ascontiguousarray(frame, dtype=frame.dtype.newbyteorder("<"))
+
+    def _Align(self):
+        if self._file.tell() % 2:
+            self._file.write(b"\0")
+
+    def _CheckOffset(self, offset):
+        if not self._bigTIFF and offset >= 2 ** 32:
+            raise ValueError("TIFF file is larger than 4 GB. Save it as a BigTIFF instead.")
+        return offset
+
+
+# Writes frames to an animated GIF one at a time. Each frame is quantized to its own palette, as PIL does when saving
+# all frames at once.
+class GIFWriter:
+    def __init__(self, path: Path, duration=None, loop=0):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.frameCount = 0
+        self._duration = duration
+        self._loop = loop
+        self._file = open(path, "wb")
+
+    def Append(self, frame: np.ndarray):
+        from PIL import GifImagePlugin
+
+        image = Image.fromarray(frame)
+        if image.mode in ("RGB", "RGBA"):
+            image = image.convert("P", palette=Image.Palette.ADAPTIVE)
+        elif image.mode not in ("1", "L", "P"):
+            image = image.convert("L")
+
+        if self.frameCount == 0:
+            header, _ = GifImagePlugin.getheader(image.copy(), info={"loop": self._loop})
+            self._file.write(b"".join(header))
+        parameters = {"include_color_table": True}
+        if self._duration is not None:
+            parameters["duration"] = self._duration
+        self._file.write(b"".join(GifImagePlugin.getdata(image, **parameters)))
+        self.frameCount += 1
+
+    def Close(self):
+        self._file.write(b";")
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+# Writes the frames of one output image as they are produced: to a TIFF stack if there are several, or to a regular
+# image file if there is only one.
+class ImageWriter:
+    def __init__(self, path: Path, frameCount, bigTIFF=False, compression=None):
+        self.path = path
+        self._stack = TIFFWriter(path, bigTIFF, compression) if frameCount > 1 else None
+
+    def Append(self, frame: np.ndarray):
+        if self._stack is not None:
+            self._stack.Append(frame)
+        else:
+            SaveImage(frame, self.path)
+
+    def Close(self):
+        if self._stack is not None:
+            self._stack.Close()
+
+
 # Convert a numberically labeled image to a randomly-colored RGB image (with optional drawing of label number on
 # each island.
 def LabelToRGB(image: np.ndarray, textSize):
+    from skimage.color import label2rgb
+    from skimage.measure import regionprops
+    from PIL import ImageFont, ImageDraw
+
     # Scikit-image RGB is 0-1. Convert to 8-bit RGB.
     colors = [(255, 198, 30),
               (175, 88, 186),
@@ -154,49 +481,145 @@ def LabelToRGB(image: np.ndarray, textSize):
     return labeled
 
 
-# Overlay a set of organoid tracks on a list of base images.
-def LabelTracks(tracks: List[Tracker.OrganoidTrack], labelColor, outlineAlpha, fillAlpha, mainColor, specialColorMap,
+# Overlay a set of organoid tracks on a list of base images. Tracks are drawn in list order: each track's fill, then its
+# outline, so later tracks cover earlier ones. The overlay is built with array operations on an image of track numbers
+# per frame; only the text labels are drawn with PIL.
+def LabelTracks(tracks: List["Tracker.OrganoidTrack"], labelColor, outlineAlpha, fillAlpha, mainColor, specialColorMap,
                 baseImages):
-    images = []
-
-    font = ImageFont.truetype("arial.ttf", 26)
-
-    for frame, baseImage in enumerate(baseImages):
-        # Find the tracks that are at the given frame number
-        tracksAtFrame = [track for track in tracks if track.WasDetected(frame)]
-
-        pilImage = Image.new(mode="RGBA", size=baseImage.shape, color=(0, 0, 0, 0))
-        drawer = ImageDraw.Draw(pilImage)
-
-        # Draw each present track on the frame
-        for track in tracksAtFrame:
-            data = track.Data(frame)
-            fillCoords = list(zip(list(data.GetRP().coords[:, 1]), list(data.GetRP().coords[:, 0])))
+    return list(LabelTracksStream(tracks, labelColor, outlineAlpha, fillAlpha, mainColor, specialColorMap, baseImages))
 
-            if track.id in specialColorMap:
-                color = specialColorMap[track.id]
-            else:
-                color = mainColor
 
-            drawer.point(fillCoords, color + (fillAlpha,))
-            borderCoords = ComputeOutline(data.GetRP().image)
-            globalCoords = borderCoords + data.GetRP().bbox[:2]
-            xs = list(globalCoords[:, 1])
-            ys = list(globalCoords[:, 0])
-            outlineCoords = list(zip(xs, ys))
-            drawer.point(outlineCoords, color + (outlineAlpha,))
+# Same as LabelTracks, but yields each overlaid frame as soon as it is drawn. baseImages may be any iterable of frames,
+# the first of which is tracker frame firstFrame.
+def LabelTracksStream(tracks: List["Tracker.OrganoidTrack"], labelColor, outlineAlpha, fillAlpha, mainColor,
+                      specialColorMap, baseImages, firstFrame=0):
+    from PIL import ImageFont, ImageDraw
 
-            y, x = list(data.GetRP().centroid)
-            drawer.text((x, y), str(track.id), anchor="ms", fill=labelColor, font=font)
+    font = ImageFont.truetype("arial.ttf", 26)
 
-        baseImage = Image.fromarray(baseImage).convert(mode="RGBA")
-        pilImage = Image.alpha_composite(baseImage, pilImage).convert(mode="RGB")
-        images.append(np.asarray(pilImage))
-    return images
+    # Colors of each track (track number 0 is the transparent background)
+    colors = [specialColorMap[track.id] if track.id in specialColorMap else mainColor for track in tracks]
+    fillColors = np.array([(0, 0, 0, 0)] + [color + (fillAlpha,) for color in colors], dtype=np.uint8)
+    outlineColors = np.array([(0, 0, 0, 0)] + [color + (outlineAlpha,) for color in colors], dtype=np.uint8)
+
+    # Tracks are found in each frame through their stores, rather than by asking every track.
+    stores = {}
+    for number, track in enumerate(tracks, start=1):
+        store, numbers = stores.setdefault(id(track.GetStore()), (track.GetStore(), {}))
+        numbers[track.id] = number
+
+    for frame, baseImage in enumerate(baseImages, start=firstFrame):
+        height, width = baseImage.shape[:2]
+        trackImage = np.zeros([height, width], dtype=np.int64)
+        centroids = []
+        bboxes = np.zeros([len(tracks) + 1, 4], dtype=np.int64)
+        for store, numbers in stores.values():
+            rows = [row for row in store.RowsAtFrame(frame) if store.track[row] in numbers]
+            if not rows:
+                continue
+            trackNumbers = np.array([numbers[store.track[row]] for row in rows])
+            _PaintInOrder(trackImage, store.Pixels(rows), np.repeat(trackNumbers, store.area[rows]))
+            bboxes[trackNumbers] = store.bbox[rows]
+            centroids += zip(trackNumbers.tolist(), store.centroid[rows].tolist())
+
+        # Outlines are drawn after fills, so where a track's outline is on top of a fill, it wins unless the fill is
+        # from a later track.
+        outlineImage = ComputeTrackOutlines(trackImage, bboxes)
+        useOutline = (outlineImage != 0) & (outlineImage >= trackImage)
+        overlay = fillColors[trackImage]
+        overlay[useOutline] = outlineColors[outlineImage[useOutline]]
+
+        # Track numbers are drawn in track order, each after its own track's fill and outline, so a later track's
+        # fill or outline hides an earlier track's number. Where it does, the pixels from before the number was drawn
+        # are put back.
+        topNumbers = np.where(useOutline, outlineImage, trackImage)
+        pilImage = Image.fromarray(overlay, mode="RGBA")
+        drawer = ImageDraw.Draw(pilImage)
+        for number, (y, x) in sorted(centroids):
+            text = str(tracks[number - 1].id)
+            left, top, right, bottom = drawer.textbbox((x, y), text, anchor="ms", font=font)
+            box = (max(0, int(left) - 1), max(0, int(top) - 1),
+                   min(width, int(right) + 2), min(height, int(bottom) + 2))
+            hidden = topNumbers[box[1]:box[3], box[0]:box[2]] > number
+            before = np.array(pilImage.crop(box)) if box[0] < box[2] and box[1] < box[3] and hidden.any() else None
+            drawer.text((x, y), text, anchor="ms", fill=labelColor, font=font)
+            if before is not None:
+                after = np.array(pilImage.crop(box))
+                after[hidden] = before[hidden]
+                pilImage.paste(Image.fromarray(after, mode="RGBA"), box[:2])
+        overlay = np.asarray(pilImage)
+
+        if baseImage.dtype == np.uint8 and baseImage.ndim == 2:
+            baseImage = np.repeat(baseImage[:, :, None], 3, axis=2)
+        else:
+            baseImage = np.asarray(Image.fromarray(baseImage).convert(mode="RGB"))
+        yield AlphaComposite(baseImage, overlay)
+
+
+def _PaintInOrder(image: np.ndarray, coords: np.ndarray, values: np.ndarray):
+    # Sets image pixels to values, where the last value wins for pixels that appear more than once.
+    flat = coords[:, 0] * image.shape[1] + coords[:, 1]
+    order = np.argsort(flat, kind="stable")
+    flat, values = flat[order], values[order]
+    last = np.append(flat[1:] != flat[:-1], True)
+    image.ravel()[flat[last]] = values[last]
+
+
+# Finds the outline of every labeled region in an image, as ComputeOutline does for each region's bounding-box image.
+# Returns an image with the highest label whose outline includes each pixel (0 for none). bboxes gives the bounding box
+# (min row, min column, max row, max column) of each label; outlines are cut off at the bounding box.
+def ComputeTrackOutlines(labeled: np.ndarray, bboxes: np.ndarray):
+    height, width = labeled.shape
+    padded = np.pad(labeled, 1)
+
+    # Only pixels with a non-uniform 3x3 neighbourhood can be on an outline.
+    offsets = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+    neighbours = [padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width] for dy, dx in offsets]
+    uniform = np.ones([height, width], dtype=bool)
+    for neighbour in neighbours:
+        uniform &= neighbour == labeled
+    rows, columns = np.nonzero(~uniform)
+    neighbourLabels = np.stack([neighbour[rows, columns] for neighbour in neighbours])
+
+    # The Sobel magnitude of a binary image is above 0.5 exactly when the integer kernel sums satisfy
+    # horizontal^2 + vertical^2 > 8. Each label in the neighbourhood is a candidate.
+    verticalWeights = np.array([dy * (2 - abs(dx)) for dy, dx in offsets])[:, None]
+    horizontalWeights = np.array([dx * (2 - abs(dy)) for dy, dx in offsets])[:, None]
+    outline = np.zeros([height, width], dtype=labeled.dtype)
+    for k, candidate in enumerate(neighbourLabels):
+        # Each distinct label around a pixel only has to be tested once.
+        new = candidate != 0
+        for previous in neighbourLabels[:k]:
+            new &= previous != candidate
+        indices = np.flatnonzero(new)
+        candidate = candidate[indices]
+        isCandidate = neighbourLabels[:, indices] == candidate
+        vertical = (verticalWeights * isCandidate).sum(axis=0)
+        horizontal = (horizontalWeights * isCandidate).sum(axis=0)
+        minRow, minColumn, maxRow, maxColumn = bboxes[candidate].T
+        candidateRows, candidateColumns = rows[indices], columns[indices]
+        onOutline = (vertical ** 2 + horizontal ** 2 > 8) & (candidateRows >= minRow) & (candidateRows < maxRow) & \
+                    (candidateColumns >= minColumn) & (candidateColumns < maxColumn)
+        candidateRows, candidateColumns = candidateRows[onOutline], candidateColumns[onOutline]
+        outline[candidateRows, candidateColumns] = np.maximum(outline[candidateRows, candidateColumns],
+                                                              candidate[onOutline])
+    return outline
+
+
+# Composites an RGBA overlay onto an opaque RGB image, with the same integer arithmetic as PIL's alpha_composite.
+def AlphaComposite(baseImage: np.ndarray, overlay: np.ndarray):
+    composite = baseImage.copy()
+    visible = overlay[:, :, 3] != 0
+    alpha = overlay[visible][:, 3:].astype(np.uint32)
+    blended = overlay[visible][:, :3] * (alpha << 7) + baseImage[visible] * ((255 - alpha) << 7) + (0x80 << 7)
+    composite[visible] = (((blended >> 8) + blended) >> 8) >> 7
+    return composite
 
 
 def ComputeOutline(image: np.ndarray):
     # Finds the outline of an image.
+    from skimage.filters import sobel
+
     edge = sobel(image, mode="constant")
     coords = np.argwhere(np.greater(edge, 0.5))
     return coords
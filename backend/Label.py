@@ -5,68 +5,352 @@ import skimage.morphology as morphology
 import numpy as np
 import skimage.feature
 import skimage.filters
+import skimage.util
 import scipy.ndimage as ndimage
+import time
+from backend.ResultCache import ResultCache
 
 
-def Label(image: np.ndarray, minimumArea: float, removeBorders: bool):
-    # Consider organoids to be present at pixels with greater than 50% detection belief.
-    foregroundMask = ndimage.binary_opening(image >= 0.5)
+# Labels organoids in detection images. Intermediate results that several steps need (the foreground mask and the
+# smoothed images) are computed once per frame, in float32, into workspaces that are reused for all frames of the same
+# size. The edge map is kept as a by-product (lastEdges). Time spent in each stage is accumulated in timings. A Labeler
+# must not be used from several threads at once.
+# cache: an optional ResultCache. Label looks frames up in it (lastCacheHit tells whether the last frame was found)
+# and stores the label image and edge map of frames that were not.
+class Labeler:
+    def __init__(self, minimumArea: float = 100, removeBorders: bool = False, threshold=0.5, edgeLow=0.005,
+                 edgeHigh=0.05, cache: ResultCache = None):
+        self.minimumArea = minimumArea
+        self.removeBorders = removeBorders
+        self.threshold = threshold
+        self.edgeLow = edgeLow
+        self.edgeHigh = edgeHigh
+        self.lastEdges = None
+        self.cache = cache
+        self.lastCacheHit = None
+        self.timings = {}
+        self.frameCount = 0
+        self._workspaces = {}
+        self._stageStart = 0
 
-    # Watershed algorithm is used to distinguish organoids in contact. The algorithm needs a heightmap and a set of
-    # initializer points (basins) for each organoid. The negated detection image is used as the heightmap for watershed
-    # (i.e. the organoid centers, which are the strongest predictions, should be at the lowest points in the heightmap).
-    smoothForeground = skimage.filters.gaussian(image, 2)
-    heightmap = -smoothForeground
+    def Label(self, image: np.ndarray):
+        self.frameCount += 1
+        if self.cache is not None:
+            self._StartStage()
+            key = self.cache.Key("label", image, [self.minimumArea, self.removeBorders, self.threshold, self.edgeLow,
+                                                  self.edgeHigh])
+            cached = self.cache.Get(key)
+            self.lastCacheHit = cached is not None
+            self._EndStage("cache")
+            if cached is not None:
+                self.lastEdges = cached["edges"]
+                return cached["labeled"]
 
-    # Basins are found by removing the organoid borders.
-    edges = DetectEdges(image)
-    centers = np.bitwise_and(foregroundMask, np.bitwise_not(edges))
-    basins, _ = ndimage.label(centers)
-    labeled = segmentation.watershed(heightmap, basins, mask=foregroundMask)
+        heightmap, smoothEdges = self.Smooth(image)
+        labeled = self.Segment(image, heightmap, smoothEdges, self.threshold, self.edgeLow, self.edgeHigh)
+        labeled = self.Clean(labeled, self.minimumArea, self.removeBorders)
+        if self.cache is not None:
+            self._StartStage()
+            self.cache.Put(key, labeled=labeled, edges=self.lastEdges)
+            self._EndStage("cache")
+        return labeled
 
-    # Some small organoids will be lost during the watershed if their edges were relatively too thick
-    # to find their centers. Watershed should only really split organoids that are touching, so we want to make sure
-    # that organoids in the original mask are preserved.
+    def Smooth(self, image: np.ndarray):
+        # Computes the intermediates that do not depend on any threshold: the watershed heightmap and the smoothed
+        # edge magnitude. These are workspaces, so they are overwritten by the next call.
+        self._StartStage()
 
-    # First, find all regions that were lost.
-    unsplit = np.logical_and(foregroundMask, labeled == 0)
-    # Label the lost regions
-    unsplit_labeled, _ = ndimage.label(unsplit)
-    # Make the label numbers for lost regions different from the watershed labels.
-    unsplit_labeled[unsplit_labeled > 0] += labeled.max() + 1
-    # Merge lost regions with the watershed labels.
-    labeled = labeled + unsplit_labeled
+        # Watershed algorithm is used to distinguish organoids in contact. The algorithm needs a heightmap and a set
+        # of initializer points (basins) for each organoid. The negated detection image is used as the heightmap for
+        # watershed (i.e. the organoid centers, which are the strongest predictions, should be at the lowest points in
+        # the heightmap).
+        floatImage = skimage.util.img_as_float32(image)
+        heightmap = self._Gaussian(floatImage, "heightmap")
+        np.negative(heightmap, out=heightmap)
 
-    # Fill holes in labeled organoids
-    labeled = FillHoles(labeled)
+        # Reordered Canny edge detector (Sobel -> Gaussian -> Hysteresis threshold)
+        smoothEdges = self._Gaussian(self._Sobel(floatImage), "smoothEdges")
+        self._EndStage("smoothing")
+        return heightmap, smoothEdges
 
-    # Remove small organoids
-    labeled = morphology.remove_small_objects(labeled, minimumArea)
+    def Segment(self, image: np.ndarray, heightmap, smoothEdges, threshold, edgeLow, edgeHigh, foregroundMask=None):
+        # Splits the foreground into organoids, given the intermediates from Smooth. Holes are filled, but small and
+        # border organoids are not removed yet (see Clean).
+        self._StartStage()
 
-    if removeBorders:
-        labeled = segmentation.clear_border(labeled)
+        # Consider organoids to be present at pixels with greater than 50% detection belief.
+        if foregroundMask is None:
+            foregroundMask = self.Foreground(image, threshold)
+        self._EndStage("foreground")
 
-    return labeled
+        # Basins are found by removing the organoid borders.
+        edges = self.Edges(smoothEdges, foregroundMask, edgeLow, edgeHigh)
+        self.lastEdges = edges
+        self._EndStage("edges")
 
+        centers = np.bitwise_and(foregroundMask, np.bitwise_not(edges))
+        basins, _ = ndimage.label(centers)
+        labeled = segmentation.watershed(heightmap, basins, mask=foregroundMask)
 
-def DetectEdges(image: np.ndarray):
-    # Reordered Canny edge detector (Sobel -> Gaussian -> Hysteresis threshold)
-    smoothEdges = skimage.filters.gaussian(skimage.filters.sobel(image), 2)
-    edges = skimage.filters.apply_hysteresis_threshold(smoothEdges, 0.005, 0.05)
+        # Some small organoids will be lost during the watershed if their edges were relatively too thick
+        # to find their centers. Watershed should only really split organoids that are touching, so we want to make
+        # sure that organoids in the original mask are preserved.
+
+        # First, find all regions that were lost.
+        unsplit = np.logical_and(foregroundMask, labeled == 0)
+        # Label the lost regions
+        unsplit_labeled, _ = ndimage.label(unsplit)
+        # Make the label numbers for lost regions different from the watershed labels.
+        unsplit_labeled[unsplit_labeled > 0] += labeled.max() + 1
+        # Merge lost regions with the watershed labels.
+        labeled = labeled + unsplit_labeled
+        self._EndStage("watershed")
+
+        # Fill holes in labeled organoids
+        labeled = FillHoles(labeled)
+        self._EndStage("fill holes")
+        return labeled
+
+    def Clean(self, labeled: np.ndarray, minimumArea, removeBorders):
+        # Removes small organoids (and, optionally, organoids touching the border) from a segmented image. The input
+        # is not modified.
+        self._StartStage()
+        labeled = morphology.remove_small_objects(labeled, minimumArea)
+
+        if removeBorders:
+            labeled = segmentation.clear_border(labeled)
+        self._EndStage("cleanup")
+        return labeled
+
+    @staticmethod
+    def Foreground(image: np.ndarray, threshold):
+        return ndimage.binary_opening(image >= threshold)
+
+    @staticmethod
+    def Edges(smoothEdges: np.ndarray, foregroundMask: np.ndarray, edgeLow, edgeHigh):
+        edges = skimage.filters.apply_hysteresis_threshold(smoothEdges, edgeLow, edgeHigh)
+        return np.bitwise_and(edges, foregroundMask, out=edges)
+
+    def DetectEdges(self, image: np.ndarray):
+        _, smoothEdges = self.Smooth(image)
+        return self.Edges(smoothEdges, self.Foreground(image, self.threshold), self.edgeLow, self.edgeHigh)
+
+    def TimingReport(self):
+        return TimingReport(self.timings, self.frameCount)
+
+    def _Gaussian(self, image: np.ndarray, name):
+        # Same as skimage.filters.gaussian(image, 2) for float32 images.
+        return ndimage.gaussian_filter(image, 2, mode="nearest", truncate=4.0,
+                                       output=self._Workspace(name, image.shape))
+
+    def _Sobel(self, image: np.ndarray):
+        # Same as skimage.filters.sobel(image) for float32 images: the root mean square of the two directional
+        # derivatives.
+        magnitude = self._Workspace("sobel", image.shape)
+        derivative = self._Workspace("derivative", image.shape)
+        magnitude.fill(0)
+        for kernel in _sobelKernels:
+            ndimage.convolve(image, kernel, output=derivative, mode="reflect")
+            derivative *= derivative
+            magnitude += derivative
+        np.sqrt(magnitude, out=magnitude)
+        magnitude /= np.sqrt(2, dtype=np.float32)
+        return magnitude
+
+    def _Workspace(self, name, shape):
+        workspace = self._workspaces.get(name)
+        if workspace is None or workspace.shape != shape:
+            workspace = np.empty(shape, dtype=np.float32)
+            self._workspaces[name] = workspace
+        return workspace
+
+    def _StartStage(self):
+        self._stageStart = time.perf_counter()
+
+    def _EndStage(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0) + now - self._stageStart
+        self._stageStart = now
+
+
+# Sobel derivative kernels along each image axis.
+_sobelKernels = [np.outer([1, 0, -1], [1, 2, 1]) / 4, np.outer([1, 2, 1], [1, 0, -1]) / 4]
+
+
+# Labels frames with every combination of a grid of labeling parameters. The threshold-independent smoothing is
+# computed once per frame, the foreground mask once per threshold, and minimum-area filtering is applied to the same
+# segmentation for all minimum areas. Results summarize the organoid counts and areas for each combination, and, if
+# ground-truth segmentations are given, how well the labeling matches them.
+class LabelSweep:
+    def __init__(self, thresholds=(0.5,), edgeLows=(0.005,), edgeHighs=(0.05,), minimumAreas=(100,),
+                 removeBorders=False):
+        self.removeBorders = removeBorders
+        self.parameters = [(threshold, edgeLow, edgeHigh, minimumArea)
+                           for threshold in thresholds
+                           for edgeLow in edgeLows
+                           for edgeHigh in edgeHighs if edgeLow <= edgeHigh
+                           for minimumArea in minimumAreas]
+        self.labeler = Labeler()
+        self.frameCount = 0
+        self._areas = {parameters: [] for parameters in self.parameters}
+        self._scores = {parameters: np.zeros(5, dtype=np.int64) for parameters in self.parameters}
+        self._hasTruth = False
+
+    # Labels a frame with all parameter combinations. truth is an optional ground-truth segmentation (labeled or
+    # binary) of the frame.
+    def AddFrame(self, image: np.ndarray, truth: np.ndarray = None):
+        self.AddFrameResults(self.SweepFrame(image, truth))
+
+    # Labels a frame with all parameter combinations without adding it to the results. Returns, for each combination,
+    # the organoid areas and (with a truth) the ScoreSegmentation scores, for AddFrameResults. Frames can be swept in
+    # several processes (see SweepInWorker) and their results added in one.
+    def SweepFrame(self, image: np.ndarray, truth: np.ndarray = None):
+        self.labeler.frameCount += 1
+        if truth is not None:
+            if len(np.unique(truth)) <= 2:
+                # Binary masks are split into organoids by connectivity.
+                truth = ndimage.label(truth)[0]
+            truth = _Sequential(truth)
+
+        heightmap, smoothEdges = self.labeler.Smooth(image)
+        foregroundMasks = {}
+        segmentedParameters, segmented = None, None
+        results = {}
+        for parameters in self.parameters:
+            threshold, edgeLow, edgeHigh, minimumArea = parameters
+            if threshold not in foregroundMasks:
+                foregroundMasks[threshold] = Labeler.Foreground(image, threshold)
+            if parameters[:3] != segmentedParameters:
+                # Combinations are ordered so that all minimum areas of a segmentation come together.
+                segmentedParameters = parameters[:3]
+                segmented = self.labeler.Segment(image, heightmap, smoothEdges, threshold, edgeLow, edgeHigh,
+                                                 foregroundMasks[threshold])
+            labeled = self.labeler.Clean(segmented, minimumArea, self.removeBorders)
+
+            areas = np.bincount(labeled.ravel())[1:]
+            results[parameters] = (areas[areas > 0], ScoreSegmentation(labeled, truth) if truth is not None else None)
+        return results
+
+    def AddFrameResults(self, results):
+        self.frameCount += 1
+        for parameters, (areas, scores) in results.items():
+            self._areas[parameters].append(areas)
+            if scores is not None:
+                self._hasTruth = True
+                self._scores[parameters] += scores
+
+    # One dictionary per parameter combination, with the parameters and the summary of the results.
+    def Results(self):
+        results = []
+        for parameters in self.parameters:
+            threshold, edgeLow, edgeHigh, minimumArea = parameters
+            areas = np.concatenate(self._areas[parameters]) if self._areas[parameters] else np.zeros(0)
+            result = {"threshold": threshold, "edgeLow": edgeLow, "edgeHigh": edgeHigh, "minimumArea": minimumArea,
+                      "frames": self.frameCount, "count": len(areas),
+                      "meanArea": areas.mean() if len(areas) else np.nan,
+                      "medianArea": np.median(areas) if len(areas) else np.nan,
+                      "stdArea": areas.std() if len(areas) else np.nan,
+                      "minArea": areas.min() if len(areas) else np.nan,
+                      "maxArea": areas.max() if len(areas) else np.nan,
+                      "iou": np.nan, "f1": np.nan, "truthCount": np.nan}
+            if self._hasTruth:
+                intersection, union, matched, predicted, actual = self._scores[parameters]
+                result["iou"] = intersection / union if union else np.nan
+                result["f1"] = 2 * matched / (predicted + actual) if predicted + actual else np.nan
+                result["truthCount"] = actual
+            results.append(result)
+        return results
 
-    foregroundMask = ndimage.binary_opening(image >= 0.5)
-    edges = np.bitwise_and(edges, foregroundMask)
-    return edges
+
+# Compares a labeled image to a ground-truth labeled image. Returns the foreground intersection and union, the number
+# of organoids matched to a ground-truth organoid with an intersection over union above 0.5 (such matches are unique),
+# and the numbers of labeled and ground-truth organoids.
+def ScoreSegmentation(labeled: np.ndarray, truth: np.ndarray):
+    labeled = _Sequential(labeled)
+    truth = _Sequential(truth)
+    labelCount = labeled.max() + 1
+    truthCount = truth.max() + 1
+    overlaps = np.bincount((labeled * truthCount + truth).ravel(),
+                           minlength=labelCount * truthCount).reshape([labelCount, truthCount])
+    labeledAreas = overlaps.sum(axis=1)
+    truthAreas = overlaps.sum(axis=0)
+    iou = overlaps[1:, 1:] / (labeledAreas[1:, None] + truthAreas[None, 1:] - overlaps[1:, 1:])
+
+    intersection = overlaps[1:, 1:].sum()
+    union = intersection + overlaps[1:, 0].sum() + overlaps[0, 1:].sum()
+    return np.array([intersection, union, np.count_nonzero(iou > 0.5), labelCount - 1, truthCount - 1])
+
+
+def _Sequential(labeled: np.ndarray):
+    # Renumbers the labels of an image to 1...N, keeping 0 as the background.
+    present = np.bincount(labeled.ravel()) > 0
+    present[0] = True
+    if present.all():
+        return labeled
+    return (np.cumsum(present) - 1)[labeled]
+
+
+# Formats accumulated stage timings as a table.
+def TimingReport(timings: dict, frameCount):
+    total = sum(timings.values())
+    lines = ["%-12s %8.3f s (%5.1f%%)" % (stage, seconds, 100 * seconds / total if total else 0)
+             for stage, seconds in timings.items()]
+    lines.append("%-12s %8.3f s for %d frames" % ("total", total, frameCount))
+    return "\n".join(lines)
+
+
+# Labeling in a backend.Parallel.WorkerPool: each worker keeps its own Labeler (and workspaces).
+_workerLabeler = None
+
+
+def InitializeWorker(minimumArea, removeBorders, threshold=0.5, edgeLow=0.005, edgeHigh=0.05, cache=None):
+    global _workerLabeler
+    _workerLabeler = Labeler(minimumArea, removeBorders, threshold, edgeLow, edgeHigh, cache)
+
+
+def LabelInWorker(image: np.ndarray):
+    # Returns the labeled image, the edge map, the time spent in each stage for this frame, and whether it was found
+    # in the cache (None without a cache).
+    before = dict(_workerLabeler.timings)
+    labeled = _workerLabeler.Label(image)
+    timings = {stage: seconds - before.get(stage, 0) for stage, seconds in _workerLabeler.timings.items()}
+    return labeled, _workerLabeler.lastEdges, timings, _workerLabeler.lastCacheHit
+
+
+# Sweeping in a WorkerPool: each worker keeps its own LabelSweep, whose results stay empty.
+_workerSweep = None
+
+
+def InitializeSweepWorker(thresholds, edgeLows, edgeHighs, minimumAreas, removeBorders):
+    global _workerSweep
+    _workerSweep = LabelSweep(thresholds, edgeLows, edgeHighs, minimumAreas, removeBorders)
+
+
+def SweepInWorker(item):
+    # item is (frame, truth or None). Returns the LabelSweep.SweepFrame results and the time spent in each stage.
+    image, truth = item
+    before = dict(_workerSweep.labeler.timings)
+    results = _workerSweep.SweepFrame(image, truth)
+    timings = {stage: seconds - before.get(stage, 0) for stage, seconds in _workerSweep.labeler.timings.items()}
+    return results, timings
+
+
+def Label(image: np.ndarray, minimumArea: float, removeBorders: bool):
+    return Labeler(minimumArea, removeBorders).Label(image)
+
+
+def DetectEdges(image: np.ndarray):
+    return Labeler().DetectEdges(image)
 
 
 def FillHoles(image: np.ndarray):
+    # Holes of each label are filled in ascending label order, so higher labels win where filled regions overlap. A
+    # hole can not reach outside of the label's bounding box, so only the box is filled.
     filledImage = np.zeros_like(image)
-    labels = np.unique(image)
-    for label in labels:
-        if label == 0:
+    for label, box in enumerate(ndimage.find_objects(image), start=1):
+        if box is None:
             continue
-        subImage = np.where(image == label, True, False)
-        filled = ndimage.binary_fill_holes(subImage)
-        filledImage[filled] = label
+        filled = ndimage.binary_fill_holes(image[box] == label)
+        filledImage[box][filled] = label
 
     return filledImage
@@ -0,0 +1,211 @@
+# Measure.py -- measures morphological features of labeled regions, a whole frame at a time.
+
+from typing import List
+import numpy as np
+from scipy import ndimage
+from skimage.measure import regionprops, regionprops_table
+
+# Weights of the border pixel configurations in skimage's perimeter estimate (see skimage.measure.perimeter).
+_perimeterWeights = np.zeros(50)
+_perimeterWeights[[5, 7, 15, 17, 25, 27]] = 1
+_perimeterWeights[[21, 33]] = np.sqrt(2)
+_perimeterWeights[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+# Names of skimage regionprops properties, current and older (deprecated) ones. Any other feature is evaluated as an
+# expression.
+_regionProperties = {
+    "area", "area_bbox", "area_convex", "area_filled", "axis_major_length", "axis_minor_length", "bbox", "centroid",
+    "centroid_local", "centroid_weighted", "centroid_weighted_local", "coords", "eccentricity",
+    "equivalent_diameter_area", "euler_number", "extent", "feret_diameter_max", "image", "image_convex",
+    "image_filled", "image_intensity", "inertia_tensor", "inertia_tensor_eigvals", "intensity_max", "intensity_mean",
+    "intensity_min", "intensity_std", "label", "moments", "moments_central", "moments_hu", "moments_normalized",
+    "moments_weighted", "moments_weighted_central", "moments_weighted_hu", "moments_weighted_normalized",
+    "orientation", "perimeter", "perimeter_crofton", "slice", "solidity",
+    "bbox_area", "convex_area", "convex_image", "equivalent_diameter", "filled_area", "filled_image",
+    "intensity_image", "local_centroid", "major_axis_length", "max_intensity", "mean_intensity", "min_intensity",
+    "minor_axis_length", "std_intensity", "weighted_centroid", "weighted_local_centroid", "weighted_moments",
+    "weighted_moments_central", "weighted_moments_hu", "weighted_moments_normalized"}
+
+
+# Measures features of every labeled region in a frame. Features are names of skimage regionprops properties (or, as
+# for regionprops, any expression on a region "rp", e.g. "centroid[0]"). Returns the region labels and, for each
+# feature, a list with the value for each region.
+def MeasureFrame(frame: np.ndarray, features: List[str]):
+    measurements = FrameMeasurements(frame)
+    labels = measurements.labels
+
+    # Common shape features are computed for all regions at once. Other properties go through regionprops_table,
+    # and expressions are evaluated region by region.
+    properties = [feature for feature in features if IsProperty(feature) and feature not in FrameMeasurements.features]
+    expressions = [feature for feature in features if not IsProperty(feature)]
+    table = regionprops_table(frame, properties=properties) if properties else {}
+    regions = regionprops(frame) if len(labels) and (expressions or any(p not in table for p in properties)) else []
+
+    values = []
+    for feature in features:
+        if feature in FrameMeasurements.features:
+            values.append(measurements.Get(feature))
+        elif feature in properties:
+            values.append(_TableValues(table, feature, regions[0] if regions else None, len(labels)))
+        else:
+            values.append([eval("rp.%s" % feature, {}, {"rp": rp}) for rp in regions])
+    return labels, values
+
+
+# Whether a feature is a regionprops property (rather than an expression).
+def IsProperty(feature: str):
+    return feature in _regionProperties
+
+
+# Shape features of all regions of a labeled frame, computed from per-label sums over the whole image. Values have the
+# same types as the regionprops properties of the same name, and are equal up to floating-point rounding.
+class FrameMeasurements:
+    features = {"label", "area", "bbox", "area_bbox", "bbox_area", "centroid", "extent", "equivalent_diameter_area",
+                "equivalent_diameter", "perimeter", "inertia_tensor", "inertia_tensor_eigvals", "eccentricity",
+                "orientation", "axis_major_length", "major_axis_length", "axis_minor_length", "minor_axis_length"}
+    # Older skimage names of the same properties
+    _aliases = {"bbox_area": "area_bbox", "equivalent_diameter": "equivalent_diameter_area",
+                "major_axis_length": "axis_major_length", "minor_axis_length": "axis_minor_length"}
+
+    def __init__(self, frame: np.ndarray):
+        self.frame = frame
+        pixels = np.flatnonzero(frame)
+        pixelLabels = frame.ravel()[pixels]
+        self.labels = np.flatnonzero(np.bincount(pixelLabels, minlength=1)[1:]) + 1
+        self._labelToIndex = np.zeros(frame.max(initial=0) + 1, dtype=np.intp)
+        self._labelToIndex[self.labels] = np.arange(len(self.labels))
+        self._index = self._labelToIndex[pixelLabels]
+        self._rows, self._columns = np.divmod(pixels, frame.shape[1])
+        self._cache = {}
+
+    def Get(self, feature):
+        # Values of a feature for each region, in label order
+        feature = self._aliases.get(feature, feature)
+        if feature not in self._cache:
+            self._cache[feature] = getattr(self, "_" + feature)()
+        return self._cache[feature]
+
+    def _Sum(self, weights=None):
+        return np.bincount(self._index, weights, minlength=len(self.labels))
+
+    def _Moments(self):
+        # Central moments mu20, mu11 and mu02
+        if "moments" not in self._cache:
+            rowCentroids, columnCentroids = np.transpose(self._centroid()).reshape([2, -1])
+            rows = self._rows - rowCentroids[self._index]
+            columns = self._columns - columnCentroids[self._index]
+            self._cache["moments"] = self._Sum(rows * rows), self._Sum(rows * columns), self._Sum(columns * columns)
+        return self._cache["moments"]
+
+    def _Eigenvalues(self):
+        tensors = np.array(self.Get("inertia_tensor")).reshape([-1, 2, 2])
+        return np.clip(np.linalg.eigvalsh(tensors)[:, ::-1], 0, None)
+
+    def _label(self):
+        return self.labels.tolist()
+
+    def _area(self):
+        return self._Sum().astype(float).tolist()
+
+    def _bbox(self):
+        slices = [s for s in ndimage.find_objects(self.frame) if s is not None]
+        return [(rows.start, columns.start, rows.stop, columns.stop) for rows, columns in slices]
+
+    def _area_bbox(self):
+        return [float((maxRow - minRow) * (maxColumn - minColumn))
+                for minRow, minColumn, maxRow, maxColumn in self.Get("bbox")]
+
+    def _centroid(self):
+        area = self._Sum()
+        return list(zip((self._Sum(self._rows) / area).tolist(), (self._Sum(self._columns) / area).tolist()))
+
+    def _extent(self):
+        return (np.array(self.Get("area")) / np.array(self.Get("area_bbox"))).tolist()
+
+    def _equivalent_diameter_area(self):
+        return ((4 * np.array(self.Get("area")) / np.pi) ** (1 / 2)).tolist()
+
+    def _perimeter(self):
+        # Border pixels have a 4-neighbour outside their region. Each border pixel is classified by which of its
+        # neighbours are border pixels of the same region, as skimage does for each region image.
+        padded = np.pad(self.frame, 1)
+        height, width = self.frame.shape
+
+        def Neighbour(image, dy, dx):
+            return image[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+
+        border = self.frame != 0
+        interior = border.copy()
+        for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+            interior &= Neighbour(padded, dy, dx) == self.frame
+        border &= ~interior
+        paddedBorder = np.pad(border, 1)
+        configuration = border.astype(np.intp)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if dy or dx:
+                    weight = 10 if dy and dx else 2
+                    sameRegion = Neighbour(padded, dy, dx) == self.frame
+                    configuration += weight * (Neighbour(paddedBorder, dy, dx) & sameRegion)
+
+        borderIndex = self._labelToIndex[self.frame[border]]
+        histogram = np.bincount(borderIndex * 50 + configuration[border], minlength=len(self.labels) * 50)
+        return (histogram.reshape([-1, 50]) @ _perimeterWeights).tolist()
+
+    def _inertia_tensor(self):
+        mu20, mu11, mu02 = self._Moments()
+        area = self._Sum()
+        tensors = np.stack([mu02 / area, -mu11 / area, -mu11 / area, mu20 / area], axis=1).reshape([-1, 2, 2])
+        return list(tensors)
+
+    def _inertia_tensor_eigvals(self):
+        return self._Eigenvalues().tolist()
+
+    def _eccentricity(self):
+        eigenvalues = self._Eigenvalues()
+        major, minor = eigenvalues[:, 0], eigenvalues[:, 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(major == 0, 0, np.sqrt(1 - minor / major)).tolist()
+
+    def _orientation(self):
+        tensors = np.array(self.Get("inertia_tensor")).reshape([-1, 2, 2])
+        a, b, c = tensors[:, 0, 0], tensors[:, 0, 1], tensors[:, 1, 1]
+        return np.where(a - c == 0, np.where(b < 0, np.pi / 4, -np.pi / 4),
+                        0.5 * np.arctan2(-2 * b, c - a)).tolist()
+
+    def _axis_major_length(self):
+        return (4 * np.sqrt(self._Eigenvalues()[:, 0])).tolist()
+
+    def _axis_minor_length(self):
+        return (4 * np.sqrt(self._Eigenvalues()[:, 1])).tolist()
+
+
+def _TableValues(table: dict, feature: str, sampleRegion, count):
+    # regionprops_table splits multi-valued properties into one column per element ("centroid-0", "moments-1-2",
+    # ...). These are joined back together into values of the same type as the regionprops property.
+    if feature in table:
+        column = table[feature]
+        return column.tolist() if column.dtype != object else list(column)
+
+    columns = {tuple(int(i) for i in key[len(feature) + 1:].split("-")): table[key] for key in table
+               if key.startswith(feature + "-")}
+    if count == 0:
+        return []
+    shape = tuple(np.max(list(columns), axis=0) + 1)
+    stacked = np.zeros((count,) + shape, dtype=np.result_type(*columns.values()))
+    for index, column in columns.items():
+        stacked[(slice(None),) + index] = column
+
+    sample = getattr(sampleRegion, feature)
+    if isinstance(sample, tuple):
+        return [tuple(value) for value in stacked.tolist()]
+    if isinstance(sample, list):
+        return stacked.tolist()
+    return list(stacked)
+
+
+# Measures one frame in a worker. item is (name, frame, features); returns (name, labels, values).
+def MeasureItem(item):
+    name, frame, features = item
+    labels, values = MeasureFrame(frame, features)
+    return name, labels, values
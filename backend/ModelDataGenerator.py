@@ -2,7 +2,7 @@
 
 import tensorflow as tf
 import numpy as np
-from backend.ImageManager import LoadImages
+from backend.PackData import PrepareTrainingImage, PrepareTrainingSegmentation, LoadPackedData
 from pathlib import Path
 
 
@@ -14,6 +14,7 @@ class ModelDataGenerator(tf.keras.utils.Sequence):
         self.imagePaths = np.array([path for path in imagePaths.iterdir() if path.is_file()])
         self.segmentationPaths = np.array([path for path in segmentationPaths.iterdir() if path.is_file()])
 
+        # imageSize is (rows, columns), as for the network input.
         self.imageSize = imageSize
         self.on_epoch_end()
 
@@ -43,10 +44,7 @@ class ModelDataGenerator(tf.keras.utils.Sequence):
         imageData = np.zeros([len(imagePaths), self.imageSize[0], self.imageSize[1], 1], dtype=np.uint8)
 
         for imageIndex in range(len(imagePaths)):
-            image = next(LoadImages(imagePaths[imageIndex], mode="L")).Resize(self.imageSize).frames[0]
-            # Auto-contrast
-            image = 255 * ((image - image.min()) / (image.max() - image.min()))
-            imageData[imageIndex, :, :, 0] = image
+            imageData[imageIndex, :, :, 0] = PrepareTrainingImage(imagePaths[imageIndex], self.imageSize)
         return imageData
 
     def LoadSegmentations(self, segmentationPaths):
@@ -54,6 +52,49 @@ class ModelDataGenerator(tf.keras.utils.Sequence):
 
         for segmentationIndex in range(len(segmentationPaths)):
             segmentationData[segmentationIndex, :, :, 0] = \
-            next(LoadImages(segmentationPaths[segmentationIndex], mode="1")).Resize(self.imageSize).frames[0]
+                PrepareTrainingSegmentation(segmentationPaths[segmentationIndex], self.imageSize)
 
         return segmentationData
+
+
+# Serves batches from a dataset packed by backend.PackData. Each batch is a slice of consecutive pairs of the memory-
+# mapped file, so nothing is decoded and nothing is copied until TensorFlow reads the batch. The pairs were shuffled
+# when they were packed; after every epoch, the order of the batches is shuffled.
+class PackedDataGenerator(tf.keras.utils.Sequence):
+    def __init__(self, path: Path, batchSize, shuffle=True):
+        self.batchSize = batchSize
+        self.images, self.segmentations = LoadPackedData(path)
+        self.imageSize = self.images.shape[1:3]
+        self.shuffle = shuffle
+        self.batchOrder = np.arange(len(self))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.images) / self.batchSize))
+
+    def __getitem__(self, batchNumber):
+        batchStart = self.batchOrder[batchNumber] * self.batchSize
+        batchEnd = batchStart + self.batchSize
+        return self.images[batchStart:batchEnd], self.segmentations[batchStart:batchEnd]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.batchOrder = np.random.permutation(len(self))
+
+
+# Wraps a Sequence of (image, segmentation) batches (e.g. a ModelDataGenerator or PackedDataGenerator) and augments
+# every batch with a backend.Augment.Augmenter as it is served, so each epoch sees different random transformations.
+class AugmentedDataGenerator(tf.keras.utils.Sequence):
+    def __init__(self, data: tf.keras.utils.Sequence, augmenter):
+        self.data = data
+        self.augmenter = augmenter
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, batchNumber):
+        images, segmentations = self.data[batchNumber]
+        return self.augmenter.AugmentBatch(images, segmentations)
+
+    def on_epoch_end(self):
+        self.data.on_epoch_end()
@@ -0,0 +1,120 @@
+# ModelDataPipeline.py -- tf.data input pipeline for model training. Images are decoded, converted to grayscale,
+# resized and auto-contrasted inside the TensorFlow graph, on several threads at once, and batches are prefetched while
+# the model trains on the previous one.
+
+import tensorflow as tf
+import numpy as np
+import time
+from pathlib import Path
+from PIL import Image
+from backend.ImageManager import PrepareFrame, sort_paths_nicely
+
+# File types that TensorFlow can decode itself. Other files (e.g. TIFFs) are decoded with PIL, outside the graph.
+_graphDecodable = {".png", ".jpg", ".jpeg", ".gif", ".bmp"}
+
+
+# Builds a dataset of (image, segmentation) batches from a directory of images and a directory of segmentations, paired
+# in name order. Both are uint8 arrays of shape (batch, rows, columns, 1), as from ModelDataGenerator.
+# imageSize: (rows, columns) of the network input.
+# shuffle: reshuffle the examples every epoch.
+# cache: None, "memory", or a file path. Decoded examples are cached after the first epoch, so that later epochs skip
+#   decoding and resizing. With a cache, examples are shuffled from a buffer of shuffleBuffer decoded examples (default:
+#   all of them); without one, the file list is shuffled before decoding.
+# augmenter: a backend.Augment.Augmenter that transforms each batch (after the cache, so every epoch is augmented
+#   anew), or None.
+def BuildDataset(imagesPath: Path, segmentationsPath: Path, imageSize, batchSize, shuffle=True, cache=None,
+                 shuffleBuffer=None, augmenter=None) -> tf.data.Dataset:
+    imagePaths = _ListFiles(imagesPath)
+    segmentationPaths = _ListFiles(segmentationsPath)
+    if len(imagePaths) != len(segmentationPaths):
+        raise ValueError("Found %d images but %d segmentations" % (len(imagePaths), len(segmentationPaths)))
+    imageSize = tuple(imageSize)
+    imagesInGraph = _AllGraphDecodable(imagePaths)
+    segmentationsInGraph = _AllGraphDecodable(segmentationPaths)
+
+    def Load(imagePath, segmentationPath):
+        # Images are auto-contrasted after resizing. Segmentations are binarized before resizing, and resized with
+        # nearest-neighbour sampling so that they stay binary.
+        image = _Resize(_Decode(imagePath, imagesInGraph, "L"), imageSize, "bicubic")
+        image = tf.cast(image, tf.float32)
+        minimum, maximum = tf.reduce_min(image), tf.reduce_max(image)
+        image = tf.cast(255 * tf.math.divide_no_nan(image - minimum, maximum - minimum), tf.uint8)
+
+        segmentation = _Decode(segmentationPath, segmentationsInGraph, "1")
+        segmentation = _Resize(tf.cast(segmentation > 127, tf.uint8), imageSize, "nearest")
+        return image[:, :, None], segmentation[:, :, None]
+
+    dataset = tf.data.Dataset.from_tensor_slices(([str(path) for path in imagePaths],
+                                                  [str(path) for path in segmentationPaths]))
+    if shuffle and cache is None:
+        dataset = dataset.shuffle(len(imagePaths), reshuffle_each_iteration=True)
+    dataset = dataset.map(Load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    if cache is not None:
+        dataset = dataset.cache("" if cache == "memory" else str(cache))
+        if shuffle:
+            dataset = dataset.shuffle(shuffleBuffer or len(imagePaths), reshuffle_each_iteration=True)
+    dataset = dataset.batch(batchSize)
+    if augmenter is not None:
+        def Augment(images, segmentations):
+            images, segmentations = tf.numpy_function(augmenter.AugmentBatch, [images, segmentations],
+                                                      [tf.uint8, tf.uint8])
+            images.set_shape([None, imageSize[0], imageSize[1], 1])
+            segmentations.set_shape([None, imageSize[0], imageSize[1], 1])
+            return images, segmentations
+
+        dataset = dataset.map(Augment, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+# Measures how many batches per second a dataset or ModelDataGenerator can supply, over the given number of steps.
+# The first batch is not timed, so that one-time setup (e.g. opening files, tracing) is not counted.
+def BenchmarkInput(data, steps):
+    if isinstance(data, tf.data.Dataset):
+        batches = iter(data.repeat())
+    else:
+        batches = (data[i % len(data)] for i in range(steps + 1))
+    next(batches)
+    start = time.perf_counter()
+    for _ in range(steps):
+        next(batches)
+    return steps / (time.perf_counter() - start)
+
+
+def _ListFiles(path: Path):
+    paths = [file for file in path.iterdir() if file.is_file()]
+    sort_paths_nicely(paths)
+    return paths
+
+
+def _AllGraphDecodable(paths):
+    return all(path.suffix.lower() in _graphDecodable for path in paths)
+
+
+def _Decode(path, inGraph, mode):
+    # Decodes an image file to a grayscale uint8 tensor of shape (rows, columns).
+    if not inGraph:
+        def LoadWithPIL(pathBytes):
+            image = PrepareFrame(Image.open(pathBytes.decode()), mode=mode)
+            return image.astype(np.uint8) * (255 if mode == "1" else 1)
+
+        image = tf.numpy_function(LoadWithPIL, [path], tf.uint8)
+        image.set_shape([None, None])
+        return image
+
+    image = tf.io.decode_image(tf.io.read_file(path), expand_animations=False)
+    channels = tf.shape(image)[2]
+
+    def Luma():
+        # Same integer weights as PIL's conversion to mode "L" (the alpha channel is ignored)
+        rgb = tf.cast(image[:, :, :3], tf.int32)
+        luma = tf.bitwise.right_shift(rgb[:, :, 0] * 19595 + rgb[:, :, 1] * 38470 + rgb[:, :, 2] * 7471 + 0x8000, 16)
+        return tf.cast(luma, tf.uint8)
+
+    return tf.cond(channels >= 3, Luma, lambda: image[:, :, 0])
+
+
+def _Resize(image, size, method):
+    if method == "nearest":
+        return tf.image.resize(image[:, :, None], size, method="nearest")[:, :, 0]
+    resized = tf.image.resize(tf.cast(image[:, :, None], tf.float32), size, method=method, antialias=True)[:, :, 0]
+    return tf.cast(tf.clip_by_value(tf.round(resized), 0, 255), tf.uint8)
@@ -5,11 +5,47 @@ from tensorflow.keras.layers import Input, Conv2D, Dropout, MaxPooling2D, Conv2D
 from tensorflow.keras.models import Model
 from tensorflow.keras.callbacks import EarlyStopping, Callback
 from pathlib import Path
+from typing import Union
+import math
+import queue
+import shutil
+import threading
+import time
+import numpy as np
 from backend.ModelDataGenerator import ModelDataGenerator
 
 
+# Sets up TensorFlow for training on CPUs. Must be called before a ModelTrainer is created.
+# intraOpThreads: threads used within an operation (e.g. a convolution); interOpThreads: operations run at once.
+#   None leaves TensorFlow's default (one per core).
+# mixedPrecision: compute in bfloat16 (keeping float32 weights), if the CPU has bfloat16 instructions.
+# Returns whether mixed precision is used.
+def ConfigureCPUTraining(intraOpThreads=None, interOpThreads=None, mixedPrecision=False) -> bool:
+    if intraOpThreads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intraOpThreads)
+    if interOpThreads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(interOpThreads)
+    if mixedPrecision and not CPUSupportsBFloat16():
+        print("This CPU has no bfloat16 instructions, so training stays in float32.")
+        return False
+    if mixedPrecision:
+        tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+    return mixedPrecision
+
+
+def CPUSupportsBFloat16():
+    try:
+        with open("/proc/cpuinfo") as file:
+            flags = file.read().split()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
 class ModelTrainer:
-    def __init__(self, inputSize, dropoutRate, startSize):
+    # accumulationSteps: number of batches whose gradients are averaged for each weight update, to emulate a batch
+    # that many times larger.
+    def __init__(self, inputSize, dropoutRate, startSize, accumulationSteps=1):
         # First layer in the network is each pixel in the grayscale image
         inputs = Input((inputSize[0], inputSize[1], 1))
 
@@ -41,15 +77,20 @@ class ModelTrainer:
             currentLayer = Conv2D(size, (3, 3), activation='elu', kernel_initializer='he_normal', padding='same')(
                 currentLayer)
 
-        # Last layer is sigmoid to produce probability map.
-        final = Conv2D(1, (1, 1), activation='sigmoid')(currentLayer)
+        # Last layer is sigmoid to produce probability map. It is computed in float32 even with mixed precision, so that
+        # the loss is.
+        final = Conv2D(1, (1, 1), activation='sigmoid', dtype='float32')(currentLayer)
 
-        self._model = Model(inputs=[inputs], outputs=[final])
+        self._model = TrainingModel(inputs=[inputs], outputs=[final], accumulationSteps=accumulationSteps)
         self._model.summary()
 
-    def Train(self, learningRate, patience, epochs, trainingDataGenerator: ModelDataGenerator,
-              testingDataGenerator: ModelDataGenerator,
-              outputPath: Path = None):
+    # Training and validation data may each be a ModelDataGenerator or a dataset from ModelDataPipeline.BuildDataset.
+    # keepBest, keepEvery: which per-epoch checkpoints to keep (see ModelSavingCallback).
+    # variants: quantized TFLite variants to export along with the float model (see ModelVariants), calibrated and
+    #   evaluated on representativeCount validation images.
+    def Train(self, learningRate, patience, epochs, trainingDataGenerator: Union[ModelDataGenerator, tf.data.Dataset],
+              testingDataGenerator: Union[ModelDataGenerator, tf.data.Dataset],
+              outputPath: Path = None, keepBest=None, keepEvery=None, variants=None, representativeCount=100):
         # Adam optimizer is used for SGD. Binary cross-entropy for loss.
         self._model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learningRate),
                             loss=tf.keras.losses.binary_crossentropy)
@@ -59,7 +100,8 @@ class ModelTrainer:
         if outputPath is not None:
             subPath = outputPath / "epochs"
             subPath.mkdir(parents=True, exist_ok=True)
-            callbacks.append(ModelTrainer.ModelSavingCallback(subPath))
+            callbacks.append(ModelTrainer.ModelSavingCallback(subPath, keepBest, keepEvery))
+            callbacks.append(ModelTrainer.ThroughputCallback(subPath))
 
         self._model.fit(trainingDataGenerator,
                         validation_data=testingDataGenerator,
@@ -68,13 +110,55 @@ class ModelTrainer:
                         callbacks=callbacks)
 
         if outputPath is not None:
-            self.SaveLiteModel(outputPath / "model.tflite", self.ConvertToLiteModel(self._model))
-            self.SaveModel(outputPath / "fullModel", self._model)
+            model = self.Float32Copy(self._model)
+            self.SaveLiteModel(outputPath / "model.tflite", self.ConvertToLiteModel(model))
+            self.SaveModel(outputPath / "fullModel", model)
+            if variants:
+                from backend.ModelVariants import ExportVariants, RepresentativeImages
+                ExportVariants(model, outputPath, variants,
+                               RepresentativeImages(testingDataGenerator, representativeCount))
+
+    # Measures training steps per second with the given training data, over a number of steps. The first step is not
+    # timed, since it includes building the training function. The model is trained by these steps.
+    def BenchmarkTraining(self, learningRate, trainingData: Union[ModelDataGenerator, tf.data.Dataset], steps):
+        self._model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learningRate),
+                            loss=tf.keras.losses.binary_crossentropy)
+        if isinstance(trainingData, tf.data.Dataset):
+            trainingData = trainingData.repeat()
+        else:
+            steps = min(steps, len(trainingData) - 1)
+        self._model.fit(trainingData, steps_per_epoch=1, epochs=1, verbose=0)
+        start = time.perf_counter()
+        self._model.fit(trainingData, steps_per_epoch=steps, epochs=1, verbose=0)
+        return steps / (time.perf_counter() - start)
+
+    # A float32 copy of a model (trained with or without mixed precision) as a plain Keras model, for saving and
+    # conversion to TFLite.
+    @staticmethod
+    def Float32Copy(model: Model) -> Model:
+        def CloneLayer(layer):
+            config = layer.get_config()
+            config["dtype"] = "float32"
+            return layer.__class__.from_config(config)
+
+        copy = tf.keras.models.clone_model(model, clone_function=CloneLayer)
+        copy.set_weights(model.get_weights())
+        return copy
 
     # Use TFLite to minimize memory overhead for saved models and inference.
+    # quantization: None (float32), "dynamic" (int8 weights), "float16" (float16 weights) or "int8" (int8 weights and
+    #   activations, calibrated on representativeImages, a list of network-input-shaped float32 images). The inputs
+    #   and outputs of every variant stay float32, so that any of them can be used in place of the float model.
     @staticmethod
-    def ConvertToLiteModel(fullModel):
+    def ConvertToLiteModel(fullModel, quantization=None, representativeImages=None):
         converter = tf.lite.TFLiteConverter.from_keras_model(fullModel)
+        if quantization is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == "float16":
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantization == "int8":
+            converter.representative_dataset = lambda: ([image[None]] for image in representativeImages)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
         return converter.convert()
 
     @staticmethod
@@ -87,25 +171,213 @@ class ModelTrainer:
     def SaveModel(path: Path, fullModel: Model):
         fullModel.save(path)
 
-    # After every epoch, save the training and validation performance, as well as a copy of the model.
+    # After every epoch, save the training and validation performance, as well as a copy of the model. Only the
+    # weights are copied on the training thread; a background thread converts the copy to TFLite and saves it, so
+    # training goes on meanwhile. Checkpoints are kept for the keepBest epochs with the lowest validation loss and for
+    # every keepEvery-th epoch (all of them if neither is given). Epochs that would not be kept are not saved, and
+    # checkpoints that drop out of the best are deleted. Save times are printed and written to checkpoints.csv.
     class ModelSavingCallback(Callback):
-        def __init__(self, outPath: Path):
+        def __init__(self, outPath: Path, keepBest=None, keepEvery=None):
             super().__init__()
             self.i = 0
             self.path = outPath
+            self.keepBest = keepBest
+            self.keepEvery = keepEvery
             self.trainLosses = []
             self.validationLosses = []
+            self.best = []
+            self.saveTimes = []
+            self._saveModel = None
+            self._queue = queue.Queue(maxsize=2)
+            self._thread = None
+            self._error = None
 
-        def on_epoch_end(self, epoch, logs=None):
-            savePath = self.path / ("epoch_" + str(epoch) + ".tflite")
+        def on_train_begin(self, logs=None):
+            # Checkpoints are saved from a copy of the model, which the training thread never touches.
+            self._saveModel = ModelTrainer.Float32Copy(self.model)
+            self._thread = threading.Thread(target=self._SaveCheckpoints, daemon=True)
+            self._thread.start()
 
-            ModelTrainer.SaveLiteModel(savePath, ModelTrainer.ConvertToLiteModel(self.model))
-            ModelTrainer.SaveModel(self.path / ("epoch_" + str(epoch) + "_fullModel"), self.model)
+        def on_epoch_end(self, epoch, logs=None):
             self.trainLosses.append(str(logs['loss']))
             self.validationLosses.append(str(logs['val_loss']))
+            self._RaiseSaveError()
+
+            # Decide whether this epoch is kept, and which kept checkpoint it replaces among the best.
+            loss = float(logs['val_loss'])
+            loss = math.inf if math.isnan(loss) else loss
+            keep = (self.keepBest is None and self.keepEvery is None) or self._IsPeriodic(epoch)
+            deleted = []
+            if self.keepBest:
+                self.best = sorted(self.best + [(loss, epoch)])
+                if len(self.best) > self.keepBest:
+                    _, worst = self.best.pop()
+                    if worst != epoch and not self._IsPeriodic(worst):
+                        deleted.append(worst)
+                keep = keep or any(bestEpoch == epoch for _, bestEpoch in self.best)
+            if not keep:
+                return
+
+            start = time.perf_counter()
+            weights = self.model.get_weights()
+            copyTime = time.perf_counter() - start
+            # Blocks only if the saving thread is two checkpoints behind.
+            self._queue.put((epoch, loss, weights, copyTime, deleted))
 
         def on_train_end(self, logs=None):
+            self._queue.put(None)
+            self._thread.join()
+
             outfile = open(self.path / "losses.csv", "w+")
             outfile.write("Training loss, " + ",".join(self.trainLosses) + "\n")
             outfile.write("Validation loss, " + ",".join(self.validationLosses) + "\n")
             outfile.close()
+
+            outfile = open(self.path / "checkpoints.csv", "w+")
+            outfile.write("Epoch, Validation loss, Copy time (s), TFLite time (s), SavedModel time (s), Deleted\n")
+            outfile.writelines(", ".join(str(value) for value in row) + "\n" for row in self.saveTimes)
+            outfile.close()
+            self._RaiseSaveError()
+
+        def _IsPeriodic(self, epoch):
+            return self.keepEvery is not None and (epoch + 1) % self.keepEvery == 0
+
+        def _CheckpointPaths(self, epoch):
+            return self.path / ("epoch_" + str(epoch) + ".tflite"), self.path / ("epoch_" + str(epoch) + "_fullModel")
+
+        def _SaveCheckpoints(self):
+            # Runs on the saving thread until on_train_end. After an error, checkpoints are skipped (the error is
+            # raised on the training thread).
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                if self._error is not None:
+                    continue
+                epoch, loss, weights, copyTime, deleted = item
+                litePath, fullPath = self._CheckpointPaths(epoch)
+                try:
+                    start = time.perf_counter()
+                    self._saveModel.set_weights(weights)
+                    ModelTrainer.SaveLiteModel(litePath, ModelTrainer.ConvertToLiteModel(self._saveModel))
+                    liteTime = time.perf_counter() - start
+                    start = time.perf_counter()
+                    ModelTrainer.SaveModel(fullPath, self._saveModel)
+                    fullTime = time.perf_counter() - start
+                    for deletedEpoch in deleted:
+                        deletedLitePath, deletedFullPath = self._CheckpointPaths(deletedEpoch)
+                        deletedLitePath.unlink(missing_ok=True)
+                        shutil.rmtree(deletedFullPath, ignore_errors=True)
+                except Exception as error:
+                    self._error = error
+                    continue
+                self.saveTimes.append([epoch, loss, "%.4f" % copyTime, "%.2f" % liteTime, "%.2f" % fullTime,
+                                       " ".join(str(deletedEpoch) for deletedEpoch in deleted)])
+                print("\nSaved checkpoint of epoch %d in %.2f s (TFLite %.2f s, SavedModel %.2f s; %.4f s on the "
+                      "training thread)" % (epoch, liteTime + fullTime, liteTime, fullTime, copyTime))
+
+        def _RaiseSaveError(self):
+            if self._error is not None:
+                raise RuntimeError("Saving a checkpoint failed") from self._error
+
+    # Records the training throughput (images per second) of every epoch, and how the time of the training steps
+    # splits between waiting for the input pipeline (from the start of a step until its batch is available) and
+    # computing. Validation is not included. The first epoch's input wait includes building the training function.
+    # Written to throughput.csv.
+    class ThroughputCallback(Callback):
+        def __init__(self, outPath: Path):
+            super().__init__()
+            self.path = outPath
+            self.rows = []
+            self._stepStart = 0
+            self._arrival = 0
+
+        def on_train_begin(self, logs=None):
+            self.model.batchArrivalHook = self._OnBatchArrival
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self._images = 0
+            self._inputTime = 0
+            self._computeTime = 0
+
+        def on_train_batch_begin(self, batch, logs=None):
+            self._stepStart = time.perf_counter()
+
+        def _OnBatchArrival(self, batchSize):
+            self._arrival = time.perf_counter()
+            self._images += batchSize
+
+        def on_train_batch_end(self, batch, logs=None):
+            self._inputTime += self._arrival - self._stepStart
+            self._computeTime += time.perf_counter() - self._arrival
+
+        def on_epoch_end(self, epoch, logs=None):
+            stepTime = self._inputTime + self._computeTime
+            rate = self._images / stepTime if stepTime > 0 else 0
+            self.rows.append([epoch, self._images, "%.3f" % stepTime, "%.2f" % rate, "%.3f" % self._inputTime,
+                              "%.3f" % self._computeTime])
+            print("\nEpoch %d: %.2f images/s, %.0f%% of step time waiting for input" %
+                  (epoch, rate, 100 * self._inputTime / stepTime if stepTime > 0 else 0))
+
+        def on_train_end(self, logs=None):
+            self.model.batchArrivalHook = None
+            outfile = open(self.path / "throughput.csv", "w+")
+            outfile.write("Epoch, Images, Step time (s), Images/s, Input wait (s), Compute (s)\n")
+            outfile.writelines(", ".join(str(value) for value in row) + "\n" for row in self.rows)
+            outfile.close()
+
+
+# U-Net model with its own training step, which can accumulate gradients over several batches before updating the
+# weights, and which reports the arrival of each batch (its size, to batchArrivalHook) as soon as it is available.
+class TrainingModel(Model):
+    def __init__(self, *args, accumulationSteps=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accumulationSteps = accumulationSteps
+        self.batchArrivalHook = None
+        self._sums = None
+
+    def compile(self, *args, **kwargs):
+        super().compile(*args, **kwargs)
+        if self.accumulationSteps > 1:
+            # Created here rather than while tracing the training step, together with the optimizer's variables,
+            # which are otherwise created on its first update (that here only happens in a conditional).
+            self._sums = _GradientSums(self.trainable_variables)
+            self.optimizer.build(self.trainable_variables)
+
+    def train_step(self, data):
+        x, y, sampleWeight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        tf.numpy_function(self._BatchArrived, [tf.shape(x)[0]], tf.int64, stateful=True)
+        with tf.GradientTape() as tape:
+            yPredicted = self(x, training=True)
+            loss = self.compute_loss(x, y, yPredicted, sampleWeight)
+        if self.accumulationSteps == 1:
+            self.optimizer.minimize(loss, self.trainable_variables, tape=tape)
+        else:
+            self._Accumulate(tape.gradient(loss, self.trainable_variables))
+        return self.compute_metrics(x, y, yPredicted, sampleWeight)
+
+    def _Accumulate(self, gradients):
+        for total, gradient in zip(self._sums.gradients, gradients):
+            total.assign_add(gradient / self.accumulationSteps)
+        self._sums.count.assign_add(1)
+
+        def Update():
+            self.optimizer.apply_gradients(zip(self._sums.gradients, self.trainable_variables))
+            for total in self._sums.gradients:
+                total.assign(tf.zeros_like(total))
+            self._sums.count.assign(0)
+            return True
+
+        tf.cond(self._sums.count >= self.accumulationSteps, Update, lambda: False)
+
+    def _BatchArrived(self, batchSize):
+        if self.batchArrivalHook is not None:
+            self.batchArrivalHook(int(batchSize))
+        return np.int64(0)
+
+
+# Running sums of gradients for TrainingModel. A plain object, so that Keras does not count them as model weights.
+class _GradientSums:
+    def __init__(self, variables):
+        self.gradients = [tf.Variable(tf.zeros_like(variable), trainable=False) for variable in variables]
+        self.count = tf.Variable(0, trainable=False)
@@ -0,0 +1,79 @@
+# ModelVariants.py -- exports quantized TFLite variants of a trained model and compares them with the float model.
+
+from pathlib import Path
+from typing import List
+import time
+import numpy as np
+import tensorflow as tf
+from backend.ModelTrainer import ModelTrainer
+
+# Quantized variants, each saved as model_<variant>.tflite next to the float32 model.tflite.
+Variants = ["dynamic", "float16", "int8"]
+
+
+# Takes up to count images from validation data (a ModelDataGenerator-like Sequence or a tf.data dataset of
+# (image, segmentation) batches), as float32 arrays of the network input shape without the batch axis.
+def RepresentativeImages(data, count) -> List[np.ndarray]:
+    batches = data.as_numpy_iterator() if isinstance(data, tf.data.Dataset) else (data[i] for i in range(len(data)))
+    images = []
+    for batchImages, _ in batches:
+        images += [image.astype(np.float32) for image in batchImages]
+        if len(images) >= count:
+            break
+    return images[:count]
+
+
+# Converts a Keras model to each of the given variants, saves them to outputPath, and reports each variant's file size,
+# latency and agreement with the float32 model (outputPath/model.tflite, which must exist). The int8 variant is
+# calibrated on the given images, and all variants are compared on them. The report is printed and written to
+# outputPath/variants.csv. Returns its rows.
+def ExportVariants(model: tf.keras.Model, outputPath: Path, variants: List[str], images: List[np.ndarray],
+                   threshold=0.5):
+    floatPath = outputPath / "model.tflite"
+    paths = [floatPath]
+    for variant in variants:
+        path = outputPath / ("model_" + variant + ".tflite")
+        ModelTrainer.SaveLiteModel(path, ModelTrainer.ConvertToLiteModel(model, variant, images))
+        paths.append(path)
+
+    floatOutputs, _ = RunLiteModel(floatPath, images)
+    floatMasks = floatOutputs > threshold
+    rows = []
+    for variant, path in zip(["float32"] + variants, paths):
+        outputs, latency = RunLiteModel(path, images)
+        masks = outputs > threshold
+        union = np.logical_or(masks, floatMasks).sum()
+        iou = np.logical_and(masks, floatMasks).sum() / union if union > 0 else 1.0
+        rows.append([variant, path.name, path.stat().st_size / 2 ** 20, latency * 1000, iou,
+                     np.abs(outputs - floatOutputs).max()])
+
+    print("Variant   Size (MB)  Latency (ms)  IoU vs float32  Max difference")
+    for variant, _, size, latency, iou, difference in rows:
+        print("%-9s %9.2f %13.2f %15.4f %15.4f" % (variant, size, latency, iou, difference))
+    with open(outputPath / "variants.csv", "w+") as outfile:
+        outfile.write("Variant, File, Size (MB), Latency (ms), IoU vs float32, Max difference\n")
+        outfile.writelines("%s, %s, %.4f, %.3f, %.6f, %.6f\n" % tuple(row) for row in rows)
+    return rows
+
+
+# Runs a TFLite model (with the same runtime as Detector) over images one at a time. Returns the outputs, of shape
+# (images, rows, columns), and the median time of an invocation in seconds. The first invocation is not timed.
+def RunLiteModel(path: Path, images: List[np.ndarray]):
+    from tflite_runtime.interpreter import Interpreter
+
+    interpreter = Interpreter(model_path=str(path.absolute()))
+    interpreter.allocate_tensors()
+    inputIndex = interpreter.get_input_details()[0]['index']
+    outputIndex = interpreter.get_output_details()[0]['index']
+    interpreter.set_tensor(inputIndex, images[0][None])
+    interpreter.invoke()
+
+    outputs = []
+    times = []
+    for image in images:
+        interpreter.set_tensor(inputIndex, image[None])
+        start = time.perf_counter()
+        interpreter.invoke()
+        times.append(time.perf_counter() - start)
+        outputs.append(interpreter.get_tensor(outputIndex)[0, :, :, 0])
+    return np.stack(outputs), float(np.median(times))
@@ -0,0 +1,68 @@
+# PackData.py -- packs image/segmentation pairs into a single memory-mappable array for model training.
+
+from pathlib import Path
+from typing import List
+import numpy as np
+from backend.ImageManager import LoadImages
+from backend.Parallel import WorkerPool
+
+
+# Normalizes image/segmentation pairs as ModelDataGenerator does (grayscale, resized, auto-contrasted images and 0/1
+# masks) and writes them to one uint8 .npy file of shape (2, pairs, rows, columns, 1): all images, then all masks, so
+# that a batch of either is a contiguous slice. Pairs are matched by name, and are written in a random order (unless
+# shuffle is False), since batches are later read as consecutive runs. An index file (CSV) next to it lists the source
+# files of each pair. Only the pairs being prepared are held in memory.
+# imageSize: (rows, columns) of the network input.
+def PackData(imagePaths: List[Path], segmentationPaths: List[Path], imageSize, outputPath: Path, workers=1,
+             shuffle=True):
+    segmentationsByStem = {path.stem: path for path in segmentationPaths}
+    pairs = [(path, segmentationsByStem[path.stem]) for path in sorted(imagePaths, key=lambda x: x.stem)
+             if path.stem in segmentationsByStem]
+    if shuffle:
+        pairs = [pairs[i] for i in np.random.permutation(len(pairs))]
+
+    outputPath.parent.mkdir(parents=True, exist_ok=True)
+    packed = np.lib.format.open_memmap(outputPath.with_suffix(".npy"), mode="w+", dtype=np.uint8,
+                                       shape=(2, len(pairs), imageSize[0], imageSize[1], 1))
+    pool = WorkerPool(workers)
+    items = ((imagePath, segmentationPath, tuple(imageSize)) for imagePath, segmentationPath in pairs)
+    for i, (image, segmentation) in enumerate(pool.Map(PreparePair, items)):
+        packed[0, i, :, :, 0] = image
+        packed[1, i, :, :, 0] = segmentation
+    pool.Close()
+    packed.flush()
+    del packed
+
+    with open(IndexPath(outputPath), "w+") as indexFile:
+        indexFile.write("Index, Image, Segmentation\n")
+        indexFile.writelines("%d, %s, %s\n" % (i, imagePath, segmentationPath)
+                             for i, (imagePath, segmentationPath) in enumerate(pairs))
+    return len(pairs)
+
+
+# Opens a packed dataset as a read-only memory map. Returns the images and masks, each of shape (pairs, rows,
+# columns, 1).
+def LoadPackedData(path: Path):
+    packed = np.load(path.with_suffix(".npy"), mmap_mode="r")
+    return packed[0], packed[1]
+
+
+def IndexPath(path: Path) -> Path:
+    return path.with_name(path.stem + "_index.csv")
+
+
+# Loads a training image as ModelDataGenerator does: grayscale, resized, and auto-contrasted to the full 8-bit range.
+def PrepareTrainingImage(path: Path, imageSize) -> np.ndarray:
+    image = next(LoadImages(path, mode="L")).Resize((imageSize[1], imageSize[0])).frames[0]
+    return (255 * ((image - image.min()) / (image.max() - image.min()))).astype(np.uint8)
+
+
+# Loads a segmentation as a 0/1 mask of the network input size.
+def PrepareTrainingSegmentation(path: Path, imageSize) -> np.ndarray:
+    return next(LoadImages(path, mode="1")).Resize((imageSize[1], imageSize[0])).frames[0].astype(np.uint8)
+
+
+# Prepares one pair in a worker. item is (image path, segmentation path, image size).
+def PreparePair(item):
+    imagePath, segmentationPath, imageSize = item
+    return PrepareTrainingImage(imagePath, imageSize), PrepareTrainingSegmentation(segmentationPath, imageSize)
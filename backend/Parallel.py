@@ -0,0 +1,46 @@
+# Parallel.py -- runs a function over many inputs in a pool of worker processes, keeping results in input order.
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable
+
+
+def CPUCount():
+    return os.cpu_count() or 1
+
+
+class WorkerPool:
+    # workers: number of worker processes. With one worker, everything runs serially in this process.
+    # initializer: called once in each worker (e.g. to load a model), with initargs.
+    def __init__(self, workers, initializer: Callable = None, initargs=()):
+        self.workers = max(1, workers)
+        self._executor = None
+        if self.workers > 1:
+            self._executor = ProcessPoolExecutor(self.workers, initializer=initializer, initargs=initargs)
+        elif initializer is not None:
+            initializer(*initargs)
+
+    # Lazily yields function(item) for each item, in input order. At most maxInFlight items are handed to the
+    # workers ahead of the consumer, which bounds memory use when inputs or results are large. The function must be
+    # defined at module level so that it can be sent to the workers.
+    def Map(self, function: Callable, items: Iterable, maxInFlight=None):
+        if self._executor is None:
+            for item in items:
+                yield function(item)
+            return
+
+        if maxInFlight is None:
+            maxInFlight = 2 * self.workers
+        pending = deque()
+        for item in items:
+            pending.append(self._executor.submit(function, item))
+            if len(pending) >= maxInFlight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def Close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
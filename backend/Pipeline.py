@@ -0,0 +1,55 @@
+# Pipeline.py -- streams items through a chain of processing stages that run concurrently.
+
+import queue
+import threading
+from typing import Callable, Iterable, List
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+# Lazily yields the result of passing each source item through every stage in turn. The source and each stage run
+# in their own thread, connected by queues that hold at most queueSize items, so that decoding, inference and
+# post-processing overlap while only a bounded number of items are in memory at once. Stages are called in order
+# on a single thread each, so stateful stages (e.g. a tracker) see items in source order. An exception in any stage
+# is re-raised by the consumer.
+def StreamStages(source: Iterable, stages: List[Callable], queueSize=4):
+    queues = [queue.Queue(queueSize) for _ in range(len(stages) + 1)]
+
+    def Feed():
+        try:
+            for item in source:
+                queues[0].put(item)
+        except BaseException as e:
+            queues[0].put(_Failure(e))
+            return
+        queues[0].put(_END)
+
+    def Work(stage, inQueue: queue.Queue, outQueue: queue.Queue):
+        while True:
+            item = inQueue.get()
+            if item is _END or isinstance(item, _Failure):
+                outQueue.put(item)
+                return
+            try:
+                outQueue.put(stage(item))
+            except BaseException as e:
+                outQueue.put(_Failure(e))
+                return
+
+    threads = [threading.Thread(target=Feed, daemon=True)]
+    threads += [threading.Thread(target=Work, args=(stage, queues[i], queues[i + 1]), daemon=True)
+                for i, stage in enumerate(stages)]
+    [thread.start() for thread in threads]
+
+    while True:
+        item = queues[-1].get()
+        if item is _END:
+            break
+        if isinstance(item, _Failure):
+            raise item.exception
+        yield item
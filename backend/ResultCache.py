@@ -0,0 +1,156 @@
+# ResultCache.py -- an on-disk cache of per-frame results (e.g. detection and label images), keyed by content.
+
+from pathlib import Path
+import hashlib
+import os
+import threading
+import zipfile
+import numpy as np
+
+
+# Results are stored as compressed .npz files under <path>/<stage>/, named by a SHA-256 hash of the input frame and
+# everything else the result depends on (e.g. the model file and the stage parameters), so a changed input or setting
+# is simply a miss. Integer images are stored in the smallest integer type that holds their values and boolean images
+# as packed bits. Reading an entry updates its modification time; when the cache grows past maxBytes, the least
+# recently used entries are deleted. Several processes may share a cache directory. A ResultCache can be used from
+# several threads, and can be sent to worker processes (e.g. as a WorkerPool initializer argument), where it continues as
+# a separate cache object on the same directory.
+class ResultCache:
+    # Digests of files that results depend on (e.g. a model), by path, size and modification time
+    _fileDigests = {}
+
+    def __init__(self, path: Path, maxBytes=1 << 30):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = {}
+        self.misses = {}
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled; the copy gets its own.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def FileDigest(path: Path) -> str:
+        stat = os.stat(path)
+        key = (str(Path(path).absolute()), stat.st_size, stat.st_mtime_ns)
+        if key not in ResultCache._fileDigests:
+            digest = hashlib.sha256()
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(block)
+            ResultCache._fileDigests[key] = digest.hexdigest()
+        return ResultCache._fileDigests[key]
+
+    def Key(self, stage: str, frame: np.ndarray, parameters) -> str:
+        # parameters: anything else the result depends on, with a stable repr (e.g. a list of numbers and strings).
+        frame = np.ascontiguousarray(frame)
+        digest = hashlib.sha256()
+        digest.update(repr((frame.dtype.str, frame.shape, parameters)).encode())
+        digest.update(frame.data)
+        return stage + "/" + digest.hexdigest()
+
+    def Get(self, key: str):
+        # Returns the arrays stored under a key (as a dict), or None on a miss.
+        stage = key.split("/")[0]
+        path = self._Path(key)
+        try:
+            with np.load(path) as stored:
+                arrays = {name: self._Decode(stored, name) for name in stored.files if "." not in name}
+            os.utime(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Missing, or partly written / evicted by another process
+            with self._lock:
+                self.misses[stage] = self.misses.get(stage, 0) + 1
+            return None
+        with self._lock:
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+        return arrays
+
+    def Put(self, key: str, **arrays: np.ndarray):
+        path = self._Path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        stored = {}
+        for name, array in arrays.items():
+            stored.update(self._Encode(name, np.asarray(array)))
+
+        # Written under a temporary name and renamed, so other processes never see a partial entry.
+        temporaryPath = path.with_name("%s.%d.%d.tmp" % (path.stem, os.getpid(), threading.get_ident()))
+        with open(temporaryPath, "wb") as file:
+            np.savez_compressed(file, **stored)
+        os.replace(temporaryPath, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._Entries())
+            else:
+                self._size += path.stat().st_size
+            if self._size > self.maxBytes:
+                self._Evict()
+
+    def Report(self) -> str:
+        stages = sorted(set(self.hits) | set(self.misses))
+        return "\n".join("%s cache: %d hits, %d misses" % (stage, self.hits.get(stage, 0), self.misses.get(stage, 0))
+                         for stage in stages)
+
+    def _Path(self, key: str) -> Path:
+        stage, digest = key.split("/")
+        return self.path / stage / digest[:2] / (digest + ".npz")
+
+    def _Entries(self):
+        # (path, size, last use) of every entry
+        if not self.path.exists():
+            return []
+        entries = []
+        for path in self.path.glob("*/*/*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _Evict(self):
+        # Delete least recently used entries until the cache is 10% below its limit, so that the next few puts do
+        # not each have to scan the cache again.
+        entries = sorted(self._Entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= 0.9 * self.maxBytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            self._size -= size
+
+    @staticmethod
+    def _Encode(name, array: np.ndarray):
+        stored = {name + ".dtype": np.array(array.dtype.str), name + ".shape": np.array(array.shape)}
+        if array.dtype == bool:
+            stored[name] = np.packbits(array, axis=None)
+        elif array.dtype.kind in "iu" and array.size > 0:
+            low, high = array.min(), array.max()
+            compact = next(dtype for dtype in [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32,
+                                               array.dtype]
+                           if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max)
+            stored[name] = array.astype(compact)
+        else:
+            stored[name] = array
+        return stored
+
+    @staticmethod
+    def _Decode(stored, name):
+        dtype = np.dtype(str(stored[name + ".dtype"]))
+        shape = tuple(stored[name + ".shape"])
+        array = stored[name]
+        if dtype == bool:
+            return np.unpackbits(array, count=int(np.prod(shape))).astype(bool).reshape(shape)
+        return array.astype(dtype, copy=False).reshape(shape)
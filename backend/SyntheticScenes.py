@@ -0,0 +1,151 @@
+# SyntheticScenes.py -- generates labeled time-lapse scenes of organoids with known identities, for testing and
+# benchmarking tracking.
+
+from collections import Counter, defaultdict
+from pathlib import Path
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+# A scene of disk-shaped organoids that grow, drift, merge, split and disappear. Frames yields each frame as a labeled
+# image (as from the label sub-program, with labels in random order) together with the ground truth: a map from each
+# label in the image to the organoid's identity. An organoid that merges into another ends, and the larger of the two
+# keeps its identity; an organoid that splits keeps its identity, and its smaller part is a new organoid. Organoids may
+# also be hidden by others or leave the image. Everything is drawn from a random generator with the given seed.
+# radius: (smallest, largest) initial radius in pixels.
+# growth: mean relative growth of the radius per frame.
+# drift: (rows, columns) that the whole scene moves per frame; jitter: standard deviation of each organoid's own
+#   movement per frame, in pixels.
+# mergeRate, splitRate, disappearRate: probability per organoid per frame of each event.
+class SyntheticScene:
+    def __init__(self, organoids=100, frames=20, imageSize=(1024, 1024), radius=(8, 20), growth=0.02,
+                 drift=(0.5, 0.5), jitter=1.0, mergeRate=0.005, splitRate=0.005, disappearRate=0.005, seed=0):
+        self.organoids = organoids
+        self.frames = frames
+        self.imageSize = tuple(imageSize)
+        self.radius = radius
+        self.growth = growth
+        self.drift = np.array(drift, dtype=np.float64)
+        self.jitter = jitter
+        self.mergeRate = mergeRate
+        self.splitRate = splitRate
+        self.disappearRate = disappearRate
+        self.seed = seed
+        self.events = Counter()
+
+    def Frames(self):
+        rng = np.random.default_rng(self.seed)
+        self.events = Counter()
+        centers, radii = self._Place(rng)
+        identities = np.arange(self.organoids)
+        nextIdentity = self.organoids
+
+        for frame in range(self.frames):
+            if frame > 0:
+                centers = centers + self.drift + rng.normal(0, self.jitter, centers.shape)
+                radii = radii * (1 + self.growth * rng.uniform(0.5, 1.5, len(radii)))
+                centers, radii, identities, nextIdentity = self._Events(rng, centers, radii, identities,
+                                                                        nextIdentity)
+            yield self._Draw(rng, centers, radii, identities)
+
+    def _Place(self, rng):
+        # Random positions, avoiding overlaps where there is room.
+        radii = rng.uniform(self.radius[0], self.radius[1], self.organoids)
+        centers = np.zeros([self.organoids, 2])
+        for i in range(self.organoids):
+            for _ in range(20):
+                centers[i] = rng.uniform(radii[i], np.array(self.imageSize) - radii[i])
+                distances = np.linalg.norm(centers[:i] - centers[i], axis=1)
+                if np.all(distances > radii[:i] + radii[i] + 2):
+                    break
+        return centers, radii
+
+    def _Events(self, rng, centers, radii, identities, nextIdentity):
+        count = len(radii)
+        alive = np.ones(count, dtype=bool)
+        alive[rng.random(count) < self.disappearRate] = False
+        self.events["disappearances"] += count - alive.sum()
+
+        # Merges: an organoid merges with its nearest neighbour if they are close; the larger one absorbs the other.
+        if count > 1:
+            _, nearest = cKDTree(centers).query(centers, k=2)
+            for i in np.flatnonzero(rng.random(count) < self.mergeRate):
+                j = nearest[i, 1]
+                if not (alive[i] and alive[j]) or \
+                        np.linalg.norm(centers[i] - centers[j]) > 2 * (radii[i] + radii[j]):
+                    continue
+                keep, absorbed = (i, j) if radii[i] >= radii[j] else (j, i)
+                areas = radii[[keep, absorbed]] ** 2
+                centers[keep] = (centers[keep] * areas[0] + centers[absorbed] * areas[1]) / areas.sum()
+                radii[keep] = np.sqrt(areas.sum())
+                alive[absorbed] = False
+                self.events["merges"] += 1
+
+        # Splits: 40% of the area breaks off next to the organoid as a new one.
+        splitting = np.flatnonzero(alive & (rng.random(count) < self.splitRate))
+        angles = rng.uniform(0, 2 * np.pi, len(splitting))
+        daughterRadii = radii[splitting] * np.sqrt(0.4)
+        radii[splitting] *= np.sqrt(0.6)
+        offsets = (radii[splitting] + daughterRadii + 1)[:, None] * np.stack([np.sin(angles), np.cos(angles)], 1)
+        self.events["splits"] += len(splitting)
+
+        centers = np.concatenate([centers[alive], centers[splitting] + offsets])
+        radii = np.concatenate([radii[alive], daughterRadii])
+        identities = np.concatenate([identities[alive], np.arange(nextIdentity, nextIdentity + len(splitting))])
+        return centers, radii, identities, nextIdentity + len(splitting)
+
+    def _Draw(self, rng, centers, radii, identities):
+        # Organoids are drawn in identity order, so later ones hide earlier ones where they overlap.
+        image = np.zeros(self.imageSize, dtype=np.int32)
+        labels = rng.permutation(len(radii)) + 1
+        for (y, x), radius, label in zip(centers, radii, labels):
+            top, left = max(0, int(y - radius)), max(0, int(x - radius))
+            bottom, right = min(self.imageSize[0], int(y + radius) + 2), min(self.imageSize[1], int(x + radius) + 2)
+            if top >= bottom or left >= right:
+                continue
+            rows, columns = np.ogrid[top:bottom, left:right]
+            inside = (rows - y) ** 2 + (columns - x) ** 2 <= radius ** 2
+            image[top:bottom, left:right][inside] = label
+
+        visible = np.flatnonzero(np.bincount(image.ravel(), minlength=len(labels) + 1)[1:]) + 1
+        labelToIdentity = dict(zip(labels.tolist(), identities.tolist()))
+        return image, {int(label): labelToIdentity[label] for label in visible}
+
+
+# Scores tracking results against the ground truth. truths and labelMaps hold, for each frame, a map from region label
+# to organoid identity and to track ID (as returned by Tracker.Track). Returns:
+# linkAccuracy: of the organoids seen in two consecutive frames, the fraction that kept the same track ID.
+# purity: the fraction of detections whose track mostly followed that same organoid.
+# tracks, truthOrganoids: the number of distinct track IDs and organoid identities.
+def ScoreTracking(truths, labelMaps):
+    links = 0
+    correctLinks = 0
+    previous = {}
+    trackContents = defaultdict(Counter)
+    for truth, labelMap in zip(truths, labelMaps):
+        current = {identity: labelMap[label] for label, identity in truth.items()}
+        for identity, trackID in current.items():
+            if identity in previous:
+                links += 1
+                correctLinks += previous[identity] == trackID
+            trackContents[trackID][identity] += 1
+        previous = current
+
+    detections = sum(sum(contents.values()) for contents in trackContents.values())
+    pure = sum(max(contents.values()) for contents in trackContents.values())
+    return {"linkAccuracy": correctLinks / links if links else 1.0, "purity": pure / detections if detections else 1.0,
+            "tracks": len(trackContents), "truthOrganoids": len({identity for truth in truths for identity in
+                                                                  truth.values()})}
+
+
+# Saves a scene as a TIFF stack of labeled frames and a CSV of the ground truth (frame, label, organoid).
+def SaveScene(scene: SyntheticScene, path: Path):
+    from backend.ImageManager import TIFFWriter
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with TIFFWriter(path.with_suffix(".tif"), compression="deflate") as writer, \
+            open(path.with_name(path.stem + "_truth.csv"), "w+") as truthFile:
+        truthFile.write("Frame, Label, Organoid\n")
+        for frame, (image, truth) in enumerate(scene.Frames()):
+            writer.Append(image)
+            truthFile.writelines("%d, %d, %d\n" % (frame, label, identity) for label, identity in truth.items())
@@ -0,0 +1,232 @@
+# TrackStore.py -- compact, column-oriented storage of the organoid detections that make up a set of tracks.
+
+from pathlib import Path
+from typing import Dict, List
+import pickle
+import numpy as np
+
+
+class TrackStore:
+    # Every detection (one organoid in one frame) is a row. Per-detection measurements are kept in flat numpy
+    # columns. Pixel masks are run-length encoded as horizontal runs (image row, first column, length) in raster
+    # order, with the runs of all detections concatenated into one set of arrays.
+    _rowColumns = {"track": (np.int64, ()), "frame": (np.int64, ()), "area": (np.int64, ()),
+                   "centroid": (np.float64, (2,)), "bbox": (np.int64, (4,)), "runOffset": (np.int64, ()),
+                   "runCount": (np.int64, ())}
+    _runColumns = {"runRow": np.int32, "runColumn": np.int32, "runLength": np.int32}
+
+    def __init__(self):
+        self.rowCount = 0
+        self.runTotal = 0
+        self._columns = {name: np.zeros((0,) + shape, dtype) for name, (dtype, shape) in self._rowColumns.items()}
+        self._columns.update({name: np.zeros(0, dtype) for name, dtype in self._runColumns.items()})
+        self._extraData: Dict[int, dict] = {}
+        self._BuildIndex()
+
+    # Column views (trimmed to the number of stored rows)
+    @property
+    def track(self) -> np.ndarray:
+        return self._columns["track"][:self.rowCount]
+
+    @property
+    def frame(self) -> np.ndarray:
+        return self._columns["frame"][:self.rowCount]
+
+    @property
+    def area(self) -> np.ndarray:
+        return self._columns["area"][:self.rowCount]
+
+    @property
+    def centroid(self) -> np.ndarray:
+        return self._columns["centroid"][:self.rowCount]
+
+    @property
+    def bbox(self) -> np.ndarray:
+        return self._columns["bbox"][:self.rowCount]
+
+    def Add(self, trackID, frame, coords) -> int:
+        # Store one detection from its pixel coordinates (rows of (row, column)). Returns its row number.
+        coords = np.asarray(coords)
+        coords = coords[np.lexsort([coords[:, 1], coords[:, 0]])]
+        breaks = np.flatnonzero((np.diff(coords[:, 0]) != 0) | (np.diff(coords[:, 1]) != 1)) + 1
+        starts = np.concatenate([[0], breaks])
+        lengths = np.diff(np.concatenate([starts, [len(coords)]]))
+        return self._AddRows([trackID], frame, coords[starts, 0], coords[starts, 1], lengths, [len(starts)])[0]
+
+    def AddFrame(self, frame, image: np.ndarray, labels, trackIDs) -> np.ndarray:
+        # Store the regions with the given labels in a labeled image as detections of the given tracks, in one pass
+        # over the image. Returns the new row numbers.
+        labels = np.asarray(labels)
+        width = image.shape[1]
+        flat = image.ravel()
+
+        # Split the image into horizontal runs of equal label.
+        changes = np.ones(len(flat), dtype=bool)
+        changes[1:] = flat[1:] != flat[:-1]
+        changes[::width] = True
+        starts = np.flatnonzero(changes)
+        lengths = np.diff(np.append(starts, len(flat)))
+
+        # Keep the runs of the requested regions, grouped by region (and still in raster order within each).
+        labelToIndex = np.full(max(flat.max(), labels.max(initial=0)) + 1, -1, dtype=np.int64)
+        labelToIndex[labels] = np.arange(len(labels))
+        runIndices = labelToIndex[flat[starts]]
+        keep = np.flatnonzero(runIndices >= 0)
+        keep = keep[np.argsort(runIndices[keep], kind="stable")]
+        runCounts = np.bincount(runIndices[keep], minlength=len(labels))
+        return self._AddRows(trackIDs, frame, starts[keep] // width, starts[keep] % width, lengths[keep], runCounts)
+
+    def RenameTrack(self, oldID, newID):
+        # Changes the track ID of all detections of a track.
+        rows = np.flatnonzero(self.track == oldID)
+        if len(rows) == 0:
+            return
+        if not self._columns["track"].flags.writeable:
+            self._columns["track"] = np.array(self._columns["track"])
+        self._columns["track"][rows] = newID
+        for row, frame in zip(rows.tolist(), self.frame[rows].tolist()):
+            del self._rowsByKey[(oldID, frame)]
+            self._rowsByKey[(newID, frame)] = row
+
+    def Row(self, trackID, frame):
+        # Row of the detection of a track at a frame, or None if the track was not detected then.
+        return self._rowsByKey.get((trackID, frame))
+
+    def RowsAtFrame(self, frame) -> List[int]:
+        return self._rowsByFrame.get(frame, [])
+
+    def Frames(self) -> List[int]:
+        return sorted(self._rowsByFrame)
+
+    def Coords(self, row) -> np.ndarray:
+        # Pixel coordinates of a detection, in raster order (as from skimage regionprops).
+        return self.Pixels([row])
+
+    def Pixels(self, rows) -> np.ndarray:
+        # Concatenated pixel coordinates of several detections (area[rows] pixels each, in the order given).
+        rows = np.asarray(rows, dtype=np.int64)
+        offsets = self._columns["runOffset"][rows]
+        counts = self._columns["runCount"][rows]
+        runs = self._Ranges(offsets, counts)
+        lengths = self._columns["runLength"][runs].astype(np.int64)
+        pixelRows = np.repeat(self._columns["runRow"][runs], lengths)
+        pixelColumns = self._Ranges(self._columns["runColumn"][runs].astype(np.int64), lengths)
+        return np.stack([pixelRows.astype(np.int64), pixelColumns], axis=1)
+
+    def Mask(self, row) -> np.ndarray:
+        # Binary image of a detection, cropped to its bounding box.
+        minRow, minColumn, maxRow, maxColumn = self._columns["bbox"][row]
+        mask = np.zeros([maxRow - minRow, maxColumn - minColumn], dtype=bool)
+        coords = self.Coords(row)
+        mask[coords[:, 0] - minRow, coords[:, 1] - minColumn] = True
+        return mask
+
+    def Paint(self, image: np.ndarray, rows, values):
+        # Draw each detection into an image with the corresponding value.
+        coords = self.Pixels(rows)
+        image[coords[:, 0], coords[:, 1]] = np.repeat(values, self.area[np.asarray(rows, dtype=np.int64)])
+        return image
+
+    def ExtraData(self, row) -> dict:
+        # Free-form per-detection data (e.g. measurements from other channels).
+        return self._extraData.setdefault(row, {})
+
+    # Saves the store as a directory of .npy files, which can be loaded back as memory maps.
+    def Save(self, path: Path):
+        path.mkdir(parents=True, exist_ok=True)
+        for name in self._rowColumns:
+            np.save(path / (name + ".npy"), self._columns[name][:self.rowCount])
+        for name in self._runColumns:
+            np.save(path / (name + ".npy"), self._columns[name][:self.runTotal])
+        with open(path / "extraData.pkl", "wb") as file:
+            pickle.dump({row: data for row, data in self._extraData.items() if data}, file)
+
+    @staticmethod
+    def Load(path: Path, mmap=True) -> "TrackStore":
+        store = TrackStore()
+        mode = "r" if mmap else None
+        for name in list(TrackStore._rowColumns) + list(TrackStore._runColumns):
+            store._columns[name] = np.load(path / (name + ".npy"), mmap_mode=mode)
+        store.rowCount = len(store._columns["track"])
+        store.runTotal = len(store._columns["runRow"])
+        with open(path / "extraData.pkl", "rb") as file:
+            store._extraData = pickle.load(file)
+        store._BuildIndex()
+        return store
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_columns"] = {name: column[:self.runTotal if name in self._runColumns else self.rowCount]
+                             for name, column in self._columns.items()}
+        del state["_rowsByKey"]
+        del state["_rowsByFrame"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        self._BuildIndex()
+
+    def _AddRows(self, trackIDs, frame, runRows, runColumns, runLengths, runCounts) -> np.ndarray:
+        # Append detections given their runs (grouped by detection) and the number of runs of each detection.
+        runCounts = np.asarray(runCounts, dtype=np.int64)
+        runLengths = np.asarray(runLengths, dtype=np.int64)
+        count = len(runCounts)
+        rows = np.arange(self.rowCount, self.rowCount + count)
+        self._Reserve(self.rowCount + count, self.runTotal + len(runLengths))
+
+        runSlice = slice(self.runTotal, self.runTotal + len(runLengths))
+        self._columns["runRow"][runSlice] = runRows
+        self._columns["runColumn"][runSlice] = runColumns
+        self._columns["runLength"][runSlice] = runLengths
+
+        # Measurements follow from the runs: area and centroid from run sums, bounding box from the extreme runs.
+        if count > 0:
+            detections = np.repeat(np.arange(count), runCounts)
+            runColumns = np.asarray(runColumns, dtype=np.int64)
+            runRows = np.asarray(runRows, dtype=np.int64)
+            area = np.bincount(detections, runLengths, minlength=count)
+            rowSums = np.bincount(detections, runRows * runLengths, minlength=count)
+            columnSums = np.bincount(detections, (2 * runColumns + runLengths - 1) * runLengths / 2, minlength=count)
+            firstRuns = np.cumsum(runCounts) - runCounts
+            rowSlice = slice(self.rowCount, self.rowCount + count)
+            self._columns["track"][rowSlice] = trackIDs
+            self._columns["frame"][rowSlice] = frame
+            self._columns["area"][rowSlice] = area
+            self._columns["centroid"][rowSlice] = np.stack([rowSums / area, columnSums / area], axis=1)
+            self._columns["bbox"][rowSlice] = np.stack(
+                [runRows[firstRuns], np.minimum.reduceat(runColumns, firstRuns),
+                 runRows[firstRuns + runCounts - 1] + 1, np.maximum.reduceat(runColumns + runLengths, firstRuns)],
+                axis=1)
+            self._columns["runOffset"][rowSlice] = self.runTotal + firstRuns
+            self._columns["runCount"][rowSlice] = runCounts
+
+        self.rowCount += count
+        self.runTotal += len(runLengths)
+        for row, trackID in zip(rows.tolist(), np.asarray(trackIDs).tolist()):
+            self._rowsByKey[(trackID, int(frame))] = row
+            self._rowsByFrame.setdefault(int(frame), []).append(row)
+        return rows
+
+    @staticmethod
+    def _Ranges(starts, lengths) -> np.ndarray:
+        # Concatenation of arange(start, start + length) for each start and length.
+        lengths = np.asarray(lengths, dtype=np.int64)
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    def _BuildIndex(self):
+        self._rowsByKey = {}
+        self._rowsByFrame = {}
+        for row, (trackID, frame) in enumerate(zip(self.track.tolist(), self.frame.tolist())):
+            self._rowsByKey[(trackID, frame)] = row
+            self._rowsByFrame.setdefault(frame, []).append(row)
+
+    def _Reserve(self, rows, runs):
+        # Grow the columns geometrically so that appending is amortized O(1). Loaded (memory-mapped) columns are
+        # copied into memory the first time they have to grow.
+        for names, needed in [(self._rowColumns, rows), (self._runColumns, runs)]:
+            for name in names:
+                column = self._columns[name]
+                if len(column) < needed:
+                    grown = np.zeros((max(needed, 2 * len(column), 16),) + column.shape[1:], dtype=column.dtype)
+                    grown[:len(column)] = column
+                    self._columns[name] = grown
@@ -4,93 +4,124 @@ from typing import List
 import numpy as np
 from skimage.measure import regionprops
 from scipy.optimize import linear_sum_assignment
-from util import Printer
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from pathlib import Path
+from backend.TrackStore import TrackStore
 
 
 class Tracker:
-    # Data point for one frame for one organoid
+    # Data point for one frame for one organoid. This is a lightweight view of one row of a TrackStore.
     class OrganoidFrameData:
-        def __init__(self, coords):
-            self.extraData = {}
-            self.coords = coords
+        def __init__(self, store: TrackStore, row):
+            self._store = store
+            self._row = row
             self._regionProperties = None
 
-        def __getstate__(self):
-            state = self.__dict__.copy()
-            del state['_regionProperties']
-            return state
+        def WasDetected(self):
+            return self._row is not None
 
-        def __setstate__(self, state):
-            self.__dict__ = state
-            self._regionProperties = None
+        @property
+        def coords(self):
+            return None if self._row is None else self._store.Coords(self._row)
 
-        def WasDetected(self):
-            return self.coords is not None
+        @property
+        def centroid(self):
+            return None if self._row is None else tuple(self._store.centroid[self._row])
+
+        @property
+        def area(self):
+            return None if self._row is None else int(self._store.area[self._row])
+
+        @property
+        def bbox(self):
+            return None if self._row is None else tuple(self._store.bbox[self._row].tolist())
+
+        @property
+        def extraData(self) -> dict:
+            return {} if self._row is None else self._store.ExtraData(self._row)
 
         def GetRP(self):
-            if self._regionProperties is None and self.coords is not None:
-                coords = np.array(self.coords)
-                image = np.zeros([512, 512], dtype=np.uint8)
+            if self._regionProperties is None and self._row is not None:
+                # Only the image up to the bottom-right of the organoid is needed to reproduce its global
+                # coordinates.
+                _, _, maxRow, maxColumn = self.bbox
+                coords = self.coords
+                image = np.zeros([maxRow, maxColumn], dtype=np.uint8)
                 image[tuple(coords.T)] = 1
                 self._regionProperties = regionprops(image)[0]
             return self._regionProperties
 
     class OrganoidTrack:
-        # Collection of data points for a single identified organoid
-        def __init__(self, frame, newID):
-            self.id = newID
+        # Collection of data points for a single identified organoid. Detections are kept in a TrackStore, which is
+        # shared between all tracks of a Tracker (track IDs must be unique within a store).
+        def __init__(self, frame, newID, store: TrackStore = None):
+            self._store = store if store is not None else TrackStore()
+            self._id = newID
 
             self.active = True
             self.firstFrame = frame
             self.age = 0
             self.invisibleConsecutive = 0
-            self._data: List[Tracker.OrganoidFrameData] = []
+            self.lastDetectedFrame = None
+
+        @property
+        def id(self):
+            return self._id
+
+        @id.setter
+        def id(self, newID):
+            # Detections already in the store are moved to the new ID.
+            self._store.RenameTrack(self._id, newID)
+            self._id = newID
 
         def Data(self, frameNumber):
             # Retrieve the datapoint for the given frame
             if not self.DidTrackExist(frameNumber):
                 return None
-            return self._data[frameNumber - self.firstFrame]
+            return Tracker.OrganoidFrameData(self._store, self._store.Row(self.id, frameNumber))
 
         def NoDetection(self):
             # Report no detection of this track for the current frame
-            data = Tracker.OrganoidFrameData(None)
-            self._data.append(data)
             self.invisibleConsecutive += 1
             self.age += 1
 
         def WasDetected(self, frameNumber):
-            data = self.Data(frameNumber)
-            return data and data.WasDetected()
+            return self.DidTrackExist(frameNumber) and self._store.Row(self.id, frameNumber) is not None
 
         def DidTrackExist(self, frameNumber):
-            # Retrieve the datapoint for the given frame
-            if frameNumber < self.firstFrame:
-                return False
-            else:
-                # Frame number relative to when this track started
-                local = frameNumber - self.firstFrame
-                if local >= len(self._data):
-                    return False
-            return True
+            # Frame number relative to when this track started
+            return frameNumber is not None and 0 <= frameNumber - self.firstFrame < self.age
+
+        def DetectedFrames(self):
+            return [frame for frame in range(self.firstFrame, self.firstFrame + self.age) if self.WasDetected(frame)]
 
         def GetLastDetectedFrame(self):
-            for i, data in reversed(list(enumerate(self._data))):
-                if data.WasDetected():
-                    return i + self.firstFrame
-            return None
+            return self.lastDetectedFrame
 
         def GetLastDetectedData(self):
             return self.Data(self.GetLastDetectedFrame())
 
+        def GetLastDetectedRow(self):
+            return self._store.Row(self.id, self.lastDetectedFrame)
+
+        def GetStore(self):
+            return self._store
+
         def Detect(self, coords):
             # Report a detection of this track at this frame
-            self._data.append(Tracker.OrganoidFrameData(coords))
+            self._store.Add(self.id, self.firstFrame + self.age, coords)
+            self.DetectionStored()
+
+        def DetectionStored(self):
+            # Report a detection of this track at this frame that has already been added to the store
+            self.lastDetectedFrame = self.firstFrame + self.age
             self.invisibleConsecutive = 0
             self.age += 1
 
     def __init__(self):
         self._tracks: List[Tracker.OrganoidTrack] = []
+        self._store = TrackStore()
         self.overlapCost = 100
         self.costOfNewOrganoid = 1
         self.costOfMissingOrganoid = 1
@@ -98,69 +129,45 @@ class Tracker:
         self.frame = 0
         self.nextID = 0
 
+    # Assigns the labeled regions in the next frame to tracks. Returns a map from region label to organoid ID.
     def Track(self, image: np.ndarray):
-        # Morphologically analyze labled regions in the image
-        detections = regionprops(image)
-        coordinates = [detection.coords for detection in detections]
+        # Labeled regions in the image, in label order
+        labels = np.flatnonzero(np.bincount(image.ravel())[1:]) + 1
 
         # Get all currently active organoid tracks
         availableTracks = [track for track in self._tracks if track.active]
         numTracks = len(availableTracks)
-        numDetections = len(detections)
+        numDetections = len(labels)
 
-        # Build cost matrix (larger size with "dummy" rows and columns allows for assignment of detections to new tracks
-        # or of existing tracks to missing detections.
-        fullSize = numTracks + numDetections
-        costMatrix = np.zeros([fullSize, fullSize])
-
-        # Fill in the cost of creating a new track
-        newOrganoidMatrix = np.full([numDetections, numDetections], np.inf)
-        np.fill_diagonal(newOrganoidMatrix, self.costOfNewOrganoid)
-        costMatrix[numTracks:, :numDetections] = newOrganoidMatrix
-
-        # Fill in the cost of considering an organoid as as missing
-        missingOrganoidMatrix = np.full([numTracks, numTracks], np.inf)
-        np.fill_diagonal(missingOrganoidMatrix, self.costOfMissingOrganoid)
-        costMatrix[:numTracks, numDetections:] = missingOrganoidMatrix
-
-        print("Computing cost matrix... ")
-        # Fill in the cost of assignment for each track to each detection
-        for trackNumber in range(numTracks):
-            Printer.printRep("(Track %d/%d)" % (trackNumber, numTracks))
-
-            overlapCosts = self.OverlapCost(availableTracks[trackNumber].GetLastDetectedData().GetRP().coords,
-                                            coordinates)
-            costMatrix[trackNumber, 0:numDetections] = overlapCosts
-
-        Printer.printRep(None)
-        # Solve the assignment problem (Hungarian algorithm)
-        trackIndices, detectionIndices = linear_sum_assignment(costMatrix)
+        # Only tracks and detections that overlap can be paired up.
+        trackIndices, detectionIndices, overlapCosts = self.OverlapCosts(availableTracks, image, labels)
+        assignments = self.Assign(numTracks, numDetections, trackIndices, detectionIndices, overlapCosts)
 
         # Handle assignments
-        for assignmentIndex in range(trackIndices.size):
-            trackIndex = trackIndices[assignmentIndex]
-            detectionIndex = detectionIndices[assignmentIndex]
-
-            if detectionIndex >= numDetections and trackIndex >= numTracks:
-                # This is a dummy track and dummy detection. Can skip it.
-                continue
-
-            if detectionIndex >= numDetections:
+        detectedTracks = []
+        for trackIndex in range(numTracks):
+            if assignments[trackIndex] < 0:
                 # Track didn't get assigned to a detection, so it lost its target for this frame.
                 availableTracks[trackIndex].NoDetection()
-                continue
-
-            if trackIndex >= numTracks:
-                # This organoid didn't get assigned to an existing track, so it must be new!
-                track = Tracker.OrganoidTrack(self.frame, self.nextID)
-                self.nextID += 1
-                self._tracks.append(track)
             else:
                 # This got assigned to an existing track.
-                track = availableTracks[trackIndex]
-
-            # Register the detection.
-            track.Detect(detections[detectionIndex].coords)
+                detectedTracks.append(availableTracks[trackIndex])
+        detectionIndices = list(assignments[assignments >= 0])
+
+        for detectionIndex in np.setdiff1d(np.arange(numDetections), assignments):
+            # This organoid didn't get assigned to an existing track, so it must be new!
+            track = Tracker.OrganoidTrack(self.frame, self.nextID, self._store)
+            self.nextID += 1
+            self._tracks.append(track)
+            detectedTracks.append(track)
+            detectionIndices.append(detectionIndex)
+
+        # All detections of the frame are added to the store in one pass over the image.
+        self._store.AddFrame(self.frame, image, labels[detectionIndices], [track.id for track in detectedTracks])
+        for track in detectedTracks:
+            track.DetectionStored()
+        labelMap = {int(labels[detectionIndex]): track.id
+                    for detectionIndex, track in zip(detectionIndices, detectedTracks)}
 
         # Go through all tracks and inactivate any that have been missing for more than a given number of frames.
         if self.deleteTracksAfterMissing >= 0:
@@ -169,17 +176,103 @@ class Tracker:
                     track.active = False
 
         self.frame += 1
+        return labelMap
 
     def GetTracks(self):
         return self._tracks
 
-    def OverlapCost(self, coordinatesA, bCoordinates):
-        overlaps = []
-        for coordinatesB in bCoordinates:
-            overlap = np.count_nonzero((coordinatesA[:, None] == coordinatesB).all(-1).any(-1))
-            if overlap == 0:
-                overlap = np.inf
-            else:
-                overlap = 1 / overlap
-            overlaps.append(overlap * self.overlapCost)
-        return np.asarray(overlaps)
+    def GetStore(self) -> TrackStore:
+        return self._store
+
+    # Saves the tracks as a directory of .npy files (see TrackStore.Save).
+    def SaveTracks(self, path: Path):
+        self._store.Save(path)
+        np.save(path / "tracks.npy", np.array([[track.id, track.firstFrame, track.age, track.active,
+                                                 track.invisibleConsecutive,
+                                                 -1 if track.lastDetectedFrame is None else track.lastDetectedFrame]
+                                                for track in self._tracks], dtype=np.int64).reshape([-1, 6]))
+
+    @staticmethod
+    def LoadTracks(path: Path, mmap=True) -> List[OrganoidTrack]:
+        store = TrackStore.Load(path, mmap)
+        tracks = []
+        for trackID, firstFrame, age, active, invisibleConsecutive, lastDetectedFrame in \
+                np.load(path / "tracks.npy").tolist():
+            track = Tracker.OrganoidTrack(firstFrame, trackID, store)
+            track.age = age
+            track.active = bool(active)
+            track.invisibleConsecutive = invisibleConsecutive
+            track.lastDetectedFrame = None if lastDetectedFrame < 0 else lastDetectedFrame
+            tracks.append(track)
+        return tracks
+
+    def Assign(self, numTracks, numDetections, trackIndices, detectionIndices, costs):
+        # Solves the assignment of tracks to detections, given the costs of the candidate (track, detection) pairs.
+        # Returns the detection index assigned to each track, or -1 if the track is missing in this frame.
+        assignments = np.full(numTracks, -1)
+
+        # Tracks and detections that share no candidate pairs cannot affect each other's assignment, so the problem
+        # splits into independent groups (connected components of the candidate pair graph).
+        graph = coo_matrix((np.ones(len(costs)), (trackIndices, numTracks + detectionIndices)),
+                           shape=[numTracks + numDetections] * 2)
+        _, components = connected_components(graph, directed=False)
+        pairComponents = components[trackIndices]
+        order = np.argsort(pairComponents, kind="stable")
+        groups = np.split(order, np.flatnonzero(np.diff(pairComponents[order])) + 1)
+
+        for pairs in groups:
+            if len(pairs) == 0:
+                continue
+            tracks, localTracks = np.unique(trackIndices[pairs], return_inverse=True)
+            detections, localDetections = np.unique(detectionIndices[pairs], return_inverse=True)
+            groupTracks = len(tracks)
+            groupDetections = len(detections)
+
+            # Build cost matrix (larger size with "dummy" rows and columns allows for assignment of detections to
+            # new tracks or of existing tracks to missing detections.
+            fullSize = groupTracks + groupDetections
+            costMatrix = np.zeros([fullSize, fullSize])
+
+            # Fill in the cost of assignment for each track to each detection
+            costMatrix[:groupTracks, :groupDetections] = np.inf
+            costMatrix[localTracks, localDetections] = costs[pairs]
+
+            # Fill in the cost of creating a new track
+            newOrganoidMatrix = np.full([groupDetections, groupDetections], np.inf)
+            np.fill_diagonal(newOrganoidMatrix, self.costOfNewOrganoid)
+            costMatrix[groupTracks:, :groupDetections] = newOrganoidMatrix
+
+            # Fill in the cost of considering an organoid as as missing
+            missingOrganoidMatrix = np.full([groupTracks, groupTracks], np.inf)
+            np.fill_diagonal(missingOrganoidMatrix, self.costOfMissingOrganoid)
+            costMatrix[:groupTracks, groupDetections:] = missingOrganoidMatrix
+
+            # Solve the assignment problem (Hungarian algorithm)
+            rows, columns = linear_sum_assignment(costMatrix)
+            for row, column in zip(rows, columns):
+                if row < groupTracks and column < groupDetections:
+                    assignments[tracks[row]] = detections[column]
+        return assignments
+
+    def OverlapCosts(self, tracks: List[OrganoidTrack], image: np.ndarray, labels: np.ndarray):
+        # Computes the cost of assigning each track to each detection (region label) that it overlaps, from a joint
+        # histogram of (track, detection) labels under the last detected pixels of every track. Returns the track
+        # indices, detection indices and costs of the overlapping pairs only.
+        numDetections = len(labels)
+        if not tracks:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+
+        # Map the region labels in the image to detection numbers (starting from 1, with 0 for the background).
+        labelToDetection = np.zeros(image.max() + 1, dtype=np.intp)
+        labelToDetection[labels] = np.arange(1, numDetections + 1)
+
+        lastRows = [track.GetLastDetectedRow() for track in tracks]
+        coordinates = self._store.Pixels(lastRows)
+        pixelTracks = np.repeat(np.arange(len(tracks)), self._store.area[lastRows])
+        pixelDetections = labelToDetection[image[coordinates[:, 0], coordinates[:, 1]]]
+
+        histogram = np.bincount(pixelTracks * (numDetections + 1) + pixelDetections,
+                                minlength=len(tracks) * (numDetections + 1)).reshape([len(tracks), numDetections + 1])
+        trackIndices, detectionNumbers = np.nonzero(histogram[:, 1:])
+        overlaps = histogram[trackIndices, detectionNumbers + 1]
+        return trackIndices, detectionNumbers, (1 / overlaps) * self.overlapCost
@@ -18,34 +18,95 @@ class Analyze(Program):
         parser.add_argument("outputPath", help="Directory where results will be saved.", type=pathlib.Path)
         parser.add_argument("measurements", nargs="+", help="List of features to measure. "
                                                             "See https://scikit-image.org/docs/dev/api/skimage.measure.html#skimage.measure.regionprops for available features")
+        parser.add_argument("--workers", dest="workers", default=1, type=int,
+                            help="Number of processes to measure frames in.")
+        parser.add_argument("--parquet", action="store_true",
+                            help="If set, measurements are saved as a Parquet table (requires pyarrow) instead of a "
+                                 "CSV file.")
 
     def RunProgram(self, parserArgs: argparse.Namespace):
         from backend.ImageManager import LoadImages
-        from skimage.measure import regionprops
+        from backend.Measure import MeasureItem
+        from backend.Parallel import WorkerPool
 
         # Load images
         images = LoadImages(parserArgs.imagesPath)
 
         features = parserArgs.measurements
-        count = 1
-        singleAnalysisOutput = "Image name, Organoid label, " + ", ".join(features) + "\n"
-        for image in images:
-            for i, frame in enumerate(image.frames):
-                if len(image.frames) > 1:
-                    name = image.path.stem + "_" + str(i)
-                else:
-                    name = image.path.stem
-                Printer.printRep("Analyzing image %d" % count)
-                rps = regionprops(frame)
-                for rp in rps:
-                    data = ", ".join([str(eval("rp.%s" % feature, {}, {"rp": rp})) for feature in features])
-
-                    singleAnalysisOutput += "%s, %s, %s\n" % (name, rp.label, data)
-                count += 1
-        Printer.printRep()
         path: pathlib.Path = parserArgs.outputPath
         path.mkdir(parents=True, exist_ok=True)
-        csvFile = open(parserArgs.outputPath / "singleOrganoidMeasurements.csv", 'w+')
-        csvFile.write(singleAnalysisOutput)
-        csvFile.close()
+        if parserArgs.parquet:
+            try:
+                writer = ParquetWriter(path / "singleOrganoidMeasurements.parquet", features)
+            except ImportError:
+                print("Parquet output requires the pyarrow package, which is not installed. Install it with "
+                      "\"pip install pyarrow\", or leave out --parquet to save a CSV file.", file=sys.stderr)
+                return
+        else:
+            writer = CSVWriter(path / "singleOrganoidMeasurements.csv", features)
+
+        def Frames():
+            for image in images:
+                for i, frame in enumerate(image.frames):
+                    if len(image.frames) > 1:
+                        name = image.path.stem + "_" + str(i)
+                    else:
+                        name = image.path.stem
+                    yield name, frame, features
+
+        # Frames are measured in parallel and written out as soon as they are done, in input order.
+        pool = WorkerPool(parserArgs.workers)
+        count = 1
+        for name, labels, values in pool.Map(MeasureItem, Frames()):
+            Printer.printRep("Analyzing image %d" % count)
+            writer.Write(name, labels, values)
+            count += 1
+        Printer.printRep()
+        pool.Close()
+        writer.Close()
+
+
+# Writes the measurements of each frame to a CSV file as they arrive.
+class CSVWriter:
+    def __init__(self, path: pathlib.Path, features):
+        self._file = open(path, 'w+')
+        self._file.write("Image name, Organoid label, " + ", ".join(features) + "\n")
+
+    def Write(self, name, labels, values):
+        self._file.writelines("%s, %s, %s\n" % (name, label, ", ".join([str(column[i]) for column in values]))
+                              for i, label in enumerate(labels))
+
+    def Close(self):
+        self._file.close()
+
+
+# Writes the measurements of each frame to a Parquet file as they arrive (one row group per frame). Multi-valued
+# features (e.g. centroid) are stored as lists. Raises ImportError if pyarrow (an optional dependency) is missing.
+class ParquetWriter:
+    def __init__(self, path: pathlib.Path, features):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._path = path
+        self._features = features
+        self._writer = None
+
+    def Write(self, name, labels, values):
+        import numpy as np
+        pyarrow = self._pyarrow
+        if len(labels) == 0:
+            return
+        columns = {"Image name": [name] * len(labels), "Organoid label": np.asarray(labels)}
+        for feature, column in zip(self._features, values):
+            columns[feature] = [value.tolist() if isinstance(value, np.ndarray) else value for value in column]
+        if self._writer is None:
+            table = pyarrow.table(columns)
+            self._writer = pyarrow.parquet.ParquetWriter(self._path, table.schema)
+        else:
+            table = pyarrow.table(columns, schema=self._writer.schema)
+        self._writer.write_table(table)
 
+    def Close(self):
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,103 @@
+# Benchmark.py -- a sub-program that measures the throughput of OrganoID's processing stages.
+
+from commandline.Program import Program
+import argparse
+import pathlib
+
+
+class Benchmark(Program):
+    def Name(self):
+        return "benchmark"
+
+    def Description(self):
+        return "Measure the throughput of processing stages, and save the results for comparison across versions."
+
+    def SetupParser(self, parser: argparse.ArgumentParser):
+        targets = parser.add_subparsers(dest="target", required=True)
+
+        detect = targets.add_parser("detect", help="Benchmark organoid detection with every combination of the given "
+                                                   "models, images, sizes, modes, batch sizes and thread counts.")
+        detect.add_argument("--models", nargs="+", type=pathlib.Path,
+                            default=[pathlib.Path("model/model.tflite"), pathlib.Path("model2/model.tflite")],
+                            help="Paths to TFLite models.")
+        detect.add_argument("--images", nargs="+", default=["synthetic", "dataset/testing/images"],
+                            help="Image sources: \"synthetic\" (generated frames) or paths to images.")
+        detect.add_argument("--sizes", nargs="+", type=int, default=[1024],
+                            help="Sizes (in pixels, square) to resize images to. 0 keeps the images' own sizes "
+                                 "(synthetic frames are then 1024 pixels).")
+        detect.add_argument("--modes", nargs="+", choices=["detect", "batch", "multiple", "tiled"],
+                            default=["detect", "batch", "multiple", "tiled"],
+                            help="detect: one frame per call. batch: batches of frames. multiple: batches of frames "
+                                 "already at network size. tiled: batches of frames in tiled mode.")
+        detect.add_argument("--batch-sizes", dest="batchSizes", nargs="+", type=int, default=[1, 4],
+                            help="Numbers of frames (or tiles) per network invocation.")
+        detect.add_argument("--threads", nargs="+", type=int, default=[1],
+                            help="Numbers of threads for the TFLite interpreter.")
+        detect.add_argument("--frames", default=8, type=int, help="Number of frames per run.")
+        detect.add_argument("--repeats", default=3, type=int,
+                            help="Number of timed passes over the frames (after one untimed pass).")
+        detect.add_argument("--overlap", default=64, type=int, help="Tile overlap in tiled mode.")
+
+        track = targets.add_parser("track", help="Benchmark organoid tracking on synthetic time-lapse scenes with "
+                                                 "known organoid identities, for each of the given numbers of "
+                                                 "organoids.")
+        track.add_argument("--organoids", nargs="+", type=int, default=[50, 200, 800],
+                           help="Numbers of organoids in the first frame.")
+        track.add_argument("--frames", default=20, type=int, help="Number of frames per scene.")
+        track.add_argument("--size", nargs=2, type=int, default=[1024, 1024], help="Image size (rows, columns).")
+        track.add_argument("--radius", nargs=2, type=float, default=[8, 20],
+                           help="Smallest and largest initial organoid radius in pixels.")
+        track.add_argument("--growth", default=0.02, type=float, help="Mean relative radius growth per frame.")
+        track.add_argument("--drift", nargs=2, type=float, default=[0.5, 0.5],
+                           help="Movement of the whole scene per frame (rows, columns) in pixels.")
+        track.add_argument("--jitter", default=1.0, type=float,
+                           help="Standard deviation of each organoid's own movement per frame in pixels.")
+        track.add_argument("--merge-rate", dest="mergeRate", default=0.005, type=float,
+                           help="Probability per organoid per frame of merging with its nearest neighbour.")
+        track.add_argument("--split-rate", dest="splitRate", default=0.005, type=float,
+                           help="Probability per organoid per frame of splitting in two.")
+        track.add_argument("--disappear-rate", dest="disappearRate", default=0.005, type=float,
+                           help="Probability per organoid per frame of disappearing.")
+        track.add_argument("--seed", default=0, type=int, help="Random seed of the scenes.")
+        track.add_argument("--save-scenes", dest="scenesPath", type=pathlib.Path, default=None,
+                           help="Directory to save the scenes in (labeled TIFF stacks with ground-truth CSV files).")
+
+        startup = targets.add_parser("startup", help="Measure the import time of each sub-program with python -X "
+                                                     "importtime.")
+        startup.add_argument("--programs", nargs="+", default=None,
+                             help="Names of the sub-programs to measure (default: all).")
+        startup.add_argument("--repeats", default=3, type=int, help="Number of times to start each sub-program.")
+
+        for target in [detect, track, startup]:
+            target.add_argument("-O", dest="outputPath", type=pathlib.Path, default=None,
+                                help="JSON file to save the results in (default: benchmark_<target>.json).")
+            target.add_argument("--compare", dest="comparePath", type=pathlib.Path, default=None,
+                                help="JSON file of an earlier benchmark to compare frame rates (or import times) with.")
+
+    def RunProgram(self, parserArgs: argparse.Namespace):
+        from backend.Benchmark import BenchmarkDetectors, BenchmarkTracking, BenchmarkStartup, SaveResults, \
+            CompareResults
+
+        runs = []
+        if parserArgs.target == "detect":
+            sizes = [size or None for size in parserArgs.sizes]
+            runs = BenchmarkDetectors(parserArgs.models, parserArgs.images, sizes, parserArgs.modes,
+                                      parserArgs.batchSizes, parserArgs.threads, parserArgs.frames,
+                                      parserArgs.repeats, parserArgs.overlap)
+        elif parserArgs.target == "track":
+            sceneParameters = {name: getattr(parserArgs, name) for name in
+                               ["radius", "growth", "drift", "jitter", "mergeRate", "splitRate", "disappearRate",
+                                "seed"]}
+            runs = BenchmarkTracking(parserArgs.organoids, parserArgs.frames, parserArgs.size, sceneParameters,
+                                     parserArgs.scenesPath)
+        elif parserArgs.target == "startup":
+            from OrganoID import programs
+            programs = [program for program in programs
+                        if parserArgs.programs is None or program().Name() in parserArgs.programs]
+            runs = BenchmarkStartup(programs, parserArgs.repeats)
+
+        outputPath = parserArgs.outputPath or pathlib.Path("benchmark_" + parserArgs.target + ".json")
+        SaveResults(outputPath, parserArgs.target, runs)
+        print("Results saved to " + str(outputPath))
+        if parserArgs.comparePath is not None:
+            print("\n".join(CompareResults(parserArgs.comparePath, runs)))
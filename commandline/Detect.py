@@ -21,53 +21,108 @@ class Detect(Program):
                                                                 "heatmap format, which is good for visualizing "
                                                                 "detections.")
         parser.add_argument("--show", action="store_true", help="If set, the output images will be displayed.")
+        parser.add_argument("--batch-size", dest="batchSize", default=1, type=int,
+                            help="Number of frames to pass through the network at once.")
+        parser.add_argument("--workers", dest="workers", default=1, type=int,
+                            help="Number of processes to run detection in. Each process loads its own copy of the "
+                                 "model, and the CPU cores are divided evenly between them.")
+        parser.add_argument("--tiled", action="store_true",
+                            help="If set, images are analyzed at full resolution as overlapping tiles instead of being "
+                                 "shrunk to the network input size. Use for large images with small organoids.")
+        parser.add_argument("--overlap", dest="overlap", default=64, type=int,
+                            help="Overlap in pixels between neighbouring tiles in --tiled mode.")
+        parser.add_argument("--bigtiff", action="store_true",
+                            help="If set, image stacks are saved as BigTIFF files, which can be larger than 4 GB.")
+        parser.add_argument("--compress", action="store_true",
+                            help="If set, image stacks are saved with lossless (deflate) compression.")
+        parser.add_argument("--cache", dest="cachePath", default=None, type=pathlib.Path,
+                            help="Directory of a cache of detection images. Frames that were already processed with the same model and settings "
+                                 "are loaded from it instead of being processed again.")
+        parser.add_argument("--cache-size", dest="cacheSize", default=1024, type=int,
+                            help="Size limit of the cache in megabytes. The least recently used results are deleted "
+                                 "beyond it.")
 
     def RunProgram(self, parserArgs: argparse.Namespace):
-        from backend.ImageManager import LoadImages, SaveImage, ShowImage, SaveTIFFStack
-        from backend.Detector import Detector
+        from backend.ImageManager import LoadImages, ShowImage, ImageWriter
+        from backend.Detector import Detector, DetectorPool
+        from backend.ResultCache import ResultCache
+        from util import Printer
+        import time
 
         # Load the images
-        images = LoadImages(parserArgs.imagesPath, size=[512, 512], mode="L")
+        tileOverlap = parserArgs.overlap if parserArgs.tiled else None
+        images = LoadImages(parserArgs.imagesPath, size=None if parserArgs.tiled else [512, 512], mode="L")
         images = list(images)
+        cache = None
+        if parserArgs.cachePath is not None:
+            cache = ResultCache(parserArgs.cachePath, parserArgs.cacheSize << 20)
         # Load neural network detector
-        detector = Detector(parserArgs.modelPath)
+        if parserArgs.workers > 1:
+            detector = DetectorPool(parserArgs.modelPath, parserArgs.workers, parserArgs.batchSize, tileOverlap,
+                                    cache)
+        else:
+            detector = Detector(parserArgs.modelPath, parserArgs.batchSize, tileOverlap=tileOverlap, cache=cache)
+
+        # Frames from all images are queued for detection as one stream, so that the workers stay busy across image
+        # boundaries. Results come back in input order.
+        batchSize = parserArgs.batchSize
+        batches = ([image.frames[i] for i in range(start, min(start + batchSize, len(image.frames)))]
+                   for image in images for start in range(0, len(image.frames), batchSize))
+        detections = detector.DetectStream(batches)
+        compression = "deflate" if parserArgs.compress else None
 
         count = 1
-        outputImages = []
+        shownFrames = []
+        totalFrames = 0
+        totalTime = 0
 
         for image in images:
             ShowImage(image.frames[0], image.originalSize)
             print("Detecting %d: %s" % (count, image.path))
             count += 1
 
-            detected_raw = image.DoOperation(detector.Detect, "Frame")
+            # Output frames are written as they are detected, so that only the current batch is held in memory.
+            frameCount = len(image.frames)
+            writers = []
             if parserArgs.outputPath is not None:
-                if len(detected_raw.frames) > 1:
-                    extension = ".tiff"
-                else:
-                    extension = image.path.suffix
-                fileName = image.path.stem + "_detected" + extension
-                savePath = parserArgs.outputPath / fileName
-                if len(detected_raw.frames) > 1:
-                    SaveTIFFStack(detected_raw.frames, savePath)
-                else:
-                    SaveImage(detected_raw.frames[0], savePath)
-            if parserArgs.heat:
-                heat = detected_raw.DoOperation(lambda x: detector.ConvertToHeatmap(x), "Building heatmap")
-                outputImages.append(heat)
-                if parserArgs.outputPath is not None:
-                    if len(heat.frames) > 1:
-                        extension = ".tiff"
-                    else:
-                        extension = ".png"
-                    fileName = image.path.stem + "_heat" + extension
-                    savePath = parserArgs.outputPath / fileName
-                    if len(heat.frames) > 1:
-                        SaveTIFFStack(heat.frames, savePath)
-                    else:
-                        SaveImage(heat.frames[0], savePath)
+                extension = ".tiff" if frameCount > 1 else image.path.suffix
+                writers.append(ImageWriter(parserArgs.outputPath / (image.path.stem + "_detected" + extension),
+                                           frameCount, parserArgs.bigtiff, compression))
+                if parserArgs.heat:
+                    extension = ".tiff" if frameCount > 1 else ".png"
+                    writers.append(ImageWriter(parserArgs.outputPath / (image.path.stem + "_heat" + extension),
+                                               frameCount, parserArgs.bigtiff, compression))
+
+            startTime = time.perf_counter()
+            done = 0
+            while done < frameCount:
+                Printer.printRep("Frame: %d/%d" % (done + 1, frameCount))
+                for detected in next(detections):
+                    outputFrames = [detected]
+                    if parserArgs.heat:
+                        outputFrames.append(detector.ConvertToHeatmap(detected))
+                        if parserArgs.show:
+                            shownFrames.append((outputFrames[-1], image.originalSize))
+                    for writer, outputFrame in zip(writers, outputFrames):
+                        writer.Append(outputFrame)
+                    done += 1
+            Printer.printRep()
+            for writer in writers:
+                writer.Close()
+            elapsed = time.perf_counter() - startTime
+            totalFrames += frameCount
+            totalTime += elapsed
+            print("Detected %d frames in %.2f seconds (%.2f frames/second)" %
+                  (frameCount, elapsed, frameCount / elapsed))
+
+        if totalTime > 0:
+            print("Detection throughput: %d frames in %.2f seconds (%.2f frames/second)" %
+                  (totalFrames, totalTime, totalFrames / totalTime))
+        if cache is not None:
+            print(cache.Report())
+        if parserArgs.workers > 1:
+            detector.Close()
 
         if parserArgs.show:
-            for outputImage in outputImages:
-                for frame in outputImage.frames:
-                    ShowImage(frame, outputImage.originalSize)
+            for frame, size in shownFrames:
+                ShowImage(frame, size)
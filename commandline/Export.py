@@ -0,0 +1,46 @@
+# Export.py -- a sub-program that exports quantized TFLite variants of a trained model.
+
+from commandline.Program import Program
+import argparse
+import pathlib
+
+
+class Export(Program):
+    def Name(self):
+        return "export"
+
+    def Description(self):
+        return "Export quantized TFLite variants of a trained model, and report their size, latency and agreement " \
+               "with the float model."
+
+    def SetupParser(self, parser: argparse.ArgumentParser):
+        parser.add_argument("modelPath", type=pathlib.Path,
+                            help="Path to a full (SavedModel) model saved by the train sub-program, e.g. "
+                                 "model/fullModel.")
+        parser.add_argument("dataPath", type=pathlib.Path,
+                            help="Path to ground-truth data with a validation/images/ subfolder (as for train). "
+                                 "Quantization is calibrated on these images and variants are compared on them.")
+        parser.add_argument("outputPath", type=pathlib.Path,
+                            help="Directory to save model.tflite, model_<variant>.tflite and variants.csv in.")
+        parser.add_argument("--variants", nargs="+", choices=["dynamic", "float16", "int8"],
+                            default=["dynamic", "float16", "int8"], help="Variants to export.")
+        parser.add_argument("--representative-count", dest="representativeCount", default=100, type=int,
+                            help="Number of validation images to calibrate and evaluate with.")
+        parser.add_argument("-T", dest="threshold", default=0.5, type=float,
+                            help="Detection threshold for comparing the variants with the float model.")
+
+    def RunProgram(self, parserArgs: argparse.Namespace):
+        import tensorflow as tf
+        from backend.ModelTrainer import ModelTrainer
+        from backend.ModelDataGenerator import ModelDataGenerator
+        from backend.ModelVariants import ExportVariants, RepresentativeImages
+
+        model = tf.keras.models.load_model(str(parserArgs.modelPath), compile=False)
+        validationPath = parserArgs.dataPath / "validation"
+        data = ModelDataGenerator(validationPath / "images", validationPath / "segmentations",
+                                  model.input_shape[1:3], 1)
+
+        parserArgs.outputPath.mkdir(parents=True, exist_ok=True)
+        ModelTrainer.SaveLiteModel(parserArgs.outputPath / "model.tflite", ModelTrainer.ConvertToLiteModel(model))
+        ExportVariants(model, parserArgs.outputPath, parserArgs.variants,
+                       RepresentativeImages(data, parserArgs.representativeCount), parserArgs.threshold)
@@ -27,38 +27,162 @@ class Label(Program):
         parser.add_argument("--edge", action="store_true",
                             help="If set, a version of each image with edge detection will also be produced.")
         parser.add_argument("--show", action="store_true", help="If set, the output images will be displayed.")
+        parser.add_argument("--bigtiff", action="store_true",
+                            help="If set, image stacks are saved as BigTIFF files, which can be larger than 4 GB.")
+        parser.add_argument("--compress", action="store_true",
+                            help="If set, image stacks are saved with lossless (deflate) compression.")
+        parser.add_argument("--cache", dest="cachePath", default=None, type=pathlib.Path,
+                            help="Directory of a cache of label images. Frames that were already processed with the same settings "
+                                 "are loaded from it instead of being processed again.")
+        parser.add_argument("--cache-size", dest="cacheSize", default=1024, type=int,
+                            help="Size limit of the cache in megabytes. The least recently used results are deleted "
+                                 "beyond it.")
+        parser.add_argument("--workers", dest="workers", default=1, type=int,
+                            help="Number of processes to label frames in.")
+        parser.add_argument("--sweep", action="store_true",
+                            help="If set, images are labeled with every combination of the --thresholds, --edge-low, "
+                                 "--edge-high and --min-areas values, and a summary of each combination is saved to "
+                                 "labelSweep.csv instead of the labeled images.")
+        parser.add_argument("--thresholds", nargs="+", type=float, default=[0.5],
+                            help="Foreground detection thresholds to sweep.")
+        parser.add_argument("--edge-low", dest="edgeLows", nargs="+", type=float, default=[0.005],
+                            help="Low edge hysteresis thresholds to sweep.")
+        parser.add_argument("--edge-high", dest="edgeHighs", nargs="+", type=float, default=[0.05],
+                            help="High edge hysteresis thresholds to sweep.")
+        parser.add_argument("--min-areas", dest="minAreas", nargs="+", type=int, default=None,
+                            help="Minimum organoid areas to sweep (default: the -A value).")
+        parser.add_argument("--truth", dest="truthPath", default=None, type=pathlib.Path,
+                            help="Ground-truth segmentations (labeled or binary) of the detection images, in the same "
+                                 "order, to score each combination against.")
 
     def RunProgram(self, parserArgs: argparse.Namespace):
-        from backend.ImageManager import LoadImages, SaveImage, ShowImage, LabelToRGB, SaveTIFFStack
-        from backend.Label import Label, DetectEdges
+        from backend.ImageManager import LoadImages, ShowImage, LabelToRGB, ImageWriter
+        from backend.Label import InitializeWorker, LabelInWorker, TimingReport
+        from backend.Parallel import WorkerPool
+        from backend.ResultCache import ResultCache
+        from util import Printer
+        from collections import deque
+        from functools import partial
+
+        # A sweep only writes its summary, so options for the labeled images do not apply.
+        if parserArgs.sweep:
+            imageOptions = [option for option, isSet in [("--rgb", parserArgs.rgb), ("--edge", parserArgs.edge),
+                                                         ("--show", parserArgs.show),
+                                                         ("--bigtiff", parserArgs.bigtiff),
+                                                         ("--compress", parserArgs.compress),
+                                                         ("--cache", parserArgs.cachePath is not None)] if isSet]
+            if imageOptions:
+                raise SystemExit("--sweep does not save labeled images, so it cannot be combined with " +
+                                 ", ".join(imageOptions))
 
         # Load detection images
-        images = LoadImages(parserArgs.detectionsPath)
+        images = list(LoadImages(parserArgs.detectionsPath))
+
+        if parserArgs.sweep:
+            self.Sweep(parserArgs, images)
+            return
+
+        # Frames of all images are labeled as one stream, so that the workers stay busy across image boundaries.
+        # Results come back in input order. The edge map is computed as part of labeling, so it is kept for --edge.
+        # With a cache, each worker looks its frames up itself.
+        cache = None
+        if parserArgs.cachePath is not None:
+            cache = ResultCache(parserArgs.cachePath, parserArgs.cacheSize << 20)
+        pool = WorkerPool(parserArgs.workers, partial(InitializeWorker, cache=cache),
+                          (parserArgs.minArea, parserArgs.removeBorder))
+        labelResults = deque()
+
+        def Labeled():
+            for result in pool.Map(LabelInWorker, (frame for image in images for frame in image.frames)):
+                labelResults.append(result)
+                yield result[0]
+
+        # RGB conversion runs in the pool as well, on labeled frames as they come in. Only the frames in flight
+        # between the two stages are held in memory.
+        if parserArgs.rgb:
+            rgbFrames = pool.Map(partial(LabelToRGB, textSize=parserArgs.textSize), Labeled())
+        else:
+            rgbFrames = (None for _ in Labeled())
+        compression = "deflate" if parserArgs.compress else None
+        timings = {}
+        frameCount = 0
+        cacheHits = 0
 
         count = 1
         for image in images:
             print("Labeling %d: %s" % (count, image.path))
             count += 1
 
-            identified = image.DoOperation(lambda x: Label(x, parserArgs.minArea, parserArgs.removeBorder), "Labeling")
+            names = (["rgb"] if parserArgs.rgb else []) + (["edges"] if parserArgs.edge else []) + ["labeled"]
+            writers = {}
+            if parserArgs.outputPath is not None:
+                writers = {name: ImageWriter(parserArgs.outputPath /
+                                             (image.path.stem + "_" + name + image.path.suffix),
+                                             len(image.frames), parserArgs.bigtiff, compression) for name in names}
 
-            outputImages = []
-            if parserArgs.rgb:
-                outputImages.append(("rgb", identified.DoOperation(lambda x: LabelToRGB(x, parserArgs.textSize), "Converting to RGB")))
-            if parserArgs.edge:
-                edges = image.DoOperation(DetectEdges, "Finding edges")
-                outputImages.append(("edges", edges))
-            outputImages.append(("labeled", identified))
+            for i in range(len(image.frames)):
+                rgb = next(rgbFrames)
+                labeled, edges, frameTimings, cacheHit = labelResults.popleft()
+                cacheHits += bool(cacheHit)
+                for stage, seconds in frameTimings.items():
+                    timings[stage] = timings.get(stage, 0) + seconds
+                frameCount += 1
+                Printer.printRep("Labeling: %d/%d" % (i + 1, len(image.frames)))
 
-            if parserArgs.show:
-                [ShowImage(outputImage.frames[0]) for (_, outputImage) in outputImages]
+                outputFrames = {"rgb": rgb, "edges": edges, "labeled": labeled}
+                for name, writer in writers.items():
+                    writer.Append(outputFrames[name])
+                if parserArgs.show and i == 0:
+                    [ShowImage(outputFrames[name]) for name in names]
+            Printer.printRep()
+            for writer in writers.values():
+                writer.Close()
+        pool.Close()
 
-            if parserArgs.outputPath is not None:
-                for name, outputImage in outputImages:
-                    extension = outputImage.path.suffix
-                    fileName = outputImage.path.stem + "_" + name + extension
-                    savePath = parserArgs.outputPath / fileName
-                    if len(outputImage.frames) > 1:
-                        SaveTIFFStack(outputImage.frames, savePath)
-                    else:
-                        SaveImage(outputImage.frames[0], savePath)
+        # Stage times are summed over all workers.
+        print("Labeling time by stage:")
+        print(TimingReport(timings, frameCount))
+        if cache is not None:
+            print("label cache: %d hits, %d misses" % (cacheHits, frameCount - cacheHits))
+
+    def Sweep(self, parserArgs: argparse.Namespace, images):
+        from backend.ImageManager import LoadImages
+        from backend.Label import LabelSweep, InitializeSweepWorker, SweepInWorker, TimingReport
+        from backend.Parallel import WorkerPool
+        from util import Printer
+        import itertools
+
+        # Frames are swept in the pool as they are loaded, and their results are added up here in input order.
+        parameters = (parserArgs.thresholds, parserArgs.edgeLows, parserArgs.edgeHighs,
+                      parserArgs.minAreas or [parserArgs.minArea], parserArgs.removeBorder)
+        sweep = LabelSweep(*parameters)
+        pool = WorkerPool(parserArgs.workers, InitializeSweepWorker, parameters)
+        frameCount = sum(len(image.frames) for image in images)
+        frames = (frame for image in images for frame in image.frames)
+        if parserArgs.truthPath is not None:
+            truths = (frame for image in LoadImages(parserArgs.truthPath) for frame in image.frames)
+        else:
+            truths = itertools.repeat(None)
+
+        print("Sweeping %d parameter combinations" % len(sweep.parameters))
+        timings = {}
+        for i, (results, frameTimings) in enumerate(pool.Map(SweepInWorker, zip(frames, truths))):
+            Printer.printRep("Frame: %d/%d" % (i + 1, frameCount))
+            sweep.AddFrameResults(results)
+            for stage, seconds in frameTimings.items():
+                timings[stage] = timings.get(stage, 0) + seconds
+        Printer.printRep()
+        pool.Close()
+
+        outputPath = parserArgs.outputPath if parserArgs.outputPath is not None else pathlib.Path(".")
+        outputPath.mkdir(parents=True, exist_ok=True)
+        csvFile = open(outputPath / "labelSweep.csv", "w+")
+        csvFile.write("Threshold, Edge low, Edge high, Minimum area, Frames, Organoids, Mean area, Median area, "
+                      "Area std, Smallest area, Largest area, Truth organoids, Foreground IoU, Organoid F1\n")
+        for result in sweep.Results():
+            csvFile.write(", ".join(str(result[key]) for key in
+                                    ["threshold", "edgeLow", "edgeHigh", "minimumArea", "frames", "count", "meanArea",
+                                     "medianArea", "stdArea", "minArea", "maxArea", "truthCount", "iou", "f1"]) + "\n")
+        csvFile.close()
+        # Stage times are summed over all workers.
+        print(TimingReport(timings, sweep.frameCount))
@@ -0,0 +1,41 @@
+# Pack.py -- a sub-program that packs training and validation data into memory-mappable array files.
+
+from commandline.Program import Program
+import argparse
+import pathlib
+
+
+class Pack(Program):
+    def Name(self):
+        return "pack"
+
+    def Description(self):
+        return "Pack split ground-truth data into array files that can be trained from without decoding images."
+
+    def SetupParser(self, parser: argparse.ArgumentParser):
+        parser.add_argument("inputPath", help="Path to image and segmentation data. "
+                                              "Directory with subfolders training/ and validation/ with "
+                                              "respective subfolders images/ and segmentations/",
+                            type=pathlib.Path)
+        parser.add_argument("outputPath", type=pathlib.Path,
+                            help="Directory where the packed data will be saved (training.npy and validation.npy, "
+                                 "each with an index file). Train from it with train --input packed.")
+        parser.add_argument("-S", dest='size', nargs=2, default=[512, 512],
+                            help="Size of network input images (e.g. -S 512 512).", type=int)
+        parser.add_argument("--workers", dest="workers", default=1, type=int,
+                            help="Number of processes to decode images in.")
+        parser.add_argument("--keepOrder", action="store_true",
+                            help="If set, pairs are packed in name order instead of a random order.")
+
+    def RunProgram(self, parserArgs: argparse.Namespace):
+        from backend.PackData import PackData
+
+        for subset in ["training", "validation"]:
+            subsetPath = parserArgs.inputPath / subset
+            if not subsetPath.is_dir():
+                continue
+            count = PackData([path for path in (subsetPath / "images").iterdir() if path.is_file()],
+                             [path for path in (subsetPath / "segmentations").iterdir() if path.is_file()],
+                             parserArgs.size, parserArgs.outputPath / (subset + ".npy"), parserArgs.workers,
+                             not parserArgs.keepOrder)
+            print("Packed %d %s pairs" % (count, subset))
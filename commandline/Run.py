@@ -0,0 +1,163 @@
+# Run.py -- sub-program that detects, labels, tracks and measures organoids in one streaming pass.
+
+from commandline.Program import Program
+import argparse
+import pathlib
+
+
+class Run(Program):
+    def Name(self):
+        return "run"
+
+    def Description(self):
+        return "Detect, label, track and measure organoids in microscopy images in a single pass, without " \
+               "intermediate files."
+
+    def SetupParser(self, parser: argparse.ArgumentParser):
+        parser.add_argument("modelPath", help="Path to trained OrganoID model", type=pathlib.Path)
+        parser.add_argument("imagesPath", help="Path to images to analyze.", type=pathlib.Path)
+        parser.add_argument("outputPath", help="Directory where results will be saved.", type=pathlib.Path)
+        parser.add_argument("-measure", nargs="+", dest="features", default=[],
+                            help="List of features to measure. "
+                                 "See https://scikit-image.org/docs/dev/api/skimage.measure.html#skimage.measure.regionprops for available features")
+        parser.add_argument("-A", dest="minArea", default=100,
+                            type=int,
+                            help="Remove organoids with an area smaller than a set number of pixels.")
+        parser.add_argument("--removeBorder", action="store_true", help="Remove organoids that are touching borders.")
+        parser.add_argument("--batch-size", dest="batchSize", default=1, type=int,
+                            help="Number of frames to pass through the network at once.")
+        parser.add_argument("--queue-size", dest="queueSize", default=4, type=int,
+                            help="Maximum number of frame batches waiting between each stage of the pipeline.")
+        parser.add_argument("--batch", action="store_true",
+                            help="If set, each image will be treated as a separate tracking stack.")
+        parser.add_argument("--detections", action="store_true",
+                            help="If set, detection images will also be saved.")
+        parser.add_argument("--labeled", action="store_true",
+                            help="If set, labeled images will also be saved.")
+        parser.add_argument("--gif", action="store_true",
+                            help="If set, tracked images will be saved as a GIF video.")
+        parser.add_argument("--bigtiff", action="store_true",
+                            help="If set, image stacks are saved as BigTIFF files, which can be larger than 4 GB.")
+        parser.add_argument("--compress", action="store_true",
+                            help="If set, image stacks are saved with lossless (deflate) compression.")
+        parser.add_argument("--cache", dest="cachePath", default=None, type=pathlib.Path,
+                            help="Directory of a cache of detection and label images. Frames that were already processed with the same model and settings "
+                                 "are loaded from it instead of being processed again.")
+        parser.add_argument("--cache-size", dest="cacheSize", default=1024, type=int,
+                            help="Size limit of the cache in megabytes. The least recently used results are deleted "
+                                 "beyond it.")
+
+    def RunProgram(self, parserArgs: argparse.Namespace):
+        from backend.ImageManager import LoadImages, ImageWriter, GIFWriter, LabelTracksStream
+        from backend.Detector import Detector
+        from backend.Label import Labeler
+        from backend.Tracker import Tracker
+        from backend.Pipeline import StreamStages
+        from backend.Measure import MeasureFrame
+        from backend.ResultCache import ResultCache
+        from util import Printer
+
+        outputPath: pathlib.Path = parserArgs.outputPath
+        outputPath.mkdir(parents=True, exist_ok=True)
+        cache = None
+        if parserArgs.cachePath is not None:
+            cache = ResultCache(parserArgs.cachePath, parserArgs.cacheSize << 20)
+        detector = Detector(parserArgs.modelPath, parserArgs.batchSize, cache=cache)
+        labeler = Labeler(parserArgs.minArea, parserArgs.removeBorder, cache=cache)
+        features = parserArgs.features
+
+        # Each item that flows through the pipeline is a batch of consecutive frames from one image.
+        class FrameBatch:
+            def __init__(self, image, start, frames):
+                self.image = image
+                self.start = start
+                self.frames = frames
+                self.isLast = start + len(frames) == len(image.frames)
+                self.detected = None
+                self.labeled = None
+                self.labelMaps = None
+                self.overlays = None
+
+        def Load():
+            for image in LoadImages(parserArgs.imagesPath, size=[512, 512], mode="L"):
+                for start in range(0, len(image.frames), parserArgs.batchSize):
+                    end = min(start + parserArgs.batchSize, len(image.frames))
+                    yield FrameBatch(image, start, [image.frames[i] for i in range(start, end)])
+
+        def Detect(batch: FrameBatch):
+            batch.detected = detector.DetectBatch(batch.frames)
+            return batch
+
+        def Labeling(batch: FrameBatch):
+            batch.labeled = [labeler.Label(detected) for detected in batch.detected]
+            return batch
+
+        trackers = []
+
+        def Track(batch: FrameBatch):
+            if not trackers or (parserArgs.batch and batch.start == 0):
+                trackers.append(Tracker())
+            firstFrame = trackers[-1].frame
+            batch.labelMaps = [trackers[-1].Track(labeled) for labeled in batch.labeled]
+            if parserArgs.gif:
+                # The overlays of this batch only depend on the tracks so far, so they can be drawn while later
+                # batches are tracked.
+                batch.overlays = LabelTracksStream(list(trackers[-1].GetTracks()), (255, 255, 255, 255), 255, 50,
+                                                   (0, 205, 108), {}, batch.frames, firstFrame)
+            return batch
+
+        def Overlay(batch: FrameBatch):
+            if batch.overlays is not None:
+                batch.overlays = list(batch.overlays)
+            return batch
+
+        csvFile = open(outputPath / "trackResults.csv", "w+")
+        csvFile.write("Image name, Frame, Original Label, Organoid ID" +
+                      "".join([", " + feature for feature in features]) + "\n")
+
+        # Output frames are appended to their files as they come out of the pipeline, so nothing is held on to
+        # between batches. In --batch mode every image gets its own GIF; otherwise all frames go to one.
+        compression = "deflate" if parserArgs.compress else None
+        writers = {}
+        if parserArgs.gif and not parserArgs.batch:
+            writers["gif"] = GIFWriter(outputPath / "trackResults_tracked.gif")
+
+        frameNumber = 0
+        for batch in StreamStages(Load(), [Detect, Labeling, Track, Overlay], parserArgs.queueSize):
+            name = batch.image.path.stem
+            for i in range(len(batch.frames)):
+                Printer.printRep("Processed %s (%d/%d)" % (name, batch.start + i + 1, len(batch.image.frames)))
+                trackFrame = batch.start + i if parserArgs.batch else frameNumber
+                labels, values = MeasureFrame(batch.labeled[i], features)
+                csvFile.writelines("%s, %d, %d, %d%s\n" % (name, trackFrame, label, batch.labelMaps[i][label],
+                                                            "".join([", " + str(column[j]) for column in values]))
+                                   for j, label in enumerate(labels))
+                frameNumber += 1
+
+            if batch.start == 0:
+                frameCount = len(batch.image.frames)
+                if parserArgs.detections:
+                    writers["detections"] = ImageWriter(outputPath / (name + "_detected.tiff"), frameCount,
+                                                        parserArgs.bigtiff, compression)
+                if parserArgs.labeled:
+                    writers["labeled"] = ImageWriter(outputPath / (name + "_labeled.tiff"), frameCount,
+                                                     parserArgs.bigtiff, compression)
+                if parserArgs.gif and parserArgs.batch:
+                    writers["gif"] = GIFWriter(outputPath / (name + "_tracked.gif"))
+
+            for key, frames in [("detections", batch.detected), ("labeled", batch.labeled), ("gif", batch.overlays)]:
+                if key in writers:
+                    for frame in frames:
+                        writers[key].Append(frame)
+
+            if batch.isLast:
+                for key in ["detections", "labeled"] + (["gif"] if parserArgs.batch else []):
+                    if key in writers:
+                        writers.pop(key).Close()
+        Printer.printRep()
+
+        if parserArgs.gif and not parserArgs.batch:
+            writers.pop("gif").Close()
+        csvFile.close()
+        if cache is not None:
+            print(cache.Report())
@@ -27,7 +27,7 @@ class Track(Program):
                             help="If set, each image will be treated as a separate tracking stack.")
 
     def RunProgram(self, parserArgs: argparse.Namespace):
-        from backend.ImageManager import LoadImages, SaveGIF, LabelTracks, SaveImage
+        from backend.ImageManager import LoadImages, GIFWriter, LabelTracksStream, SaveImage
         from backend.Tracker import Tracker
 
         if parserArgs.batch:
@@ -47,13 +47,15 @@ class Track(Program):
                     count += 1
 
                 # Load original images
-                originalFrames = [frame * parserArgs.brightness for frame in originalImage.frames]
-                outputImages = LabelTracks(tracker.GetTracks(), (255, 255, 255, 255), 255, 50, (0, 205, 108), {},
-                                           originalFrames)
+                originalFrames = (frame * parserArgs.brightness for frame in originalImage.frames)
 
                 if parserArgs.gif:
-                    # Export GIF
-                    SaveGIF(outputImages, parserArgs.outputPath / (originalImage.path.stem + "_tracked.gif"))
+                    # Export GIF, one frame at a time as each is drawn
+                    writer = GIFWriter(parserArgs.outputPath / (originalImage.path.stem + "_tracked.gif"))
+                    for outputImage in LabelTracksStream(tracker.GetTracks(), (255, 255, 255, 255), 255, 50,
+                                                         (0, 205, 108), {}, originalFrames):
+                        writer.Append(outputImage)
+                    writer.Close()
 
                 if parserArgs.features:
                     trackInfo = "Frame, Original Label, Organoid ID, " + ", ".join(parserArgs.features)
@@ -89,22 +91,20 @@ class Track(Program):
 
         # Load original images
         originalImages = LoadImages(parserArgs.originalImagesPath, mode='L')
-        originalFrames = [frame for baseImage in originalImages for frame in baseImage.frames]
-        outputImages = LabelTracks(tracker.GetTracks(), (255, 255, 255, 255), 255, 50, (0, 205, 108), {},
-                                   originalFrames)
-
-        if parserArgs.gif:
-            # Export GIF
-            SaveGIF(outputImages, parserArgs.outputPath / "trackResults.gif")
-
-        # Export original images
-        if parserArgs.individual:
-            i = 0
-            for outputImage in outputImages:
-                fileName = "trackResults_" + str(i) + ".png"
-                i += 1
-                savePath = parserArgs.outputPath / fileName
-                SaveImage(outputImage, savePath)
+        originalFrames = (frame for baseImage in originalImages for frame in baseImage.frames)
+
+        # Overlaid frames are drawn and written one at a time (as a GIF and/or separate frames).
+        if parserArgs.gif or parserArgs.individual:
+            writer = GIFWriter(parserArgs.outputPath / "trackResults.gif") if parserArgs.gif else None
+            outputImages = LabelTracksStream(tracker.GetTracks(), (255, 255, 255, 255), 255, 50, (0, 205, 108), {},
+                                             originalFrames)
+            for i, outputImage in enumerate(outputImages):
+                if writer is not None:
+                    writer.Append(outputImage)
+                if parserArgs.individual:
+                    SaveImage(outputImage, parserArgs.outputPath / ("trackResults_" + str(i) + ".png"))
+            if writer is not None:
+                writer.Close()
 
         csvFile = open(parserArgs.outputPath / "trackResults.csv", 'w+')
         if parserArgs.features:
@@ -31,25 +31,105 @@ class Train(Program):
                             type=int)
         parser.add_argument("-S", dest='size', nargs=2, default=[512, 512],
                             help="Size of input images (e.g. -S 512 512).", type=int)
+        parser.add_argument("--keep-best", dest="keepBest", default=5, type=int,
+                            help="Number of per-epoch checkpoints with the lowest validation loss to keep in "
+                                 "outputPath/epochs (0: none).")
+        parser.add_argument("--keep-every", dest="keepEvery", default=None, type=int,
+                            help="Also keep the checkpoint of every Nth epoch (1: keep all of them).")
+        parser.add_argument("--intra-op-threads", dest="intraOpThreads", default=None, type=int,
+                            help="Number of threads that each operation (e.g. a convolution) may use (default: one "
+                                 "per core).")
+        parser.add_argument("--inter-op-threads", dest="interOpThreads", default=None, type=int,
+                            help="Number of operations that may run at once (default: one per core).")
+        parser.add_argument("--mixed-precision", dest="mixedPrecision", action="store_true",
+                            help="Compute in bfloat16 with float32 weights, if the CPU supports bfloat16. Saved "
+                                 "models are float32.")
+        parser.add_argument("--accumulate", dest="accumulationSteps", default=1, type=int,
+                            help="Number of batches to accumulate gradients over before each weight update, to "
+                                 "emulate a batch size that many times larger than -B.")
+        parser.add_argument("--variants", nargs="+", choices=["dynamic", "float16", "int8"], default=[],
+                            help="Quantized TFLite models to export along with model.tflite, with a report of their "
+                                 "size, latency and agreement with the float model (see the export sub-program).")
+        parser.add_argument("--representative-count", dest="representativeCount", default=100, type=int,
+                            help="Number of validation images to calibrate and evaluate quantized models with.")
+        parser.add_argument("--input", dest="input", choices=["tf.data", "generator", "packed"], default="tf.data",
+                            help="How training images are loaded: with a parallel, prefetching tf.data pipeline, "
+                                 "one batch at a time with the Keras generator, or as slices of the array files "
+                                 "written by the pack sub-program (then inputPath is the pack output directory).")
+        parser.add_argument("--data-cache", dest="dataCache", nargs="?", const="memory", default=None,
+                            help="Cache decoded training images after the first epoch (tf.data only): in memory, or "
+                                 "in files with the given path prefix.")
+        parser.add_argument("--shuffle-buffer", dest="shuffleBuffer", default=None, type=int,
+                            help="Number of cached training images to shuffle between (default: all of them).")
+        parser.add_argument("--augment", action="store_true",
+                            help="Randomly rotate, flip, zoom, shear, distort and skew training images (and their "
+                                 "segmentations) in memory as they are loaded, like the augment sub-program, so every "
+                                 "epoch is augmented differently.")
+        parser.add_argument("--augment-workers", dest="augmentWorkers", default=None, type=int,
+                            help="Number of threads that augment each batch (default: one per CPU).")
+        parser.add_argument("--benchmark-input", dest="benchmarkSteps", default=None, type=int,
+                            help="Instead of training, report the input and training steps per second of the tf.data "
+                                 "pipeline and of the generator (and of packed data, if inputPath has it) over this "
+                                 "many steps.")
 
     def RunProgram(self, parserArgs: argparse.Namespace):
-        from backend.ModelTrainer import ModelTrainer
-        from backend.ModelDataGenerator import ModelDataGenerator
+        from backend.ModelTrainer import ModelTrainer, ConfigureCPUTraining
+
+        ConfigureCPUTraining(parserArgs.intraOpThreads, parserArgs.interOpThreads, parserArgs.mixedPrecision)
 
         # OrganoID U-Net starts with 8 filters in the first convolutional layer. Create the trainer.
-        trainer = ModelTrainer(parserArgs.size, parserArgs.dropoutRate, 8)
+        trainer = ModelTrainer(parserArgs.size, parserArgs.dropoutRate, 8, parserArgs.accumulationSteps)
 
-        # Training and validation images are read in on-the-fly to avoid storing everything in memory.
-        trainingDataGenerator = ModelDataGenerator(parserArgs.inputPath / "training" / "images",
-                                                   parserArgs.inputPath / "training" / "segmentations",
-                                                   parserArgs.size,
-                                                   parserArgs.batchSize)
+        if parserArgs.benchmarkSteps is not None:
+            self.Benchmark(parserArgs, trainer)
+            return
 
-        validationDataGenerator = ModelDataGenerator(parserArgs.inputPath / "validation" / "images",
-                                                     parserArgs.inputPath / "validation" / "segmentations",
-                                                     parserArgs.size,
-                                                     parserArgs.batchSize)
+        # Training and validation images are read in on-the-fly to avoid storing everything in memory.
+        trainingData = self.LoadData(parserArgs, "training", parserArgs.input, True)
+        validationData = self.LoadData(parserArgs, "validation", parserArgs.input, False)
 
         # Run the trainer.
         trainer.Train(parserArgs.learningRate, parserArgs.patience, parserArgs.epochs,
-                      trainingDataGenerator, validationDataGenerator, parserArgs.outputPath)
+                      trainingData, validationData, parserArgs.outputPath, parserArgs.keepBest, parserArgs.keepEvery,
+                      parserArgs.variants, parserArgs.representativeCount)
+
+    def LoadData(self, parserArgs: argparse.Namespace, subset, method, shuffle):
+        imagesPath = parserArgs.inputPath / subset / "images"
+        segmentationsPath = parserArgs.inputPath / subset / "segmentations"
+
+        # Only training data is augmented.
+        augmenter = None
+        if parserArgs.augment and subset == "training":
+            from backend.Augment import Augmenter
+            augmenter = Augmenter(parserArgs.augmentWorkers)
+
+        if method in ["packed", "generator"]:
+            from backend.ModelDataGenerator import ModelDataGenerator, PackedDataGenerator, AugmentedDataGenerator
+            if method == "packed":
+                data = PackedDataGenerator(parserArgs.inputPath / (subset + ".npy"), parserArgs.batchSize, shuffle)
+                if list(data.imageSize) != list(parserArgs.size):
+                    raise ValueError("Packed images are %dx%d, not the requested -S size" % tuple(data.imageSize))
+            else:
+                data = ModelDataGenerator(imagesPath, segmentationsPath, parserArgs.size, parserArgs.batchSize)
+            return data if augmenter is None else AugmentedDataGenerator(data, augmenter)
+
+        from backend.ModelDataPipeline import BuildDataset
+        cache = parserArgs.dataCache
+        if cache is not None and cache != "memory":
+            cache += "_" + subset
+        return BuildDataset(imagesPath, segmentationsPath, parserArgs.size, parserArgs.batchSize, shuffle, cache,
+                            parserArgs.shuffleBuffer, augmenter)
+
+    def Benchmark(self, parserArgs: argparse.Namespace, trainer):
+        from backend.ModelDataPipeline import BenchmarkInput
+
+        steps = parserArgs.benchmarkSteps
+        print("Input       Input steps/s  Training steps/s")
+        methods = ["generator", "tf.data"]
+        if (parserArgs.inputPath / "training.npy").is_file():
+            methods.append("packed")
+        for method in methods:
+            data = self.LoadData(parserArgs, "training", method, True)
+            inputRate = BenchmarkInput(data, steps)
+            trainingRate = trainer.BenchmarkTraining(parserArgs.learningRate, data, steps)
+            print("%-11s %13.2f %17.2f" % (method, inputRate, trainingRate))
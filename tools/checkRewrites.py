@@ -0,0 +1,382 @@
+# checkRewrites.py -- checks that code paths that were rewritten for speed give the same results as straightforward
+# reference implementations of the original code, on the testing dataset and on synthetic scenes. Run from anywhere:
+#   python tools/checkRewrites.py [check ...]
+# Runs the named checks (default: all), prints one line for each, and exits with status 1 if any of them failed.
+
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from scipy import ndimage
+from scipy.optimize import linear_sum_assignment
+from skimage.measure import regionprops
+from backend.ImageManager import LoadImages, LabelTracks, ComputeOutline, TIFFWriter, SaveGIF
+from backend.Label import FillHoles
+from backend.SyntheticScenes import SyntheticScene
+from backend.Tracker import Tracker
+
+_root = Path(__file__).parent.parent
+
+
+# Raised by a check that cannot run here.
+class CheckSkipped(Exception):
+    pass
+
+
+# Labeled images of the testing dataset: each segmentation, split into organoids by connectivity.
+def TestingLabels():
+    return [ndimage.label(frame)[0].astype(np.int32)
+            for image in LoadImages(_root / "dataset" / "testing" / "segmentations", mode="1")
+            for frame in image.frames]
+
+
+# Time-lapse sequences of labeled images. Testing segmentations are made into sequences by moving them a little every
+# frame, growing them every third frame and dropping a few organoids from each frame. Synthetic scenes add merges,
+# splits and organoids that hide each other.
+def Sequences(frames=6, seed=0):
+    rng = np.random.default_rng(seed)
+    sequences = []
+    for labeled in TestingLabels():
+        sequence = []
+        for k in range(frames):
+            frame = np.roll(labeled, (2 * k, k), axis=(0, 1))
+            if k % 3 == 2:
+                frame = ndimage.grey_dilation(frame, size=3)
+            present = np.unique(frame)[1:]
+            frame = np.where(np.isin(frame, rng.choice(present, min(3, len(present)), replace=False)), 0, frame)
+            sequence.append(frame.astype(np.int32))
+        sequences.append(sequence)
+    for seed in range(3):
+        scene = SyntheticScene(organoids=80, frames=frames, imageSize=(256, 256), radius=(5, 14), jitter=2,
+                               mergeRate=0.05, splitRate=0.05, disappearRate=0.05, seed=seed)
+        sequences.append([labels for labels, _ in scene.Frames()])
+    return sequences
+
+
+# Tracks a sequence, calling compare(tracker, tracks, image, labels) before each frame is tracked, with the tracks
+# that the frame is matched against. Returns the failures that compare reported.
+def _TrackAndCompare(sequence, compare):
+    tracker = Tracker()
+    failures = []
+    for frame, image in enumerate(sequence):
+        labels = np.flatnonzero(np.bincount(image.ravel())[1:]) + 1
+        tracks = [track for track in tracker.GetTracks() if track.active]
+        failures += ["frame %d: %s" % (frame, failure) for failure in compare(tracker, tracks, image, labels)]
+        tracker.Track(image)
+    return failures
+
+
+# Cost of assigning each track (by the pixels of its last detection) to each region, as the original tracker computed
+# it: overlapCost divided by the number of shared pixels, or infinity if they do not overlap.
+def ReferenceOverlapCosts(tracker: Tracker, tracks, image: np.ndarray, labels: np.ndarray):
+    costs = np.full([len(tracks), len(labels)], np.inf)
+    for i, track in enumerate(tracks):
+        coords = np.asarray(track.GetLastDetectedData().coords)
+        overlapping = image[coords[:, 0], coords[:, 1]]
+        for j, label in enumerate(labels):
+            overlap = np.count_nonzero(overlapping == label)
+            if overlap > 0:
+                costs[i, j] = (1 / overlap) * tracker.overlapCost
+    return costs
+
+
+def _DenseCosts(tracks, labels, trackIndices, detectionIndices, costs):
+    dense = np.full([len(tracks), len(labels)], np.inf)
+    dense[trackIndices, detectionIndices] = costs
+    return dense
+
+
+# Tracker.OverlapCosts (joint label histogram) against the per-track, per-region count of shared pixels.
+def CheckOverlapCosts():
+    def Compare(tracker, tracks, image, labels):
+        dense = _DenseCosts(tracks, labels, *tracker.OverlapCosts(tracks, image, labels))
+        reference = ReferenceOverlapCosts(tracker, tracks, image, labels)
+        if not np.array_equal(dense, reference):
+            return ["%d of %d overlap costs differ" % (np.count_nonzero(dense != reference), dense.size)]
+        return []
+
+    return [failure for sequence in Sequences() for failure in _TrackAndCompare(sequence, Compare)]
+
+
+# Assignment of tracks to regions as the original tracker solved it: one assignment problem over all tracks and regions,
+# with the costs of new and missing organoids on the diagonals of the dummy blocks. Returns the region index assigned
+# to each track (-1 for missing) and the total cost.
+def ReferenceAssign(tracker: Tracker, costs: np.ndarray):
+    numTracks, numDetections = costs.shape
+    fullSize = numTracks + numDetections
+    costMatrix = np.zeros([fullSize, fullSize])
+    costMatrix[:numTracks, :numDetections] = costs
+    newOrganoidMatrix = np.full([numDetections, numDetections], np.inf)
+    np.fill_diagonal(newOrganoidMatrix, tracker.costOfNewOrganoid)
+    costMatrix[numTracks:, :numDetections] = newOrganoidMatrix
+    missingOrganoidMatrix = np.full([numTracks, numTracks], np.inf)
+    np.fill_diagonal(missingOrganoidMatrix, tracker.costOfMissingOrganoid)
+    costMatrix[:numTracks, numDetections:] = missingOrganoidMatrix
+
+    rows, columns = linear_sum_assignment(costMatrix)
+    assignments = np.full(numTracks, -1)
+    for row, column in zip(rows, columns):
+        if row < numTracks and column < numDetections:
+            assignments[row] = column
+    return assignments, costMatrix[rows, columns].sum()
+
+
+def _AssignmentCost(tracker: Tracker, costs: np.ndarray, assignments: np.ndarray):
+    assigned = assignments >= 0
+    return costs[assigned, assignments[assigned]].sum() + \
+        tracker.costOfMissingOrganoid * np.count_nonzero(~assigned) + \
+        tracker.costOfNewOrganoid * (costs.shape[1] - np.count_nonzero(assigned))
+
+
+# Tracker.Assign (one assignment problem per connected component of candidate pairs) against one problem over all
+# tracks and regions. Where several assignments are optimal, the two may pick different ones, so assignments are
+# compared by their total cost, and the number of tracks assigned differently is only reported if the costs differ.
+def CheckAssignment():
+    def Compare(tracker, tracks, image, labels):
+        trackIndices, detectionIndices, costs = tracker.OverlapCosts(tracks, image, labels)
+        assignments = tracker.Assign(len(tracks), len(labels), trackIndices, detectionIndices, costs)
+        dense = _DenseCosts(tracks, labels, trackIndices, detectionIndices, costs)
+        reference, referenceCost = ReferenceAssign(tracker, dense)
+        cost = _AssignmentCost(tracker, dense, assignments)
+        if not np.isclose(cost, referenceCost, rtol=1e-9, atol=0):
+            return ["total cost %r instead of %r (%d tracks assigned differently)" %
+                    (cost, referenceCost, np.count_nonzero(assignments != reference))]
+        return []
+
+    return [failure for sequence in Sequences() for failure in _TrackAndCompare(sequence, Compare)]
+
+
+# Hole filling as the original code did it: each label's mask is filled over the whole image, in ascending label order.
+def ReferenceFillHoles(image: np.ndarray):
+    filledImage = np.zeros_like(image)
+    for label in np.unique(image):
+        if label == 0:
+            continue
+        filledImage[ndimage.binary_fill_holes(image == label)] = label
+    return filledImage
+
+
+# Labeled images with holes: testing labels and synthetic frames with random background pixels punched into their
+# regions, and with rings drawn around some regions, so that filled regions overlap. Labels are shuffled, so that rings
+# have both higher and lower labels than the regions they enclose.
+def HoleyLabels(seed=0):
+    rng = np.random.default_rng(seed)
+    images = TestingLabels()
+    images += [labels for labels, _ in SyntheticScene(organoids=60, frames=2, imageSize=(256, 256), radius=(6, 20),
+                                                      seed=seed).Frames()]
+    holey = []
+    for image in images:
+        image = image.copy()
+        image[(image > 0) & (rng.random(image.shape) < 0.05)] = 0
+        for box in ndimage.find_objects(image)[:10]:
+            if box is None:
+                continue
+            top, left = max(0, box[0].start - 2), max(0, box[1].start - 2)
+            bottom, right = min(image.shape[0], box[0].stop + 2), min(image.shape[1], box[1].stop + 2)
+            ring = np.zeros(image.shape, dtype=bool)
+            ring[top:bottom, left:right] = True
+            ring[top + 1:bottom - 1, left + 1:right - 1] = False
+            image[ring] = image.max() + 1
+        permutation = np.concatenate([[0], rng.permutation(image.max()) + 1])
+        holey.append(permutation[image].astype(image.dtype))
+    return holey
+
+
+# Label.FillHoles (each label filled within its bounding box) against filling each label over the whole image.
+def CheckFillHoles():
+    failures = []
+    for i, image in enumerate(HoleyLabels()):
+        filled, reference = FillHoles(image), ReferenceFillHoles(image)
+        if not np.array_equal(filled, reference):
+            failures.append("image %d: %d pixels differ" % (i, np.count_nonzero(filled != reference)))
+    return failures
+
+
+# Track overlays as the original code drew them: for each track in turn, its fill, outline and number are drawn onto an
+# RGBA layer with PIL, which is then composited onto the frame. Frames must be square.
+def ReferenceLabelTracks(tracks, labelColor, outlineAlpha, fillAlpha, mainColor, specialColorMap, baseImages):
+    images = []
+    font = ImageFont.truetype("arial.ttf", 26)
+    for frame, baseImage in enumerate(baseImages):
+        pilImage = Image.new(mode="RGBA", size=baseImage.shape[:2], color=(0, 0, 0, 0))
+        drawer = ImageDraw.Draw(pilImage)
+        for track in tracks:
+            if not track.WasDetected(frame):
+                continue
+            mask = np.zeros(baseImage.shape[:2], dtype=np.uint8)
+            mask[tuple(np.asarray(track.Data(frame).coords).T)] = 1
+            region = regionprops(mask)[0]
+            color = specialColorMap.get(track.id, mainColor)
+            drawer.point(list(zip(region.coords[:, 1], region.coords[:, 0])), color + (fillAlpha,))
+            outline = ComputeOutline(region.image) + region.bbox[:2]
+            drawer.point(list(zip(outline[:, 1], outline[:, 0])), color + (outlineAlpha,))
+            y, x = region.centroid
+            drawer.text((x, y), str(track.id), anchor="ms", fill=labelColor, font=font)
+        baseImage = Image.fromarray(baseImage).convert(mode="RGBA")
+        images.append(np.asarray(Image.alpha_composite(baseImage, pilImage).convert(mode="RGB")))
+    return images
+
+
+# ImageManager.LabelTracks (array-based overlays) against drawing each track with PIL, on tracked synthetic scenes
+# (dense enough that numbers overlap other tracks) and square testing sequences, over gray and RGB frames. Needs
+# arial.ttf in the working directory, as LabelTracks does.
+def CheckTrackOverlays():
+    try:
+        ImageFont.truetype("arial.ttf", 26)
+    except OSError:
+        raise CheckSkipped("arial.ttf not found in the working directory")
+
+    sequences = [sequence[:3] for sequence in Sequences() if sequence[0].shape[0] == sequence[0].shape[1]][:2]
+    sequences.append([labels for labels, _ in SyntheticScene(organoids=150, frames=3, imageSize=(300, 300),
+                                                             radius=(6, 14), seed=3).Frames()])
+    failures = []
+    for i, sequence in enumerate(sequences):
+        tracker = Tracker()
+        for image in sequence:
+            tracker.Track(image)
+        tracks = tracker.GetTracks()
+        special = {tracks[len(tracks) // 2].id: (255, 0, 0)}
+        gray = [(image * 37 % 256).astype(np.uint8) for image in sequence]
+        for bases in [gray, [np.stack([base, 255 - base, base // 2], axis=2) for base in gray]]:
+            arguments = (tracks, (255, 255, 255, 255), 255, 50, (0, 205, 108), special, bases)
+            for frame, (overlay, reference) in enumerate(zip(LabelTracks(*arguments),
+                                                             ReferenceLabelTracks(*arguments))):
+                if not np.array_equal(overlay, reference):
+                    failures.append("sequence %d, frame %d (%s): %d pixels differ" %
+                                    (i, frame, "gray" if bases is gray else "RGB",
+                                     np.count_nonzero((overlay != reference).any(axis=2))))
+    return failures
+
+
+# Frames of each type that TIFFWriter accepts, with values across the type's range.
+def TIFFTestFrames(count=3, shape=(37, 53), seed=0):
+    rng = np.random.default_rng(seed)
+    frames = {"bool": rng.random((count,) + shape) < 0.5,
+              "float32": rng.normal(0, 1000, (count,) + shape).astype(np.float32),
+              "float64": rng.normal(0, 1000, (count,) + shape),
+              "rgb": rng.integers(0, 256, (count,) + shape + (3,), dtype=np.uint8),
+              "rgba": rng.integers(0, 256, (count,) + shape + (4,), dtype=np.uint8),
+              "int64": rng.integers(np.iinfo(np.int32).min, np.iinfo(np.int32).max, (count,) + shape),
+              "bigendian": rng.integers(0, 2 ** 16, (count,) + shape).astype(">u2")}
+    for dtype in [np.uint8, np.int8, np.uint16, np.int16, np.int32]:
+        limits = np.iinfo(dtype)
+        frames[np.dtype(dtype).name] = rng.integers(limits.min, limits.max, (count,) + shape, dtype=dtype,
+                                                    endpoint=True)
+    # PIL holds 32-bit samples as signed, so unsigned values from 2^31 up can not be read back with it.
+    frames["uint32"] = rng.integers(0, np.iinfo(np.int32).max, (count,) + shape, dtype=np.uint32, endpoint=True)
+    return frames
+
+
+# PIL saves big-endian frames in a big-endian file, and reads them back in these modes. TIFFWriter always writes
+# little-endian files.
+_littleEndianModes = {"I;16B": "I;16", "I;16BS": "I;16S"}
+
+
+def _ReadPIL(path: Path):
+    with Image.open(path) as image:
+        frames = []
+        for i in range(getattr(image, "n_frames", 1)):
+            image.seek(i)
+            frames.append((image.mode, np.array(image)))
+        return frames
+
+
+# TIFFWriter against the frames it was given, for every frame type, with and without BigTIFF and deflate compression.
+# Each file is read back with PIL and with LoadImages (which memory-maps uncompressed frames), and, for the types that
+# the original code could save through PIL without changing their values, compared with the file PIL writes: same
+# modes and values.
+def CheckTIFF():
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, frames in TIFFTestFrames().items():
+            expected = frames.astype(np.float32) if frames.dtype == np.float64 else frames
+            referencePath = Path(directory) / (name + "_reference.tif")
+            try:
+                Image.fromarray(frames[0]).save(referencePath, save_all=True,
+                                                append_images=[Image.fromarray(frame) for frame in frames[1:]])
+                reference = _ReadPIL(referencePath)
+            except (TypeError, ValueError, OSError):
+                reference = None
+            if reference is not None and not all(np.array_equal(frame, expected[i])
+                                                 for i, (_, frame) in enumerate(reference)):
+                # PIL does not keep these values (e.g. signed 8-bit frames come back unsigned).
+                reference = None
+
+            for bigTIFF in [False, True]:
+                for compression in [None, "deflate"]:
+                    description = "%s%s%s" % (name, ", BigTIFF" if bigTIFF else "",
+                                              ", " + compression if compression else "")
+                    path = Path(directory) / ("%s_%s_%s.tif" % (name, bigTIFF, compression))
+                    with TIFFWriter(path, bigTIFF, compression, rowsPerStrip=16) as writer:
+                        for frame in frames:
+                            writer.Append(frame)
+
+                    decoded = _ReadPIL(path)
+                    loaded = next(LoadImages(path)).frames
+                    if len(decoded) != len(frames) or len(loaded) != len(frames):
+                        failures.append("%s: %d frames read back instead of %d" %
+                                        (description, len(decoded), len(frames)))
+                        continue
+                    for i, ((mode, frame), loadedFrame) in enumerate(zip(decoded, loaded)):
+                        if not np.array_equal(frame, expected[i]):
+                            failures.append("%s: frame %d read back by PIL differs" % (description, i))
+                        if not np.array_equal(loadedFrame, expected[i]):
+                            failures.append("%s: frame %d loaded by LoadImages differs" % (description, i))
+                        referenceMode = _littleEndianModes.get(reference[i][0], reference[i][0]) if reference else None
+                        if reference is not None and (mode, frame.tolist()) != (referenceMode,
+                                                                               reference[i][1].tolist()):
+                            failures.append("%s: frame %d differs from PIL's TIFF (mode %s instead of %s)" %
+                                            (description, i, mode, referenceMode))
+    return failures
+
+
+# SaveGIF (frames written one at a time) against PIL saving all frames at once, for gray and RGB frames: the same
+# frames when decoded, and the same loop setting.
+def CheckGIF():
+    failures = []
+    rng = np.random.default_rng(0)
+    gray = [ndimage.zoom(rng.integers(0, 256, (10, 12)).astype(np.uint8), 6) for _ in range(4)]
+    sequences = {"gray": gray, "RGB": [np.stack([frame, 255 - frame, frame // 2], axis=2) for frame in gray],
+                 "labels": [(labels * 37 % 256).astype(np.uint8) for labels, _ in
+                            SyntheticScene(organoids=30, frames=4, imageSize=(128, 128), seed=0).Frames()]}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, frames in sequences.items():
+            path, referencePath = Path(directory) / (name + ".gif"), Path(directory) / (name + "_reference.gif")
+            SaveGIF(frames, path)
+            Image.fromarray(frames[0]).save(referencePath, save_all=True,
+                                            append_images=[Image.fromarray(frame) for frame in frames[1:]], loop=0)
+            with Image.open(path) as image, Image.open(referencePath) as reference:
+                if image.n_frames != reference.n_frames or image.info.get("loop") != reference.info.get("loop"):
+                    failures.append("%s: %d frames and loop %s instead of %d and %s" %
+                                    (name, image.n_frames, image.info.get("loop"), reference.n_frames,
+                                     reference.info.get("loop")))
+                    continue
+                for i in range(image.n_frames):
+                    image.seek(i)
+                    reference.seek(i)
+                    if not np.array_equal(np.asarray(image.convert("RGB")), np.asarray(reference.convert("RGB"))):
+                        failures.append("%s: frame %d differs" % (name, i))
+    return failures
+
+
+checks = {"overlap": CheckOverlapCosts, "assignment": CheckAssignment, "fillholes": CheckFillHoles,
+          "overlays": CheckTrackOverlays, "tiff": CheckTIFF, "gif": CheckGIF}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(checks)
+    failed = False
+    for name in names:
+        try:
+            failures = checks[name]()
+        except CheckSkipped as skipped:
+            print("%-10s skipped: %s" % (name, skipped))
+            continue
+        print("%-10s %s" % (name, "ok" if not failures else "FAILED"))
+        for failure in failures[:10]:
+            print("    " + failure)
+        failed |= bool(failures)
+    sys.exit(1 if failed else 0)